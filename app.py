@@ -1,9 +1,19 @@
-from flask import Flask, request, jsonify
+import time
+_import_started = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import os
+import json
+import atexit
 import logging
-from rag_system import RAGSystem
-from vector_database import create_vector_database
+import threading
+from config import load_environment
+from intent_classifier import IntentClassifier
+from rag_system import RAGSystem, FUSED_PROMPT
+from vector_database import create_vector_database, index_exists
+from search_backends import parse_search_params
+from startup_timeline import StartupTimeline
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO)
@@ -12,22 +22,64 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)  # Cho phép CORS
 
+# Thời gian từng bước khởi động, tính từ lúc bắt đầu import app
+startup_timeline = StartupTimeline(started_at=_import_started)
+startup_timeline.record('import', (time.perf_counter() - _import_started) * 1000)
+
 # Khởi tạo hệ thống RAG
 rag_system = None
+# Sẵn sàng trước rag_system (không cần model/index), để /api/intent phục vụ được sớm
+intent_classifier = None
+_init_lock = threading.Lock()
+_init_started = False
+
+# Số câu tối đa trong một request batch và số lời gọi LLM đồng thời của /api/chat/batch
+MAX_BATCH_SIZE = int(os.getenv('API_MAX_BATCH_SIZE', '256'))
+CHAT_BATCH_CONCURRENCY = int(os.getenv('CHAT_BATCH_CONCURRENCY', '4'))
 
-def initialize_rag_system():
-    """Khởi tạo hệ thống RAG"""
-    global rag_system
+def initialize_rag_system(warm_up: bool = False):
+    """Khởi tạo hệ thống RAG theo từng bước, thời gian từng bước được ghi vào startup_timeline"""
+    global rag_system, intent_classifier
     
     try:
+        with startup_timeline.stage('env'):
+            load_environment()
+        if intent_classifier is None:
+            with startup_timeline.stage('intent_classifier'):
+                intent_classifier = IntentClassifier(
+                    prompt_mode=os.getenv('INTENT_PROMPT_MODE', 'few_shot'),
+                    fused_prompt=FUSED_PROMPT if os.getenv('RAG_PIPELINE_MODE', 'two_stage') == 'fused' else None)
+
         # Kiểm tra vector database
-        if not os.path.exists("vector_db/coca_cola_index.index"):
+        if not index_exists("vector_db/coca_cola_index"):
             logger.info("Tạo vector database...")
-            create_vector_database(index_type="IndexFlatL2")
+            with startup_timeline.stage('build_vector_db'):
+                create_vector_database()
             logger.info("Đã tạo xong vector database!")
         
         # Khởi tạo RAG system
-        rag_system = RAGSystem()
+        system = RAGSystem(
+            pipeline_mode=os.getenv('RAG_PIPELINE_MODE', 'two_stage'),
+            response_mode=os.getenv('RESPONSE_MODE', 'template'),
+            speculative_top_n=int(os.getenv('SPECULATIVE_TOP_N', '100')),
+            speculative_workers=int(os.getenv('SPECULATIVE_WORKERS', '4')),
+            context_token_budget=int(os.getenv('CONTEXT_TOKEN_BUDGET', '1000')) or None,
+            search_backend=os.getenv('VECTOR_BACKEND', 'auto'),
+            search_params=parse_search_params(os.getenv('VECTOR_SEARCH_PARAMS')),
+            intent_classifier=intent_classifier,
+            timeline=startup_timeline,
+            response_cache_size=int(os.getenv('RESPONSE_CACHE_SIZE', '1024')),
+            response_cache_ttl=float(os.getenv('RESPONSE_CACHE_TTL', '3600')) or None,
+            response_cache_max_mb=float(os.getenv('RESPONSE_CACHE_MAX_MB', '64')),
+            semantic_cache_size=int(os.getenv('SEMANTIC_CACHE_SIZE', '2048')),
+            semantic_cache_threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.88'))
+        )
+        if warm_up:
+            with startup_timeline.stage('warm_up'):
+                system.warm_up()
+        rag_system = system
+        atexit.register(system.close)
+        startup_timeline.finish()
         logger.info("Đã khởi tạo RAG system thành công!")
         return True
         
@@ -35,12 +87,101 @@ def initialize_rag_system():
         logger.error(f"Lỗi khởi tạo RAG system: {e}")
         return False
 
+def create_app(warm_up: bool = True, background: bool = False) -> Flask:
+    """
+    App factory (dùng với gunicorn: gunicorn -c gunicorn.conf.py "app:create_app()").
+    Khởi tạo RAG system một lần; với preload_app việc này chạy trong process master nên các worker
+    fork ra dùng chung model, index và dữ liệu sản phẩm theo cơ chế copy-on-write.
+
+    Args:
+        warm_up: Chạy thử encode/search trước khi nhận request
+        background: Khởi tạo trong thread nền và trả app ngay (/health trả lời ngay, các endpoint
+            trả 503 tới khi xong). Không dùng với preload_app vì thread không đi theo khi fork.
+    """
+    global _init_started
+    with _init_lock:
+        if _init_started:
+            return app
+        _init_started = True
+    if background:
+        threading.Thread(target=initialize_rag_system, kwargs={'warm_up': warm_up},
+                         name='rag-init', daemon=True).start()
+    elif not initialize_rag_system(warm_up=warm_up):
+        raise RuntimeError("Không thể khởi tạo RAG system")
+    return app
+
+def serialize_relevant_item(item):
+    """Chuyển một thông tin liên quan (chunk từ search hoặc sản phẩm gốc) sang dạng JSON trả về cho client"""
+    if isinstance(item, dict) and 'rank' in item and 'chunk' in item:
+        content = item['chunk']['content']
+        return {
+            'rank': item['rank'],
+            'score': item['score'],
+            'metadata': item['chunk']['metadata'],
+            'content_preview': content[:200] + '...' if len(content) > 200 else content
+        }
+    if isinstance(item, dict) and 'product_name' in item:
+        return {
+            'product_name': item.get('product_name'),
+            'description': item.get('description', ''),
+            'nutrition_facts': item.get('nutrition_facts', {}),
+            'ingredients': item.get('ingredients', [])
+        }
+    return str(item)
+
+def serialize_search_result(result):
+    """Chuyển một kết quả search sang dạng JSON trả về cho client"""
+    return {
+        'rank': result['rank'],
+        'score': result['score'],
+        'metadata': result['chunk']['metadata'],
+        'content': result['chunk']['content']
+    }
+
+def serialize_chat_result(result):
+    """Chuyển kết quả generate_response sang dạng JSON trả về cho client"""
+    return {
+        'query': result['query'],
+        'response': result['response'],
+        'intent': result['intent'],
+        'entities': result['entities'],
+        'total_chunks_found': result['total_chunks_found'],
+        'relevant_chunks': [serialize_relevant_item(item) for item in result['relevant_chunks']],
+        'cache': result.get('cache'),
+        'timings': result.get('timings'),
+        'prompt_stats': result.get('prompt_stats')
+    }
+
+def parse_batch(data, field: str):
+    """
+    Đọc danh sách câu trong request batch.
+    Trả về (danh sách câu đã strip, lỗi của từng câu) hoặc (None, thông báo lỗi của cả request)
+    """
+    if not data or not isinstance(data.get(field), list):
+        return None, f'Thiếu trường {field} (danh sách) trong request'
+    if not data[field]:
+        return None, f'{field} không được để trống'
+    if len(data[field]) > MAX_BATCH_SIZE:
+        return None, f'Tối đa {MAX_BATCH_SIZE} câu trong một request'
+    texts, errors = [], []
+    for item in data[field]:
+        text = item.strip() if isinstance(item, str) else ''
+        texts.append(text)
+        errors.append(None if text else 'Câu không hợp lệ hoặc để trống')
+    return texts, errors
+
+def format_sse(event: str, data) -> str:
+    """Định dạng một sự kiện server-sent events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
-        'rag_system_ready': rag_system is not None
+        'rag_system_ready': rag_system is not None,
+        'intent_classifier_ready': intent_classifier is not None,
+        'startup': startup_timeline.as_dict()
     })
 
 @app.route('/api/chat', methods=['POST'])
@@ -71,35 +212,7 @@ def chat():
         logger.info(f"Xử lý câu hỏi: {message}")
         result = rag_system.generate_response(message)
         
-        return jsonify({
-            'success': True,
-            'query': result['query'],
-            'response': result['response'],
-            'intent': result['intent'],
-            'entities': result['entities'],
-            'total_chunks_found': result['total_chunks_found'],
-            'relevant_chunks': [
-                (
-                    {
-                        'rank': item['rank'],
-                        'score': item['score'],
-                        'metadata': item['chunk']['metadata'],
-                        'content_preview': item['chunk']['content'][:200] + '...' if len(item['chunk']['content']) > 200 else item['chunk']['content']
-                    }
-                    if isinstance(item, dict) and 'rank' in item and 'chunk' in item
-                    else
-                    {
-                        'product_name': item.get('product_name'),
-                        'description': item.get('description', ''),
-                        'nutrition_facts': item.get('nutrition_facts', {}),
-                        'ingredients': item.get('ingredients', [])
-                    }
-                    if isinstance(item, dict) and 'product_name' in item
-                    else str(item)
-                )
-                for item in result['relevant_chunks']
-            ]
-        })
+        return jsonify(dict(success=True, **serialize_chat_result(result)))
         
     except Exception as e:
         logger.error(f"Lỗi xử lý chat: {e}")
@@ -107,6 +220,52 @@ def chat():
             'error': f'Lỗi xử lý: {str(e)}'
         }), 500
 
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """API endpoint cho chat dạng streaming (server-sent events)"""
+    data = request.get_json(silent=True)
+    
+    if not data or 'message' not in data:
+        return jsonify({
+            'error': 'Thiếu trường message trong request'
+        }), 400
+    
+    message = data['message'].strip()
+    
+    if not message:
+        return jsonify({
+            'error': 'Message không được để trống'
+        }), 400
+    
+    # Kiểm tra RAG system
+    if rag_system is None:
+        return jsonify({
+            'error': 'RAG system chưa sẵn sàng'
+        }), 503
+    
+    logger.info(f"Xử lý câu hỏi (stream): {message}")
+    
+    def event_stream():
+        try:
+            for event, payload in rag_system.generate_response_stream(message):
+                if event == 'meta':
+                    payload = dict(payload)
+                    payload['relevant_chunks'] = [serialize_relevant_item(item) for item in payload['relevant_chunks']]
+                yield format_sse(event, payload)
+        except Exception as e:
+            logger.error(f"Lỗi xử lý chat stream: {e}")
+            yield format_sse('error', {'error': f'Lỗi xử lý: {str(e)}'})
+    
+    return Response(
+        stream_with_context(event_stream()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # Tắt buffering của reverse proxy (nginx) để token tới client ngay
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 @app.route('/api/search', methods=['POST'])
 def search():
     """API endpoint cho tìm kiếm semantic"""
@@ -139,15 +298,7 @@ def search():
         return jsonify({
             'success': True,
             'query': query,
-            'results': [
-                {
-                    'rank': result['rank'],
-                    'score': result['score'],
-                    'metadata': result['chunk']['metadata'],
-                    'content': result['chunk']['content']
-                }
-                for result in results
-            ]
+            'results': [serialize_search_result(result) for result in results]
         })
         
     except Exception as e:
@@ -156,6 +307,88 @@ def search():
             'error': f'Lỗi tìm kiếm: {str(e)}'
         }), 500
 
+@app.route('/api/search/batch', methods=['POST'])
+def search_batch():
+    """API endpoint tìm kiếm semantic cho nhiều câu: encode một lần và search trên cả ma trận truy vấn"""
+    try:
+        data = request.get_json(silent=True)
+        queries, errors = parse_batch(data, 'queries')
+        if queries is None:
+            return jsonify({
+                'error': errors
+            }), 400
+        k = data.get('k', 5)
+        
+        # Kiểm tra RAG system
+        if rag_system is None:
+            return jsonify({
+                'error': 'RAG system chưa sẵn sàng'
+            }), 503
+        
+        logger.info(f"Tìm kiếm semantic theo lô: {len(queries)} câu")
+        rows = [i for i, error in enumerate(errors) if error is None]
+        batch_results = rag_system.vector_db.search_batch([queries[i] for i in rows], k=k) if rows else []
+        items = [{'query': query, 'success': False, 'error': error} for query, error in zip(queries, errors)]
+        for i, results in zip(rows, batch_results):
+            items[i] = {
+                'query': queries[i],
+                'success': True,
+                'results': [serialize_search_result(result) for result in results]
+            }
+        
+        return jsonify({
+            'success': True,
+            'total': len(items),
+            'failed': sum(1 for item in items if not item['success']),
+            'results': items
+        })
+        
+    except Exception as e:
+        logger.error(f"Lỗi tìm kiếm theo lô: {e}")
+        return jsonify({
+            'error': f'Lỗi tìm kiếm: {str(e)}'
+        }), 500
+
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    """API endpoint chat cho nhiều câu hỏi, lỗi của từng câu được trả về riêng"""
+    try:
+        data = request.get_json(silent=True)
+        messages, errors = parse_batch(data, 'messages')
+        if messages is None:
+            return jsonify({
+                'error': errors
+            }), 400
+        
+        # Kiểm tra RAG system
+        if rag_system is None:
+            return jsonify({
+                'error': 'RAG system chưa sẵn sàng'
+            }), 503
+        
+        logger.info(f"Xử lý lô câu hỏi: {len(messages)} câu")
+        rows = [i for i, error in enumerate(errors) if error is None]
+        outcomes = rag_system.generate_responses([messages[i] for i in rows], max_concurrency=CHAT_BATCH_CONCURRENCY)
+        items = [{'query': message, 'success': False, 'error': error} for message, error in zip(messages, errors)]
+        for i, result in zip(rows, outcomes):
+            if 'error' in result:
+                items[i] = dict(result, success=False)
+            else:
+                items[i] = dict(success=True, **serialize_chat_result(result))
+        
+        return jsonify({
+            'success': True,
+            'total': len(items),
+            'failed': sum(1 for item in items if not item['success']),
+            'results': items
+        })
+        
+    except Exception as e:
+        logger.error(f"Lỗi xử lý chat theo lô: {e}")
+        return jsonify({
+            'error': f'Lỗi xử lý: {str(e)}'
+        }), 500
+
 @app.route('/api/intent', methods=['POST'])
 def classify_intent():
     """API endpoint cho phân loại intent"""
@@ -174,22 +407,22 @@ def classify_intent():
                 'error': 'Message không được để trống'
             }), 400
         
-        # Kiểm tra RAG system
-        if rag_system is None:
+        # Phân loại intent chỉ cần IntentClassifier (sẵn sàng trước RAG system)
+        if intent_classifier is None:
             return jsonify({
-                'error': 'RAG system chưa sẵn sàng'
+                'error': 'Intent classifier chưa sẵn sàng'
             }), 503
         
         # Phân loại intent
         logger.info(f"Phân loại intent: {message}")
-        classification = rag_system.intent_classifier.classify_intent(message)
+        classification = intent_classifier.classify_intent(message)
         
         return jsonify({
             'success': True,
             'message': message,
             'intent': classification.get('intent', 'unknown'),
             'entities': classification.get('entities', {}),
-            'chunk_level': rag_system.intent_classifier.get_chunk_level_for_intent(classification.get('intent', ''))
+            'chunk_level': intent_classifier.get_chunk_level_for_intent(classification.get('intent', ''))
         })
         
     except Exception as e:
@@ -208,10 +441,7 @@ def system_info():
             }), 503
         
         # Thông tin vector database
-        vdb_info = {
-            'total_vectors': rag_system.vector_db.index.ntotal if rag_system.vector_db.index else 0,
-            'index_type': type(rag_system.vector_db.index).__name__ if rag_system.vector_db.index else None
-        }
+        vdb_info = rag_system.vector_db.index_info()
         
         # Thông tin chunks
         chunks_info = {
@@ -222,7 +452,8 @@ def system_info():
             'success': True,
             'vector_database': vdb_info,
             'chunks': chunks_info,
-            'model_name': 'paraphrase-multilingual-MiniLM-L12-v2'
+            'model_name': 'paraphrase-multilingual-MiniLM-L12-v2',
+            'query_encoder': rag_system.vector_db.encoder_info()
         })
         
     except Exception as e:
@@ -231,6 +462,26 @@ def system_info():
             'error': f'Lỗi lấy thông tin hệ thống: {str(e)}'
         }), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """API endpoint cho các chỉ số hoạt động (cache, ...)"""
+    try:
+        if rag_system is None:
+            return jsonify({
+                'error': 'RAG system chưa sẵn sàng'
+            }), 503
+        
+        return jsonify({
+            'success': True,
+            'metrics': rag_system.get_metrics()
+        })
+        
+    except Exception as e:
+        logger.error(f"Lỗi lấy metrics: {e}")
+        return jsonify({
+            'error': f'Lỗi lấy metrics: {str(e)}'
+        }), 500
+
 @app.route('/', methods=['GET'])
 def index():
     """Trang chủ với hướng dẫn API"""
@@ -240,9 +491,13 @@ def index():
         'endpoints': {
             'GET /health': 'Health check',
             'POST /api/chat': 'Chat với RAG system',
+            'POST /api/chat/stream': 'Chat với RAG system dạng streaming (server-sent events)',
+            'POST /api/chat/batch': 'Chat cho nhiều câu hỏi trong một request',
             'POST /api/search': 'Tìm kiếm semantic',
+            'POST /api/search/batch': 'Tìm kiếm semantic cho nhiều câu trong một request',
             'POST /api/intent': 'Phân loại intent',
-            'GET /api/system-info': 'Thông tin hệ thống'
+            'GET /api/system-info': 'Thông tin hệ thống',
+            'GET /api/metrics': 'Chỉ số hoạt động (cache, ...)'
         },
         'example_requests': {
             'chat': {
@@ -264,9 +519,7 @@ def index():
     })
 
 if __name__ == '__main__':
-    # Khởi tạo hệ thống RAG
-    if initialize_rag_system():
-        logger.info("Khởi động Flask API...")
-        app.run(host='0.0.0.0', port=5000, debug=False)
-    else:
-        logger.error("Không thể khởi động API do lỗi khởi tạo RAG system") 
\ No newline at end of file
+    # Chạy trực tiếp: khởi tạo hệ thống RAG trong nền để server nhận request (/health) ngay
+    create_app(background=True)
+    logger.info("Khởi động Flask API...")
+    app.run(host='0.0.0.0', port=int(os.getenv('PORT', '5000')), debug=False)
@@ -0,0 +1,124 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatchEncoder:
+    """
+    Gom các lời gọi encode đồng thời (mỗi request một vài câu) thành một lần encode của model.
+
+    Thread nền lấy yêu cầu đầu tiên trong hàng đợi, chờ thêm tối đa max_wait_ms để gom các yêu cầu
+    đến sau cho tới khi đủ max_batch_size câu, encode một lần rồi trả kết quả về cho từng người gọi.
+    Thread chỉ được tạo ở lần encode đầu tiên và được tạo lại trong process con sau khi fork
+    (gunicorn preload: thread của master không tồn tại trong worker).
+
+    Args:
+        encode_fn: Hàm encode danh sách câu thành ma trận (n, dim)
+        max_batch_size: Số câu tối đa trong một lần encode (một yêu cầu lớn hơn vẫn được encode riêng một lần)
+        max_wait_ms: Thời gian tối đa chờ gom thêm yêu cầu sau yêu cầu đầu tiên, 0 là chỉ gom các yêu cầu
+            đã xếp hàng sẵn (trong lúc lô trước đang encode)
+    """
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], max_batch_size: int = 32,
+                 max_wait_ms: float = 2.0):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._lock = threading.Lock()
+        self._queue: Optional[queue.Queue] = None
+        self._worker: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.batches = 0
+        self.requests = 0
+        self.texts = 0
+        self.max_batch = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+
+    def _ensure_worker(self) -> queue.Queue:
+        pid = os.getpid()
+        if self._pid == pid and self._worker is not None and self._worker.is_alive():
+            return self._queue
+        with self._lock:
+            if self._pid != pid or self._worker is None or not self._worker.is_alive():
+                if self._pid is not None and self._pid != pid:
+                    # Process con sau fork: hàng đợi và số liệu là của master
+                    self._reset_stats()
+                self._queue = queue.Queue()
+                self._pid = pid
+                self._worker = threading.Thread(target=self._run, args=(self._queue,),
+                                                name="micro-batch-encoder", daemon=True)
+                self._worker.start()
+        return self._queue
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts (chờ tới khi lô chứa yêu cầu này được encode xong)"""
+        future: Future = Future()
+        self._ensure_worker().put((list(texts), future, time.perf_counter()))
+        return future.result()
+
+    def _collect(self, pending: queue.Queue) -> List[Tuple[List[str], Future, float]]:
+        batch = [pending.get()]
+        size = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = pending.get(timeout=remaining) if remaining > 0 else pending.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self, pending: queue.Queue):
+        while True:
+            batch = self._collect(pending)
+            started = time.perf_counter()
+            # Các câu trùng nhau giữa các yêu cầu chỉ encode một lần
+            unique: Dict[str, int] = {}
+            for texts, _, _ in batch:
+                for text in texts:
+                    unique.setdefault(text, len(unique))
+            try:
+                embeddings = np.asarray(self.encode_fn(list(unique.keys())), dtype=np.float32)
+            except Exception as e:
+                logger.error(f"Lỗi encode lô {len(unique)} câu: {e}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.texts += len(unique)
+                self.max_batch = max(self.max_batch, len(unique))
+                for _, _, enqueued in batch:
+                    wait = started - enqueued
+                    self.total_wait += wait
+                    self.max_wait_seen = max(self.max_wait_seen, wait)
+            for texts, future, _ in batch:
+                future.set_result(embeddings[[unique[text] for text in texts]])
+
+    def stats(self) -> Dict[str, float]:
+        """Số lô, số yêu cầu, kích thước lô trung bình/lớn nhất và thời gian chờ trong hàng đợi (ms)"""
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'requests': self.requests,
+                'texts': self.texts,
+                'mean_batch_size': round(self.texts / self.batches, 2) if self.batches else 0.0,
+                'max_batch_size': self.max_batch,
+                'mean_queue_wait_ms': round(self.total_wait / self.requests * 1000, 3) if self.requests else 0.0,
+                'max_queue_wait_ms': round(self.max_wait_seen * 1000, 3)
+            }
@@ -0,0 +1,91 @@
+"""
+So sánh các backend encode câu truy vấn (query_encoders.py) với model fp32 trên corpus chunk:
+- Độ lệch: cosine giữa embedding của backend và embedding fp32 của cùng câu (trung bình, nhỏ nhất)
+- Top-k overlap: tỉ lệ kết quả top-k trên vector database trùng với kết quả khi encode bằng fp32
+- Latency encode 1 câu và một lô câu
+- Bộ nhớ RSS tăng thêm khi load backend (gồm cả import thư viện), đo trong một process riêng cho từng backend
+
+Chạy: python benchmark_encoders.py [--backends torch torch_int8 onnx onnx_int8] [--sample 200] [--k 5]
+"""
+import argparse
+import multiprocessing
+import time
+import numpy as np
+
+from local_intent_classifier import INTENT_EXEMPLARS
+from process_memory import memory_usage
+from query_encoders import ENCODER_BACKENDS, load_query_encoder
+from search_backends import normalize_vectors
+from vector_database import VectorDatabase, DEFAULT_MODEL_NAME
+
+
+def sample_queries(vdb: VectorDatabase, sample: int) -> list:
+    """Câu hỏi mẫu của các intent và một mẫu ngẫu nhiên nội dung chunk"""
+    queries = [text for texts in INTENT_EXEMPLARS.values() for text in texts]
+    rng = np.random.default_rng(0)
+    ids = rng.choice(len(vdb.chunks), min(sample, len(vdb.chunks)), replace=False)
+    return queries + [vdb.chunks[int(idx)]['content'] for idx in np.sort(ids)]
+
+
+def time_encode(encoder, texts: list, repeat: int) -> float:
+    """Thời gian trung bình mỗi lần encode (ms)"""
+    encoder.encode(texts)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encoder.encode(texts)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def load_memory_mb(name: str, model_name: str, local_files_only: bool) -> float:
+    """RSS tăng thêm (MB) khi load backend và encode một câu, chạy trong process con"""
+    rss_before = memory_usage().get('rss_mb', 0.0)
+    encoder = load_query_encoder(name, model_name, local_files_only)
+    encoder.encode(["Coca-Cola Original có bao nhiêu calo?"])
+    return memory_usage().get('rss_mb', 0.0) - rss_before
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Độ lệch, latency và bộ nhớ của các backend encode câu truy vấn")
+    parser.add_argument('--index', default="vector_db/coca_cola_index")
+    parser.add_argument('--model', default=DEFAULT_MODEL_NAME, help="Model fp32 đã dùng để embed chunk của index")
+    parser.add_argument('--backends', nargs='+', default=ENCODER_BACKENDS, choices=ENCODER_BACKENDS)
+    parser.add_argument('--sample', type=int, default=200, help="Số chunk lấy làm câu truy vấn mẫu")
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=30)
+    args = parser.parse_args()
+
+    vdb = VectorDatabase(model_name=args.model, query_cache_size=0)
+    vdb.load_index(args.index)
+    queries = sample_queries(vdb, args.sample)
+    batch = queries[:args.batch]
+
+    reference = None
+    print(f"{'backend':>11} {'load ms':>8} {'+RSS MB':>8} {'1 query ms':>11} {f'{args.batch} queries ms':>16} "
+          f"{'cos mean':>9} {'cos min':>8} {f'top-{args.k}':>7}")
+    for name in ["torch"] + [name for name in args.backends if name != "torch"]:
+        try:
+            encoder = load_query_encoder(name, vdb.model_name, vdb.local_files_only)
+        except (RuntimeError, ImportError) as e:
+            print(f"{name:>11} bỏ qua: {e}")
+            continue
+
+        embeddings = normalize_vectors(encoder.encode(queries))
+        _, indices = vdb.backend.search(embeddings, args.k)
+        if reference is None:
+            reference = (embeddings, indices)
+        cosine = np.sum(embeddings * reference[0], axis=1)
+        overlap = np.mean([len(set(row) & set(ref_row)) / args.k for row, ref_row in zip(indices, reference[1])])
+
+        if name not in args.backends:
+            continue
+        single_ms = time_encode(encoder, queries[:1], args.repeat)
+        batch_ms = time_encode(encoder, batch, max(1, args.repeat // 5))
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            rss_delta = pool.apply(load_memory_mb, (name, vdb.model_name, vdb.local_files_only))
+        print(f"{name:>11} {encoder.load_ms:>8.0f} {rss_delta:>8.1f} {single_ms:>11.2f} {batch_ms:>16.2f} "
+              f"{cosine.mean():>9.4f} {cosine.min():>8.4f} {overlap:>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
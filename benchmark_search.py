@@ -0,0 +1,75 @@
+"""
+Benchmark các backend tìm kiếm (search_backends.py) theo kích thước corpus để chọn ngưỡng
+NUMPY_MAX_VECTORS.
+
+Chạy: python benchmark_search.py --sizes 1000 10000 50000 200000 --dim 384 [--target-recall 0.95]
+"""
+import argparse
+import time
+import numpy as np
+
+from search_backends import build_backend, normalize_vectors, tune_search_params, BACKEND_NAMES
+
+
+def synthetic_vectors(rng: np.random.Generator, n: int, dim: int, clusters: int) -> np.ndarray:
+    """Vector giả lập: quanh các tâm cụm cố định (seed riêng để corpus và truy vấn dùng chung tâm)"""
+    if clusters <= 0:
+        return rng.standard_normal((n, dim), dtype=np.float32)
+    centers = np.random.default_rng(1).standard_normal((clusters, dim), dtype=np.float32)
+    labels = rng.integers(0, clusters, n)
+    return centers[labels] + 0.5 * rng.standard_normal((n, dim), dtype=np.float32)
+
+
+def time_search(backend, queries: np.ndarray, k: int, repeat: int) -> float:
+    """Thời gian trung bình mỗi lần search (ms)"""
+    backend.search(queries, k)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        backend.search(queries, k)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def recall_at_k(indices: np.ndarray, exact_indices: np.ndarray) -> float:
+    hits = sum(len(set(row) & set(exact_row)) for row, exact_row in zip(indices, exact_indices))
+    return hits / exact_indices.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark backend tìm kiếm")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000, 50000, 200000])
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--clusters', type=int, default=200,
+                        help="Số cụm chủ đề của dữ liệu giả lập (embedding thật có cấu trúc cụm), 0 là phân bố đều")
+    parser.add_argument('--backends', nargs='+', default=["numpy", "faiss_flat", "faiss_ivf", "faiss_hnsw"],
+                        choices=BACKEND_NAMES)
+    parser.add_argument('--target-recall', type=float, default=None,
+                        help="Tune tham số search của index xấp xỉ theo recall@k này trước khi đo")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'n':>8} {'backend':>12} {'build ms':>10} {'1 query ms':>11} {f'{args.batch} queries ms':>16} {'recall@k':>9}")
+    for n in args.sizes:
+        vectors = normalize_vectors(synthetic_vectors(rng, n, args.dim, args.clusters))
+        queries = normalize_vectors(synthetic_vectors(rng, args.batch, args.dim, args.clusters))
+        exact_indices = None
+        for name in args.backends:
+            start = time.perf_counter()
+            backend = build_backend(vectors, name)
+            build_ms = (time.perf_counter() - start) * 1000
+            params = ""
+            if args.target_recall is not None:
+                params = tune_search_params(backend, queries, k=args.k, target_recall=args.target_recall)['params']
+            single_ms = time_search(backend, queries[:1], args.k, args.repeat)
+            batch_ms = time_search(backend, queries, args.k, max(1, args.repeat // 5))
+            _, indices = backend.search(queries, args.k)
+            if exact_indices is None:
+                exact_indices = build_backend(vectors, "numpy").search(queries, args.k)[1]
+            recall = recall_at_k(indices, exact_indices)
+            print(f"{n:>8} {name:>12} {build_ms:>10.1f} {single_ms:>11.3f} {batch_ms:>16.3f} {recall:>9.3f} {params or ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: không khoá file giữa các process
+    fcntl = None
+
+
+def normalize_query(text: str) -> str:
+    """Chuẩn hoá câu truy vấn để làm khoá cache (Unicode NFC, chữ thường, gộp khoảng trắng)"""
+    text = unicodedata.normalize('NFC', text or '')
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+@contextmanager
+def _file_lock(filepath: str):
+    """Khoá độc quyền giữa các process (các worker gunicorn) qua file filepath.lock"""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{filepath}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_cache_file(filepath: str, version: str) -> list:
+    """Các phần tử [khoá, giá trị, thời điểm tạo] trong file cache, rỗng nếu không có, hỏng hoặc khác version"""
+    if not os.path.exists(filepath):
+        return []
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if not isinstance(data, dict) or data.get('version') != version:
+        return []
+    return data.get('entries', [])
+
+
+class TTLCache:
+    """
+    Cache LRU có giới hạn kích thước và thời gian sống (TTL), an toàn đa luồng.
+
+    Args:
+        max_size: Số phần tử tối đa, vượt quá sẽ loại phần tử ít dùng nhất
+        ttl: Thời gian sống của mỗi phần tử (giây), None hoặc 0 là không hết hạn
+        max_bytes: Tổng kích thước tối đa (byte, theo sizeof), vượt quá sẽ loại phần tử ít dùng nhất; None là không giới hạn
+        sizeof: Hàm ước lượng kích thước (byte) của một giá trị, cần khi có max_bytes
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 3600,
+                 max_bytes: Optional[int] = None, sizeof: Optional[Callable[[Any], int]] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return bool(self.ttl) and now - created_at > self.ttl
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def get_entry(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        """Như get nhưng trả về (giá trị, thời điểm tạo) để tính tuổi của phần tử, None nếu không có"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if self._is_expired(entry[1], time.time()):
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, time.time())
+            if size:
+                self._sizes[key] = size
+                self.bytes += size
+            self._evict()
+
+    def _remove(self, key: Hashable):
+        if self._data.pop(key, None) is not None:
+            self.bytes -= self._sizes.pop(key, 0)
+
+    def _evict(self):
+        while len(self._data) > self.max_size or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            key, _ = self._data.popitem(last=False)
+            self.bytes -= self._sizes.pop(key, 0)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and not self._is_expired(entry[1], time.time())
+
+    def save(self, filepath: str, version: str = "", merge: bool = False):
+        """
+        Lưu các phần tử còn hạn ra file JSON (ghi atomic), khoá và giá trị phải serialize được bằng JSON
+
+        Args:
+            filepath: Đường dẫn file cache
+            version: Khoá phiên bản, file có version khác sẽ bị bỏ qua khi load
+            merge: Gộp với các phần tử đang có trong file (cùng version) thay vì ghi đè, để nhiều process dùng
+                chung một file không xoá kết quả của nhau; cùng khoá thì giữ phần tử mới hơn, tối đa max_size
+                phần tử mới nhất
+        """
+        now = time.time()
+        with self._lock:
+            entries = [[key, value, created_at] for key, (value, created_at) in self._data.items()
+                       if not self._is_expired(created_at, now)]
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with _file_lock(filepath) if merge else nullcontext():
+            if merge:
+                merged = {}
+                for key, value, created_at in _read_cache_file(filepath, version) + entries:
+                    if self._is_expired(created_at, now):
+                        continue
+                    if key not in merged or created_at >= merged[key][2]:
+                        merged[key] = [key, value, created_at]
+                entries = sorted(merged.values(), key=lambda entry: entry[2])
+                entries = entries[-self.max_size:] if self.max_size > 0 else []
+            tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': version, 'entries': entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, filepath)
+
+    def load(self, filepath: str, version: str = "") -> int:
+        """
+        Load các phần tử từ file JSON đã lưu bằng save(), trả về số phần tử được load.
+        File không tồn tại, hỏng hoặc khác version thì không load gì.
+        """
+        now = time.time()
+        loaded = 0
+        entries = _read_cache_file(filepath, version)
+        with self._lock:
+            for key, value, created_at in entries:
+                if self._is_expired(created_at, now):
+                    continue
+                self._remove(key)
+                self._data[key] = (value, created_at)
+                if self.sizeof is not None:
+                    self._sizes[key] = self.sizeof(value)
+                    self.bytes += self._sizes[key]
+                loaded += 1
+            self._evict()
+        return loaded
+
+    def stats(self) -> Dict[str, Any]:
+        """Thống kê hit/miss của cache"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
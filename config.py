@@ -0,0 +1,28 @@
+import os
+import threading
+from typing import List
+
+_env_lock = threading.Lock()
+_env_loaded = False
+
+
+def load_environment():
+    """Đọc file .env một lần (không ghi đè biến môi trường đã có), gọi khi khởi động chứ không lúc import"""
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _env_lock:
+        if not _env_loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _env_loaded = True
+
+
+def gemini_api_keys() -> List[str]:
+    """Các Gemini API key theo thứ tự xoay vòng (key chưa cấu hình là None)"""
+    load_environment()
+    return [
+        os.getenv('GEMINI_API_KEY_1'),
+        os.getenv('GEMINI_API_KEY_2'),
+        os.getenv('GEMINI_API_KEY_3')
+    ]
@@ -0,0 +1,204 @@
+"""
+Ghép context cho prompt sinh câu trả lời trong giới hạn số token:
+- Bỏ các dòng trùng nhau giữa các chunk của cùng một sản phẩm (chunk cấp 1 và chunk tổng hợp cấp 2
+  lặp lại phần lớn các dòng dinh dưỡng, thành phần, kích cỡ); chunk chỉ còn dòng tiêu đề thì bỏ hẳn
+- Giữ thứ tự chunk theo score, chunk vượt ngân sách bị cắt theo dòng, chunk sau đó bị bỏ
+- Chế độ fair (so sánh sản phẩm): chia ngân sách đều cho các chunk, phần chunk ngắn không dùng hết chia lại cho chunk dài
+
+Số token là ước lượng (count_tokens) cho tokenizer subword của Gemini; số token từng dòng của chunk được
+tính sẵn lúc build index và lưu trong snapshot (xem snapshot.py).
+"""
+import re
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Đổi cách ước lượng thì đổi tên để số token đã lưu trong snapshot cũ không được dùng nữa
+TOKEN_ESTIMATOR = "regex-v1"
+
+CHUNK_SEPARATOR = "\n\n---\n\n"
+
+# Chữ số tách từng token; từ dài tách theo đoạn 6 ký tự; mỗi dấu câu một token
+_TOKEN_RE = re.compile(r"\d|[^\W\d_]+|[^\w\s]|_")
+_WORD_PIECE_CHARS = 6
+
+
+def count_tokens(text: str) -> int:
+    """Số token ước lượng của text"""
+    total = 0
+    for piece in _TOKEN_RE.findall(text or ''):
+        total += 1 + (len(piece) - 1) // _WORD_PIECE_CHARS
+    return total
+
+
+def line_token_counts(text: str) -> List[int]:
+    """Số token ước lượng của từng dòng (tách theo "\\n") trong nội dung một chunk"""
+    return [count_tokens(line) for line in text.split("\n")]
+
+
+def _line_key(line: str) -> str:
+    """Dạng chuẩn hoá để so trùng: bỏ gạch đầu dòng, khoảng trắng thừa và phân biệt hoa thường"""
+    return " ".join(line.strip().lstrip("-•*").split()).lower()
+
+
+class ContextPacker:
+    """
+    Args:
+        token_budget: Số token tối đa của context (ước lượng), None là không giới hạn
+        line_tokens: Hàm trả về số token từng dòng của chunk theo chỉ số trong vector database
+            (số đã tính sẵn lúc build index); chunk không có chỉ số thì tính trực tiếp
+    """
+
+    def __init__(self, token_budget: Optional[int] = 1000,
+                 line_tokens: Optional[Callable[[int], Sequence[int]]] = None):
+        self.token_budget = token_budget
+        self.line_tokens = line_tokens
+        self.separator_tokens = count_tokens(CHUNK_SEPARATOR)
+
+    def _chunk_lines(self, item: Dict[str, Any]):
+        content = item['chunk']['content']
+        lines = content.split("\n")
+        counts = None
+        if self.line_tokens is not None and item.get('index') is not None:
+            counts = [int(count) for count in self.line_tokens(item['index'])]
+        if counts is None or len(counts) != len(lines):
+            counts = line_token_counts(content)
+        return lines, counts
+
+    def pack(self, items: List[Dict[str, Any]], fair: bool = False) -> Dict[str, Any]:
+        """
+        Ghép nội dung các chunk thành context
+
+        Args:
+            items: Kết quả search ({'chunk': {'content', 'metadata'}, 'index', ...}) theo thứ tự ưu tiên (score giảm dần)
+            fair: Chia đều ngân sách cho từng chunk thay vì ưu tiên chunk đứng trước; phần ngân sách chunk ngắn
+                không dùng hết được chia lại cho các chunk dài (so sánh sản phẩm: sản phẩm nào cũng cần có mặt
+                trong context)
+
+        Returns:
+            {'context', 'tokens', 'budget', 'chunks', 'duplicate_lines', 'dropped_lines', 'items'}: dropped_lines là
+            số dòng bị cắt vì vượt ngân sách (không tính các chunk bị bỏ hẳn), items là các chunk có mặt trong context
+        """
+        pending, duplicate_lines = self._dedupe(items)
+        if fair and self.token_budget is not None:
+            packed, dropped_lines = self._pack_fair(pending)
+        else:
+            packed, dropped_lines = self._pack_in_order(pending)
+
+        blocks = ["\n".join(line for line, _ in kept) for _, kept in packed]
+        tokens = sum(count for _, kept in packed for _, count in kept)
+        tokens += self.separator_tokens * max(0, len(packed) - 1)
+        return {
+            'context': CHUNK_SEPARATOR.join(blocks),
+            'tokens': tokens,
+            'budget': self.token_budget,
+            'chunks': len(packed),
+            'duplicate_lines': duplicate_lines,
+            'dropped_lines': dropped_lines,
+            'items': [item for item, _ in packed]
+        }
+
+    def _dedupe(self, items: List[Dict[str, Any]]) -> Tuple[List[Tuple[Dict[str, Any], List[Tuple[str, int]]]], int]:
+        """Các dòng (nội dung, số token) còn lại của từng chunk sau khi bỏ dòng trùng, và số dòng trùng đã bỏ"""
+        seen = set()
+        pending = []
+        duplicate_lines = 0
+        for position, item in enumerate(items):
+            lines, counts = self._chunk_lines(item)
+            # Chunk không có tên sản phẩm (tổng quan theo nhóm) chỉ bỏ dòng trùng trong chính nó
+            scope = item['chunk'].get('metadata', {}).get('product_name') or f"#{position}"
+            kept = []
+            for line_no, (line, count) in enumerate(zip(lines, counts)):
+                key = _line_key(line)
+                if line_no > 0 and not key:
+                    continue
+                if line_no > 0 and (scope, key) in seen:
+                    duplicate_lines += 1
+                    continue
+                seen.add((scope, key))
+                # Dòng liệt kê dạng "Thành phần: A, B, C" của chunk tổng hợp: từng mục cũng tính là đã có,
+                # để các dòng "- A", "- B" của chunk chi tiết bị bỏ
+                _, colon, listed = key.partition(": ")
+                if colon and "," in listed:
+                    seen.update((scope, part.strip()) for part in listed.split(","))
+                kept.append((line, count))
+            # Chỉ còn dòng tiêu đề thì nội dung đã có trong chunk trước
+            if len(lines) > 1 and len(kept) <= 1:
+                continue
+            pending.append((item, kept))
+        return pending, duplicate_lines
+
+    def _pack_in_order(self, pending):
+        """Lấy lần lượt từng chunk tới khi hết ngân sách, chunk cuối bị cắt theo dòng"""
+        packed = []
+        tokens = 0
+        dropped_lines = 0
+        for item, kept in pending:
+            separator = self.separator_tokens if packed else 0
+            kept_tokens = sum(count for _, count in kept)
+            if self.token_budget is not None and tokens + separator + kept_tokens > self.token_budget:
+                fitted = self._truncate(kept, self.token_budget - tokens - separator)
+                if len(fitted) < min(2, len(kept)):
+                    # Không đủ chỗ cho dòng nội dung nào của chunk
+                    dropped_lines += len(kept)
+                    break
+                dropped_lines += len(kept) - len(fitted)
+                kept = fitted
+                kept_tokens = sum(count for _, count in kept)
+            packed.append((item, kept))
+            tokens += separator + kept_tokens
+        return packed, dropped_lines
+
+    def _pack_fair(self, pending):
+        """
+        Chia ngân sách kiểu water-filling: mỗi chunk một phần bằng nhau, chunk ngắn hơn phần của nó chỉ lấy
+        đúng số token cần, phần thừa chia đều cho các chunk còn lại; token còn dư sau khi cắt theo dòng được
+        dùng để giữ thêm dòng cho các chunk bị cắt (theo thứ tự ưu tiên)
+        """
+        candidates = list(range(len(pending)))
+        dropped_lines = 0
+        while True:
+            available = self.token_budget - self.separator_tokens * max(0, len(candidates) - 1)
+            demands = {i: sum(count for _, count in pending[i][1]) for i in candidates}
+            shares = _water_fill(demands, max(0, available))
+            fitted = {i: self._truncate(pending[i][1], shares[i]) for i in candidates}
+            failed = [i for i in candidates if len(fitted[i]) < min(2, len(pending[i][1]))]
+            if not failed:
+                break
+            # Bỏ chunk ít ưu tiên nhất không đủ chỗ rồi chia lại ngân sách cho các chunk còn lại
+            candidates.remove(failed[-1])
+            dropped_lines += len(pending[failed[-1]][1])
+
+        leftover = available - sum(count for i in candidates for _, count in fitted[i])
+        for i in candidates:
+            kept = pending[i][1]
+            while len(fitted[i]) < len(kept) and kept[len(fitted[i])][1] <= leftover:
+                leftover -= kept[len(fitted[i])][1]
+                fitted[i] = kept[:len(fitted[i]) + 1]
+            dropped_lines += len(kept) - len(fitted[i])
+        return [(pending[i][0], fitted[i]) for i in candidates], dropped_lines
+
+    @staticmethod
+    def _truncate(lines: List[Tuple[str, int]], limit: int) -> List[Tuple[str, int]]:
+        """Các dòng đầu vừa trong limit token"""
+        kept, total = [], 0
+        for line, count in lines:
+            if total + count > limit:
+                break
+            kept.append((line, count))
+            total += count
+        return kept
+
+
+def _water_fill(demands: Dict[int, int], total: int) -> Dict[int, int]:
+    """Chia total cho các phần tử theo nhu cầu: không phần tử nào nhận quá nhu cầu, phần còn lại chia đều"""
+    shares = {}
+    remaining = dict(demands)
+    while remaining:
+        share = total // len(remaining)
+        satisfied = [i for i, demand in remaining.items() if demand <= share]
+        if not satisfied:
+            shares.update((i, share) for i in remaining)
+            break
+        for i in satisfied:
+            shares[i] = remaining.pop(i)
+            total -= shares[i]
+    return shares
@@ -7,7 +7,7 @@ import os
 import sys
 import logging
 from rag_system import RAGSystem
-from vector_database import create_vector_database
+from vector_database import create_vector_database, index_exists
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,10 +23,10 @@ def setup_system():
         return False
     
     # Kiểm tra vector database
-    if not os.path.exists("vector_db/coca_cola_index.index"):
+    if not index_exists("vector_db/coca_cola_index"):
         print("Tạo vector database...")
         try:
-            create_vector_database(index_type="IndexFlatL2")
+            create_vector_database()
             print("Đã tạo xong vector database!")
         except Exception as e:
             print(f"Lỗi tạo vector database: {e}")
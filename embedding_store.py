@@ -0,0 +1,109 @@
+import hashlib
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+
+def content_key(model_name: str, content: str) -> str:
+    """Khoá của một embedding: sha256(tên model + nội dung), đổi model hoặc sửa nội dung đều ra khoá mới"""
+    return hashlib.sha256(f"{model_name}\x00{content}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Kho embedding trên đĩa theo hash nội dung, để khi rebuild vector database chỉ encode lại
+    các chunk mới hoặc đã sửa.
+
+    Lưu trong một file .npz gồm ma trận float32 "vectors" và mảng "keys" (khoá theo thứ tự dòng).
+
+    Args:
+        path: File lưu kho
+        model_name: Tên model embedding, là một phần của khoá
+    """
+
+    def __init__(self, path: str = "cache/embeddings.npz", model_name: str = ""):
+        self.path = path
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._rows: Dict[str, int] = {}
+        self._vectors: Optional[np.ndarray] = None
+        self._pending: Dict[str, np.ndarray] = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self) -> int:
+        """Load kho từ đĩa, trả về số embedding. Kho không tồn tại hoặc hỏng thì bắt đầu rỗng."""
+        self._rows = {}
+        self._vectors = None
+        if not os.path.exists(self.path):
+            return 0
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                keys = [str(key) for key in data['keys']]
+                vectors = data['vectors']
+        except (OSError, ValueError, KeyError):
+            return 0
+        if len(keys) != len(vectors):
+            return 0
+        self._rows = {key: row for row, key in enumerate(keys)}
+        self._vectors = vectors
+        return len(keys)
+
+    def __len__(self) -> int:
+        return len(self._rows) + len(self._pending)
+
+    def key(self, content: str) -> str:
+        return content_key(self.model_name, content)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            row = self._rows.get(key)
+            return None if row is None else self._vectors[row]
+
+    def put(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._pending[key] = np.asarray(vector, dtype=np.float32)
+
+    def lookup(self, contents: List[str]) -> Tuple[List[Optional[np.ndarray]], List[int]]:
+        """Embedding đã có của từng nội dung (None nếu chưa có) và vị trí các nội dung cần encode"""
+        found = [self.get(self.key(content)) for content in contents]
+        missing = [i for i, vector in enumerate(found) if vector is None]
+        self.hits += len(contents) - len(missing)
+        self.misses += len(missing)
+        return found, missing
+
+    def save(self, keep: Optional[Iterable[str]] = None):
+        """
+        Ghi kho ra đĩa (atomic)
+
+        Args:
+            keep: Nếu có, chỉ giữ các khoá này (bỏ embedding của các chunk không còn trong corpus)
+        """
+        with self._lock:
+            entries = {key: self._vectors[row] for key, row in self._rows.items()}
+            entries.update(self._pending)
+            if keep is not None:
+                keep = set(keep)
+                entries = {key: vector for key, vector in entries.items() if key in keep}
+            keys = list(entries.keys())
+            dimension = next(iter(entries.values())).shape[0] if entries else 0
+            vectors = np.stack([entries[key] for key in keys]) if keys else np.zeros((0, dimension), dtype=np.float32)
+
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, keys=np.asarray(keys, dtype=str), vectors=vectors.astype(np.float32))
+            os.replace(tmp_path, self.path)
+
+            self._rows = {key: row for row, key in enumerate(keys)}
+            self._vectors = vectors
+            self._pending = {}
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,41 @@
+"""
+Cấu hình gunicorn: gunicorn -c gunicorn.conf.py "app:create_app()"
+
+preload_app khởi tạo RAG system (model embedding, vector database, dữ liệu sản phẩm) và warm-up
+một lần trong process master; các worker fork ra dùng chung các trang bộ nhớ đó (copy-on-write).
+"""
+import gc
+import os
+import logging
+
+from process_memory import memory_usage
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = 'gthread'
+# Request /api/chat chờ Gemini, stream có thể kéo dài
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+preload_app = True
+
+logger = logging.getLogger('gunicorn.error')
+
+
+def _format_memory(usage):
+    return ", ".join(f"{name}={value}" for name, value in usage.items()) or "không đọc được /proc"
+
+
+def when_ready(server):
+    # Đưa các object đã tạo lúc khởi tạo vào thế hệ permanent của GC: GC của worker không duyệt
+    # (và không ghi refcount/cờ GC) lên chúng nên các trang bộ nhớ chung không bị copy
+    gc.collect()
+    gc.freeze()
+    logger.info(f"Master sẵn sàng, bộ nhớ: {_format_memory(memory_usage())}")
+
+
+def post_fork(server, worker):
+    logger.info(f"Worker {worker.pid} vừa fork, bộ nhớ: {_format_memory(memory_usage())}")
+
+
+def post_worker_init(worker):
+    logger.info(f"Worker {worker.pid} sẵn sàng nhận request, bộ nhớ: {_format_memory(memory_usage())}")
@@ -0,0 +1,124 @@
+import os
+import threading
+import logging
+from typing import Dict, Any, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class PooledHTTPClient:
+    """
+    HTTP client dùng chung cho các lời gọi LLM: giữ kết nối keep-alive trong connection pool
+    để các request tới cùng host không phải bắt tay TCP+TLS lại.
+
+    Mỗi thread có Session riêng nhưng tất cả dùng chung một HTTPAdapter (và connection pool của nó),
+    nên client an toàn khi gọi từ nhiều thread.
+
+    Args:
+        pool_size: Số kết nối tối đa được giữ lại cho mỗi host
+        connect_timeout: Timeout khi mở kết nối (giây)
+        read_timeout: Timeout khi chờ dữ liệu trả về (giây)
+    """
+
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 5.0, read_timeout: float = 30.0):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._requests_sent = 0
+        self._errors = 0
+        self._init_adapter()
+
+    def _init_adapter(self):
+        # Retry do tầng gọi (xoay vòng API key) quyết định, adapter không tự retry
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+        self._pid = os.getpid()
+        self._local = threading.local()
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        return (self.connect_timeout, self.read_timeout)
+
+    def _session(self) -> requests.Session:
+        with self._lock:
+            # Sau khi fork (gunicorn preload), không dùng lại các kết nối mở ở process cha
+            if self._pid != os.getpid():
+                self._init_adapter()
+            session = getattr(self._local, 'session', None)
+            if session is None:
+                session = requests.Session()
+                session.mount('https://', self._adapter)
+                session.mount('http://', self._adapter)
+                self._local.session = session
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        session = self._session()
+        with self._lock:
+            self._requests_sent += 1
+        try:
+            return session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self._errors += 1
+            raise
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """Số request, số kết nối đã mở và số lần dùng lại kết nối của connection pool"""
+        with self._lock:
+            stats = {
+                'pool_size': self.pool_size,
+                'connect_timeout': self.connect_timeout,
+                'read_timeout': self.read_timeout,
+                'requests': self._requests_sent,
+                'errors': self._errors,
+                'connections_opened': 0,
+                'connections_reused': 0
+            }
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['connections_opened'] += pool.num_connections
+            stats['connections_reused'] += max(pool.num_requests - pool.num_connections, 0)
+        total = stats['connections_opened'] + stats['connections_reused']
+        stats['reuse_rate'] = stats['connections_reused'] / total if total else 0.0
+        return stats
+
+
+_client: Optional[PooledHTTPClient] = None
+_client_lock = threading.Lock()
+
+
+def get_http_client() -> PooledHTTPClient:
+    """
+    Client dùng chung cho mọi lời gọi LLM. Cấu hình qua biến môi trường
+    LLM_HTTP_POOL_SIZE, LLM_HTTP_CONNECT_TIMEOUT, LLM_HTTP_READ_TIMEOUT.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PooledHTTPClient(
+                    pool_size=int(os.getenv('LLM_HTTP_POOL_SIZE', '10')),
+                    connect_timeout=float(os.getenv('LLM_HTTP_CONNECT_TIMEOUT', '5')),
+                    read_timeout=float(os.getenv('LLM_HTTP_READ_TIMEOUT', '30'))
+                )
+    return _client
+
+
+def configure_http_client(pool_size: int = 10, connect_timeout: float = 5.0, read_timeout: float = 30.0) -> PooledHTTPClient:
+    """Thay client dùng chung bằng client với cấu hình mới"""
+    global _client
+    with _client_lock:
+        _client = PooledHTTPClient(pool_size=pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout)
+    return _client
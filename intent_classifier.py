@@ -1,42 +1,27 @@
-import os
+import atexit
 import json
+import copy
+import hashlib
+import re
+import threading
 import requests
-from typing import Dict, List, Any
-from dotenv import load_dotenv
+from typing import Dict, List, Any, Optional, Tuple
 import logging
-
-load_dotenv()
+from cache import TTLCache, normalize_query
+from context_packer import count_tokens
+from http_client import get_http_client
+from config import gemini_api_keys
 
 logger = logging.getLogger(__name__)
 
-class IntentClassifier:
-    def __init__(self):
-        self.api_keys = [
-            os.getenv('GEMINI_API_KEY_1'),
-            os.getenv('GEMINI_API_KEY_2'), 
-            os.getenv('GEMINI_API_KEY_3')
-        ]
-        self.current_key_index = 0
-        self.base_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
-        
-    def get_next_api_key(self) -> str:
-        key = self.api_keys[self.current_key_index]
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-        return key
-    
-    def classify_intent(self, user_question: str) -> Dict[str, Any]:
-        system_prompt = """Bạn là một trợ lý phân tích truy vấn chuyên nghiệp cho chatbot của một công ty nước giải khát.
-Nhiệm vụ của bạn là đọc câu hỏi của người dùng và phân loại ý định (intent) của họ, đồng thời trích xuất các thực thể quan trọng như tên sản phẩm.
-
-Các intent có thể có là:
-- get_ingredients: Hỏi về thành phần sản phẩm
+INTENT_DESCRIPTIONS = """- get_ingredients: Hỏi về thành phần sản phẩm
 - get_nutrition_facts: Hỏi về thông tin dinh dưỡng chung
 - get_calories: Hỏi cụ thể về lượng calo
 - get_sugar_content: Hỏi cụ thể về lượng đường
 - check_caffeine: Hỏi về sự tồn tại của caffeine
 - get_available_sizes: Hỏi về các kích cỡ/dung tích
 - get_product_summary: Yêu cầu thông tin chung về sản phẩm
-- compare_two_products: So sánh hai sản phẩm cụ thể
+- compare_two_products: So sánh hai hoặc nhiều sản phẩm cụ thể
 - product_inquiry: Câu hỏi mở về một sản phẩm
 - list_by_product_type: Liệt kê sản phẩm theo loại
 - list_by_brand: Liệt kê sản phẩm theo thương hiệu
@@ -45,11 +30,21 @@ Các intent có thể có là:
 - explain_category: Yêu cầu giải thích về một loại
 - find_min_attribute: Tìm sản phẩm có giá trị thuộc tính nhỏ nhất (ít nhất, thấp nhất)
 - find_max_attribute: Tìm sản phẩm có giá trị thuộc tính lớn nhất (nhiều nhất, cao nhất)
-- greeting: Chào hỏi, trò chuyện thông thường
+- find_top_k_attribute: Tìm nhiều sản phẩm có giá trị thuộc tính nhỏ nhất/lớn nhất (ví dụ "5 loại ít calo nhất")
+- filter_by_attribute_range: Tìm các sản phẩm có giá trị thuộc tính trong một khoảng (dưới, trên, từ ... đến ...)
+- greeting: Chào hỏi, trò chuyện thông thường"""
+
+INTENT_PROMPT = """Bạn là một trợ lý phân tích truy vấn chuyên nghiệp cho chatbot của một công ty nước giải khát.
+Nhiệm vụ của bạn là đọc câu hỏi của người dùng và phân loại ý định (intent) của họ, đồng thời trích xuất các thực thể quan trọng như tên sản phẩm.
+
+Các intent có thể có là:
+""" + INTENT_DESCRIPTIONS + """
 
 QUY TẮC QUAN TRỌNG:
 - Nếu câu hỏi có từ "ít nhất", "thấp nhất", "nhỏ nhất", hãy dùng intent "find_min_attribute".
 - Nếu câu hỏi có từ "nhiều nhất", "cao nhất", "lớn nhất", hãy dùng intent "find_max_attribute".
+- Nếu câu hỏi hỏi nhiều sản phẩm đứng đầu (ví dụ "5 loại", "top 3"), hãy dùng intent "find_top_k_attribute" với "k" là số sản phẩm và "order" là "asc" (ít/thấp nhất) hoặc "desc" (nhiều/cao nhất).
+- Nếu câu hỏi có ngưỡng giá trị ("dưới", "trên", "từ ... đến ..."), hãy dùng intent "filter_by_attribute_range" với "min_value"/"max_value" là số.
 - Nếu người dùng hỏi về một thương hiệu (Coca-Cola, Fanta, Sprite), hãy dùng intent "list_by_brand".
 - Khi trích xuất "product_names", hãy cố gắng trả về tên đầy đủ và chính xác nhất có thể, ví dụ "Coke Zero" nên là "Coca-Cola Zero Sugar".
 
@@ -123,66 +118,427 @@ JSON:
   }
 }
 
+Ví dụ 8:
+Người dùng: "5 loại nước ít calo nhất"
+JSON:
+{
+  "intent": "find_top_k_attribute",
+  "entities": {
+    "attribute": "ít calo nhất",
+    "k": 5,
+    "order": "asc"
+  }
+}
+
+Ví dụ 9:
+Người dùng: "Những đồ uống dưới 50 calo"
+JSON:
+{
+  "intent": "filter_by_attribute_range",
+  "entities": {
+    "attribute": "calo",
+    "max_value": 50
+  }
+}
+
 Bây giờ, hãy phân tích câu hỏi dưới đây.
 
 Người dùng: {user_question}"""
 
+# Tên các intent, lấy từ INTENT_DESCRIPTIONS
+INTENT_NAMES = [line[2:].split(':', 1)[0].strip() for line in INTENT_DESCRIPTIONS.splitlines() if line.startswith('- ')]
+
+# Giá trị product_type trong dữ liệu sản phẩm
+PRODUCT_TYPES = [
+    "Nước ngọt có ga", "Nước trái cây", "Nước tăng lực / Thức uống thể thao",
+    "Nước lọc / nước tinh khiết", "Cà phê / Sữa / Đồ uống đặc biệt", "Trà"
+]
+
+# Prompt ngắn cho chế độ structured: không có ví dụ few-shot, định dạng JSON do responseSchema ràng buộc
+COMPACT_INTENT_PROMPT = """Phân loại intent và trích xuất entities của câu hỏi gửi chatbot nước giải khát Coca-Cola.
+
+Intent:
+""" + INTENT_DESCRIPTIONS + """
+
+Quy tắc:
+- "ít/thấp/nhỏ nhất": find_min_attribute; "nhiều/cao/lớn nhất": find_max_attribute; nhiều sản phẩm đứng đầu ("5 loại", "top 3"): find_top_k_attribute với k và order ("asc": ít nhất, "desc": nhiều nhất).
+- Có ngưỡng ("dưới", "trên", "từ ... đến ..."): filter_by_attribute_range với min_value/max_value là số.
+- Hỏi về thương hiệu (Coca-Cola, Fanta, Sprite): list_by_brand với brand_name.
+- attribute giữ nguyên cụm từ trong câu hỏi (ví dụ "ít calo nhất", "không đường").
+- product_names là tên đầy đủ, ví dụ "Coke Zero" là "Coca-Cola Zero Sugar", "Fanta Cam" là "Fanta Orange".
+- Chỉ điền entities có trong câu hỏi.
+
+Câu hỏi: {user_question}"""
+
+# responseSchema của Gemini cho chế độ structured (OpenAPI schema rút gọn)
+INTENT_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "intent": {"type": "STRING", "enum": INTENT_NAMES},
+        "entities": {
+            "type": "OBJECT",
+            "properties": {
+                "product_names": {"type": "ARRAY", "items": {"type": "STRING"}},
+                "attribute": {"type": "STRING"},
+                "brand_name": {"type": "STRING"},
+                "product_type": {"type": "STRING", "enum": PRODUCT_TYPES},
+                "k": {"type": "INTEGER"},
+                "order": {"type": "STRING", "enum": ["asc", "desc"]},
+                "min_value": {"type": "NUMBER"},
+                "max_value": {"type": "NUMBER"}
+            }
+        }
+    },
+    "required": ["intent", "entities"]
+}
+
+# "few_shot": prompt đầy đủ với các ví dụ, đọc JSON từ text; "structured": prompt ngắn + responseSchema
+INTENT_PROMPT_MODES = ["few_shot", "structured"]
+
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_UNQUOTED_KEY_RE = re.compile(r'([{,]\s*)([A-Za-z_][A-Za-z0-9_]*)\s*:')
+_PYTHON_LITERAL_RE = re.compile(r'\b(None|True|False)\b')
+_PYTHON_LITERALS = {'None': 'null', 'True': 'true', 'False': 'false'}
+# Key cuối object bị cắt cụt (chưa có giá trị): '..., "key":' hoặc '..., "ke'
+_DANGLING_KEY_RE = re.compile(r'(?:,|(?<=\{))\s*"[^"]*"\s*:?\s*$')
+
+
+def _balance_json(text: str) -> str:
+    """
+    Cắt text (bắt đầu bằng '{') tại chỗ object đầu tiên đóng lại; nếu bị cắt cụt giữa chừng thì đóng chuỗi
+    đang mở, bỏ key còn thiếu giá trị và đóng các ngoặc còn thiếu
+    """
+    closers = []
+    in_string = escaped = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+        elif char in '}]' and closers:
+            closers.pop()
+            if not closers:
+                return text[:i + 1]
+    if in_string:
+        text += '"'
+    text = text.rstrip().rstrip(',')
+    if closers and closers[-1] == '}':
+        text = _DANGLING_KEY_RE.sub('', text)
+    return text + ''.join(reversed(closers))
+
+
+def parse_json_object(content: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """
+    Đọc object JSON trong text trả về của LLM, sửa cục bộ các lỗi hay gặp thay vì gọi lại API:
+    code fence, text thừa trước/sau object, object bị cắt cụt, dấu phẩy thừa, nháy đơn, key không có nháy,
+    None/True/False kiểu Python
+
+    Returns:
+        (object hoặc None, có phải sửa hay không)
+    """
+    start_idx = content.find('{')
+    if start_idx == -1:
+        return None, False
+    text = content[start_idx:]
+    end_idx = text.rfind('}') + 1
+    try:
+        parsed = json.loads(text[:end_idx]) if end_idx else None
+        if isinstance(parsed, dict):
+            return parsed, False
+    except ValueError:
+        pass
+
+    text = _balance_json(text.replace('“', '"').replace('”', '"'))
+    fixes = [
+        lambda t: _TRAILING_COMMA_RE.sub(r'\1', t),
+        lambda t: t.replace("'", '"') if '"' not in t else t,
+        lambda t: _UNQUOTED_KEY_RE.sub(r'\1"\2":', t),
+        lambda t: _PYTHON_LITERAL_RE.sub(lambda m: _PYTHON_LITERALS[m.group(1)], t)
+    ]
+    # Áp dụng lần lượt từng cách sửa (cách sau có thể làm hỏng nội dung chuỗi nên chỉ dùng khi cần)
+    for fix in [lambda t: t] + fixes:
+        text = fix(text)
+        try:
+            parsed = json.loads(text)
+        except ValueError:
+            continue
+        return (parsed, True) if isinstance(parsed, dict) else (None, False)
+    return None, False
+
+
+def extract_json_object(content: str) -> Optional[Dict[str, Any]]:
+    """Trích xuất object JSON đầu tiên trong text trả về của LLM (có sửa lỗi cục bộ, xem parse_json_object)"""
+    return parse_json_object(content)[0]
+
+
+def intent_prompt_version(prompt_mode: str = "few_shot", fused_prompt: Optional[str] = None) -> str:
+    """
+    Khoá phiên bản của cache intent, gồm chế độ prompt và mã băm nội dung các prompt sinh ra kết quả được cache:
+    sửa prompt/ví dụ few-shot, đổi chế độ hoặc bật/sửa prompt của pipeline fused sẽ làm cache cũ mất hiệu lực
+    """
+    if prompt_mode == "few_shot":
+        content = INTENT_PROMPT
+    else:
+        content = COMPACT_INTENT_PROMPT + json.dumps(INTENT_RESPONSE_SCHEMA, ensure_ascii=False, sort_keys=True)
+    mode = prompt_mode
+    if fused_prompt is not None:
+        content += fused_prompt
+        mode += "+fused"
+    return f"{mode}:{hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]}"
+
+
+INTENT_PROMPT_VERSION = intent_prompt_version()
+
+class IntentClassifier:
+    def __init__(self, cache_size: int = 2048, cache_ttl: Optional[float] = 7 * 24 * 3600,
+                 cache_path: Optional[str] = "cache/intent_cache.json", prompt_mode: str = "few_shot",
+                 fused_prompt: Optional[str] = None, save_interval: float = 5.0):
+        """
+        Args:
+            cache_size: Số kết quả phân loại tối đa được cache (0 để tắt cache)
+            cache_ttl: Thời gian sống của kết quả trong cache (giây), None là không hết hạn
+            cache_path: File lưu cache xuống đĩa để dùng lại sau khi khởi động lại, None để không lưu
+            prompt_mode: "few_shot" (prompt đầy đủ có ví dụ) hoặc "structured" (prompt ngắn, Gemini trả JSON
+                theo INTENT_RESPONSE_SCHEMA), xem INTENT_PROMPT_MODES
+            fused_prompt: Prompt của pipeline fused nếu kết quả của nó cũng được lưu vào cache (tính vào phiên bản cache)
+            save_interval: Gom các lần ghi cache xuống đĩa trong khoảng này (giây), 0 là ghi ngay sau mỗi kết quả mới
+        """
+        if prompt_mode not in INTENT_PROMPT_MODES:
+            raise ValueError(f"prompt_mode không hợp lệ: {prompt_mode} (chọn một trong {INTENT_PROMPT_MODES})")
+        self.prompt_mode = prompt_mode
+        self.prompt_version = intent_prompt_version(prompt_mode, fused_prompt)
+        self.api_keys = gemini_api_keys()
+        self.current_key_index = 0
+        self.base_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+        
+        # Cache kết quả intent/entities theo câu hỏi đã chuẩn hoá
+        self.cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self.cache_path = cache_path
+        self._cache_save_lock = threading.Lock()
+        self.save_interval = save_interval
+        self._save_timer: Optional[threading.Timer] = None
+        self._atexit_registered = False
+        if cache_path:
+            loaded = self.cache.load(cache_path, version=self.prompt_version)
+            if loaded:
+                logger.info(f"Đã load {loaded} kết quả intent từ cache {cache_path}")
+        
+        # Bộ phân loại cục bộ (LocalIntentClassifier), nếu đủ tự tin thì không cần gọi Gemini
+        self.local_classifier = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'total': 0, 'cache_hits': 0, 'fast_path': 0, 'remote': 0, 'fused': 0}
+        # Chi phí các lần gọi Gemini để phân loại: số token prompt, số lần thử lại, số lần không đọc được JSON
+        self._call_stats = {'calls': 0, 'prompt_tokens': 0, 'retries': 0, 'max_retries': 0,
+                            'parse_failures': 0, 'repaired': 0}
+        
+    def get_next_api_key(self) -> str:
+        key = self.api_keys[self.current_key_index]
+        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
+        return key
+    
+    def classify_intent(self, user_question: str) -> Dict[str, Any]:
+        result = self.lookup(user_question)
+        if result is not None:
+            return result
+        return self.classify_remote(user_question)
+    
+    def classify_remote(self, user_question: str, call_info: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Phân loại bằng Gemini (bỏ qua cache và fast path cục bộ) rồi lưu kết quả vào cache
+
+        Args:
+            call_info: Nếu có, được điền chi phí của lần gọi: 'prompt_tokens', 'retries',
+                'parse' ('ok', 'repaired' hoặc 'failed')
+        """
+        self.record('remote')
+        result = self._classify_with_gemini(user_question, call_info)
+        self.remember(user_question, result)
+        return result
+    
+    def lookup(self, user_question: str) -> Optional[Dict[str, Any]]:
+        """
+        Phân loại intent chỉ bằng các nguồn cục bộ (cache, fast path), không gọi Gemini.
+        Trả về None nếu không có kết quả đủ tin cậy.
+        """
+        cached = self.cache.get(normalize_query(user_question))
+        if cached is not None:
+            self.record('cache_hits')
+            return copy.deepcopy(cached)
+        
+        if self.local_classifier is not None:
+            try:
+                local_result = self.local_classifier.classify(user_question)
+            except Exception as e:
+                logger.error(f"Lỗi phân loại intent cục bộ: {e}")
+                local_result = None
+            if local_result is not None:
+                self.record('fast_path')
+                return local_result
+        return None
+    
+    def remember(self, user_question: str, result: Dict[str, Any]):
+        """Lưu kết quả phân loại (từ Gemini hoặc pipeline fused) vào cache"""
+        # Không cache kết quả lỗi để lần sau còn thử lại
+        if result.get('intent', 'unknown') == 'unknown':
+            return
+        self.cache.put(normalize_query(user_question), copy.deepcopy(result))
+        self._schedule_save()
+    
+    def record(self, source: str):
+        """Ghi nhận nguồn phân loại của một câu hỏi ('cache_hits', 'fast_path', 'remote', 'fused')"""
+        with self._stats_lock:
+            self._stats['total'] += 1
+            self._stats[source] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Số câu hỏi theo nguồn phân loại (cache, fast path cục bộ, Gemini) và tỉ lệ đi fast path"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        total = stats['total']
+        stats['fast_path_rate'] = stats['fast_path'] / total if total else 0.0
+        stats['remote_rate'] = stats['remote'] / total if total else 0.0
+        with self._stats_lock:
+            calls = dict(self._call_stats)
+        count = calls['calls']
+        calls['mean_prompt_tokens'] = calls['prompt_tokens'] / count if count else 0.0
+        calls['mean_retries'] = calls['retries'] / count if count else 0.0
+        calls['parse_failure_rate'] = calls['parse_failures'] / count if count else 0.0
+        stats['prompt_mode'] = self.prompt_mode
+        stats['remote_calls'] = calls
+        return stats
+    
+    def record_call(self, prompt_tokens: int, retries: int, parse: str):
+        """Ghi nhận chi phí một lần phân loại bằng Gemini (parse: 'ok', 'repaired' hoặc 'failed')"""
+        with self._stats_lock:
+            self._call_stats['calls'] += 1
+            self._call_stats['prompt_tokens'] += prompt_tokens
+            self._call_stats['retries'] += retries
+            self._call_stats['max_retries'] = max(self._call_stats['max_retries'], retries)
+            if parse == 'failed':
+                self._call_stats['parse_failures'] += 1
+            elif parse == 'repaired':
+                self._call_stats['repaired'] += 1
+    
+    def _schedule_save(self):
+        """Hẹn ghi cache xuống đĩa sau save_interval giây, các kết quả mới trong khoảng đó được ghi một lần"""
+        if not self.cache_path:
+            return
+        if self.save_interval <= 0:
+            self._save_cache()
+            return
+        with self._cache_save_lock:
+            if self._save_timer is not None:
+                return
+            if not self._atexit_registered:
+                # Ghi nốt các kết quả đang chờ khi process kết thúc
+                atexit.register(self.flush_cache)
+                self._atexit_registered = True
+            self._save_timer = threading.Timer(self.save_interval, self._save_cache)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+    
+    def flush_cache(self):
+        """Ghi ngay các kết quả đang chờ ghi xuống đĩa"""
+        with self._cache_save_lock:
+            timer = self._save_timer
+        if timer is not None:
+            timer.cancel()
+            self._save_cache()
+    
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        with self._cache_save_lock:
+            self._save_timer = None
+            try:
+                # Gộp với file trên đĩa: các worker gunicorn dùng chung file, không ghi đè kết quả của nhau
+                self.cache.save(self.cache_path, version=self.prompt_version, merge=True)
+            except OSError as e:
+                logger.error(f"Không lưu được cache intent vào {self.cache_path}: {e}")
+    
+    def _build_payload(self, user_question: str) -> Dict[str, Any]:
         # Escape dấu { và } trong user_question để tránh lỗi format
         safe_user_question = user_question.replace('{', '{{').replace('}', '}}')
-        payload = {
+        generation_config = {
+            "temperature": 0.1,
+            "topK": 1,
+            "topP": 1,
+            "maxOutputTokens": 1000
+        }
+        if self.prompt_mode == "structured":
+            prompt = COMPACT_INTENT_PROMPT
+            # Gemini chỉ sinh JSON đúng schema (intent thuộc enum), không cần ví dụ định dạng trong prompt
+            generation_config["responseMimeType"] = "application/json"
+            generation_config["responseSchema"] = INTENT_RESPONSE_SCHEMA
+            generation_config["maxOutputTokens"] = 256
+        else:
+            prompt = INTENT_PROMPT
+        return {
             "contents": [
                 {
                     "parts": [
                         {
-                            "text": system_prompt.replace("{user_question}", safe_user_question)
+                            "text": prompt.replace("{user_question}", safe_user_question)
                         }
                     ]
                 }
             ],
-            "generationConfig": {
-                "temperature": 0.1,
-                "topK": 1,
-                "topP": 1,
-                "maxOutputTokens": 1000
-            }
+            "generationConfig": generation_config
         }
+    
+    def _classify_with_gemini(self, user_question: str, call_info: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        payload = self._build_payload(user_question)
+        # Ước lượng cục bộ, thay bằng usageMetadata.promptTokenCount của Gemini khi có
+        prompt_tokens = count_tokens(payload["contents"][0]["parts"][0]["text"])
         
         headers = {
             "Content-Type": "application/json"
         }
         
+        parsed = None
+        parse = 'failed'
+        attempts = 0
         for attempt in range(len(self.api_keys)):
+            attempts += 1
             try:
                 api_key = self.get_next_api_key()
                 url = f"{self.base_url}?key={api_key}"
                 
-                response = requests.post(url, headers=headers, json=payload, timeout=30)
+                response = get_http_client().post(url, headers=headers, json=payload)
                 response.raise_for_status()
                 
                 result = response.json()
+                prompt_tokens = result.get('usageMetadata', {}).get('promptTokenCount', prompt_tokens)
                 if 'candidates' in result and len(result['candidates']) > 0:
                     content = result['candidates'][0]['content']['parts'][0]['text']
                     
-                    # Trích xuất JSON từ response
-                    try:
-                        start_idx = content.find('{')
-                        end_idx = content.rfind('}') + 1
-                        if start_idx != -1 and end_idx > start_idx:
-                            json_str = content[start_idx:end_idx]
-                            try:
-                                return json.loads(json_str)
-                            except Exception as e:
-                                logger.error(f"Lỗi parse JSON: {e}\nContent trả về: {content}")
-                                continue
-                        else:
-                            logger.error(f"Không tìm thấy JSON trong response. Content: {content}")
-                            continue
-                    except Exception as e:
-                        logger.error(f"Lỗi khi xử lý response từ Gemini: {e}\nContent: {content}")
-                        continue
-            except requests.exceptions.RequestException as e:
+                    # Trích xuất JSON từ response, sửa cục bộ nếu gần đúng; không đọc được thì không gọi lại
+                    # (gọi lại với cùng prompt thường cho kết quả tương tự mà tốn thêm một lượt round trip)
+                    parsed, repaired = parse_json_object(content)
+                    if parsed is not None and isinstance(parsed.get('intent'), str):
+                        if not isinstance(parsed.get('entities'), dict):
+                            parsed['entities'] = {}
+                        parse = 'repaired' if repaired else 'ok'
+                    else:
+                        parsed = None
+                        logger.error(f"Không parse được JSON từ response. Content: {content}")
+                    break
+            except (requests.exceptions.RequestException, ValueError, KeyError, IndexError) as e:
                 logger.error(f"Lỗi API call với key {attempt + 1}: {e}")
                 continue
+        
+        self.record_call(prompt_tokens, max(0, attempts - 1), parse)
+        if call_info is not None:
+            call_info.update({'prompt_tokens': prompt_tokens, 'retries': max(0, attempts - 1), 'parse': parse})
+        if parsed is not None:
+            return parsed
         # Fallback nếu tất cả API keys đều lỗi hoặc không parse được JSON
         logger.error(f"Không phân tích được intent cho câu hỏi: {user_question}")
         return {
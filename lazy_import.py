@@ -0,0 +1,33 @@
+import importlib
+import threading
+from types import ModuleType
+
+
+class LazyModule(ModuleType):
+    """
+    Module chỉ được import thật khi truy cập thuộc tính đầu tiên, để các thư viện nặng
+    (faiss, sentence_transformers/torch) không làm chậm lúc import và các endpoint không cần tới chúng
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._lazy_lock = threading.Lock()
+        self._lazy_module = None
+
+    def _load(self) -> ModuleType:
+        if self._lazy_module is None:
+            with self._lazy_lock:
+                if self._lazy_module is None:
+                    self._lazy_module = importlib.import_module(self.__name__)
+        return self._lazy_module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._lazy_module is not None
+
+
+def lazy_module(name: str) -> LazyModule:
+    return LazyModule(name)
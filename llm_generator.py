@@ -1,48 +1,51 @@
-import os
 import json
 import requests
-from typing import Dict, Any
-from dotenv import load_dotenv
+from typing import Dict, Any, Optional, Iterator
 import logging
-
-load_dotenv()
+from http_client import get_http_client
+from config import gemini_api_keys
 
 logger = logging.getLogger(__name__)
 
-# Bạn có thể tái sử dụng logic API key từ IntentClassifier nếu muốn
-# Ở đây chúng ta tạo một bản sao đơn giản
-API_KEYS = [
-    os.getenv('GEMINI_API_KEY_1'),
-    os.getenv('GEMINI_API_KEY_2'), 
-    os.getenv('GEMINI_API_KEY_3')
-]
 CURRENT_KEY_INDEX = 0
 BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:streamGenerateContent"
+LLM_ERROR_RESPONSE = "[Lỗi khi gọi LLM để sinh câu trả lời hoặc hết quota các key]"
+
+
+class LLMStreamError(Exception):
+    """
+    Stream của Gemini không trả lời xong: bị ngắt sau khi đã trả về một phần câu trả lời (không thể thử lại
+    với key khác), hoặc mọi API key đều lỗi trước khi có đoạn text nào
+    """
 
 def get_next_api_key() -> str:
     global CURRENT_KEY_INDEX
-    key = API_KEYS[CURRENT_KEY_INDEX]
-    CURRENT_KEY_INDEX = (CURRENT_KEY_INDEX + 1) % len(API_KEYS)
+    api_keys = gemini_api_keys()
+    key = api_keys[CURRENT_KEY_INDEX % len(api_keys)]
+    CURRENT_KEY_INDEX = (CURRENT_KEY_INDEX + 1) % len(api_keys)
     return key
 
-def generate_with_llm(prompt: str) -> str:
+def generate_with_llm(prompt: str, generation_config: Optional[Dict[str, Any]] = None) -> str:
     """
     Gọi Gemini API (hoặc LLM khác) để sinh câu trả lời từ prompt.
     Trả về chuỗi text là câu trả lời.
+
+    Args:
+        prompt: Prompt gửi cho LLM
+        generation_config: generationConfig của Gemini (ví dụ {"responseMimeType": "application/json"})
     """
-    api_keys = [
-        os.getenv('GEMINI_API_KEY_1'),
-        os.getenv('GEMINI_API_KEY_2'),
-        os.getenv('GEMINI_API_KEY_3')
-    ]
+    api_keys = gemini_api_keys()
     url_base = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key="
     payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    if generation_config:
+        payload["generationConfig"] = generation_config
     for idx, api_key in enumerate(api_keys):
         if not api_key:
             continue
         url = url_base + api_key
         try:
-            response = requests.post(url, json=payload, timeout=30)
+            response = get_http_client().post(url, json=payload)
             response.raise_for_status()
             data = response.json()
             if 'candidates' in data and data['candidates']:
@@ -60,4 +63,53 @@ def generate_with_llm(prompt: str) -> str:
         except Exception as e:
             logging.error(f"[llm_generator] Lỗi gọi Gemini API sinh câu trả lời: {e}")
             continue
-    return "[Lỗi khi gọi LLM để sinh câu trả lời hoặc hết quota các key]"
\ No newline at end of file
+    return LLM_ERROR_RESPONSE
+
+def stream_with_llm(prompt: str, generation_config: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """
+    Gọi Gemini streamGenerateContent (server-sent events) và trả về lần lượt từng đoạn text ngay khi nhận được.
+    Chỉ thử key tiếp theo nếu lỗi xảy ra trước khi có đoạn text nào được trả về.
+
+    Raises:
+        LLMStreamError: Stream lỗi hoặc kết thúc mà không có finishReason sau khi đã trả về một phần câu trả lời,
+            hoặc tất cả API key đều lỗi (thông báo là LLM_ERROR_RESPONSE)
+    """
+    api_keys = gemini_api_keys()
+    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    if generation_config:
+        payload["generationConfig"] = generation_config
+    for idx, api_key in enumerate(api_keys):
+        if not api_key:
+            continue
+        url = f"{STREAM_URL}?alt=sse&key={api_key}"
+        yielded = False
+        finished = False
+        try:
+            with get_http_client().post(url, json=payload, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    data = json.loads(line[len('data:'):].strip())
+                    for candidate in data.get('candidates', [])[:1]:
+                        for part in candidate.get('content', {}).get('parts', []):
+                            text = part.get('text')
+                            if text:
+                                yielded = True
+                                yield text
+                        if candidate.get('finishReason'):
+                            finished = True
+            if yielded and finished:
+                return
+            if yielded:
+                raise LLMStreamError("Gemini stream kết thúc trước khi trả lời xong (không có finishReason)")
+            logging.error(f"[llm_generator] Gemini stream không trả về nội dung với API key {idx+1}")
+        except LLMStreamError:
+            raise
+        except requests.exceptions.HTTPError as e:
+            logging.error(f"[llm_generator] Lỗi API call stream với key {idx+1}: {e}")
+        except Exception as e:
+            logging.error(f"[llm_generator] Lỗi stream Gemini API: {e}")
+            if yielded:
+                raise LLMStreamError(f"Gemini stream bị ngắt giữa chừng: {e}") from e
+    raise LLMStreamError(LLM_ERROR_RESPONSE)
\ No newline at end of file
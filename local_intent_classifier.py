@@ -0,0 +1,262 @@
+import logging
+from typing import Dict, List, Any, Optional, Iterable
+import numpy as np
+
+from cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# Câu hỏi mẫu có gán nhãn cho các intent của IntentClassifier
+INTENT_EXEMPLARS: Dict[str, List[str]] = {
+    "get_ingredients": [
+        "Thành phần của Coca-Cola Original là gì?",
+        "Fanta Cam được làm từ những gì?",
+        "Sprite có những thành phần nào?",
+        "Trong Coke Zero có chứa gì?",
+        "Cho tôi biết nguyên liệu của Minute Maid",
+        "Danh sách thành phần của Dasani",
+        "What are the ingredients of Coca-Cola?",
+    ],
+    "get_nutrition_facts": [
+        "Thông tin dinh dưỡng của Sprite",
+        "Giá trị dinh dưỡng của Coca-Cola Original",
+        "Bảng thành phần dinh dưỡng của Fanta",
+        "Coke Zero có những chất dinh dưỡng gì?",
+        "Hàm lượng natri, chất béo của Powerade là bao nhiêu?",
+        "Nutrition facts of Sprite",
+    ],
+    "get_calories": [
+        "Coca-Cola Original có bao nhiêu calo?",
+        "Lượng calo của Fanta Cam",
+        "Một chai Sprite chứa bao nhiêu calories?",
+        "Coke Zero có calo không?",
+        "Uống Minute Maid thì nạp bao nhiêu năng lượng?",
+        "How many calories in Coca-Cola?",
+    ],
+    "get_sugar_content": [
+        "Coca-Cola Original có bao nhiêu đường?",
+        "Lượng đường trong Fanta Cam",
+        "Sprite chứa bao nhiêu gam đường?",
+        "Hàm lượng đường của Minute Maid là bao nhiêu?",
+        "Coke Zero có đường không?",
+        "How much sugar is in Sprite?",
+    ],
+    "check_caffeine": [
+        "Coca-Cola Original có caffeine không?",
+        "Sprite có chứa cafein không?",
+        "Fanta có caffeine không?",
+        "Trong Coke Zero có cà phê in không?",
+        "Uống Diet Coke có bị mất ngủ vì caffeine không?",
+        "Does Coca-Cola contain caffeine?",
+    ],
+    "get_available_sizes": [
+        "Các kích cỡ có sẵn của Coca-Cola Original",
+        "Sprite có những dung tích nào?",
+        "Fanta Cam có chai 2 lít không?",
+        "Coke Zero bán những loại chai lon nào?",
+        "Dasani có bao nhiêu cỡ chai?",
+        "What sizes does Coca-Cola come in?",
+    ],
+    "get_product_summary": [
+        "Giới thiệu về Coca-Cola Original",
+        "Cho tôi thông tin tổng quan về Sprite",
+        "Tóm tắt thông tin sản phẩm Fanta Cam",
+        "Coke Zero là sản phẩm như thế nào?",
+        "Mô tả sản phẩm Minute Maid",
+        "Tell me about Coca-Cola Zero Sugar",
+    ],
+    "compare_two_products": [
+        "So sánh Coca-Cola Original và Coke Zero",
+        "Sprite và Fanta khác nhau thế nào?",
+        "Coca-Cola hay Pepsi tốt hơn?",
+        "So sánh lượng calo của Coke và Diet Coke",
+        "Điểm khác biệt giữa Fanta Cam và Fanta Nho",
+        "Compare Sprite and Sprite Zero",
+        "So sánh Coca-Cola, Sprite và Fanta",
+    ],
+    "product_inquiry": [
+        "Coca-Cola Original có tốt cho sức khỏe không?",
+        "Người ăn kiêng có uống được Coke Zero không?",
+        "Trẻ em uống Fanta được không?",
+        "Sprite có phù hợp để uống khi tập thể dục không?",
+        "Phụ nữ mang thai uống Coca-Cola có sao không?",
+        "Minute Maid có nên uống hàng ngày không?",
+    ],
+    "list_by_product_type": [
+        "tôi cần nước thể thao",
+        "Liệt kê các loại nước trái cây",
+        "Có những loại trà nào?",
+        "Các sản phẩm nước ngọt có ga",
+        "Cho tôi danh sách nước tăng lực",
+        "Có những loại nước lọc nào?",
+    ],
+    "list_by_brand": [
+        "Danh sách các sản phẩm Coca-Cola",
+        "Fanta có những hương vị nào?",
+        "Liệt kê các sản phẩm Sprite",
+        "Thương hiệu Minute Maid có những sản phẩm gì?",
+        "Các sản phẩm của Powerade",
+        "List all Fanta products",
+    ],
+    "list_by_attribute": [
+        "Liệt kê các sản phẩm không đường",
+        "Những sản phẩm nào không có caffeine?",
+        "Các loại nước không calo",
+        "Sản phẩm nào dành cho người ăn kiêng?",
+        "Danh sách đồ uống ít đường",
+        "Which drinks are sugar free?",
+    ],
+    "list_by_country": [
+        "Các sản phẩm được bán tại Việt Nam",
+        "Liệt kê sản phẩm ở Mỹ",
+        "Ở Nhật Bản có những sản phẩm nào?",
+        "Sản phẩm Coca-Cola tại Mexico",
+        "Danh sách đồ uống của thị trường Nam Phi",
+        "Products available in the US",
+    ],
+    "explain_category": [
+        "Nước tăng lực là gì?",
+        "Thức uống thể thao khác nước ngọt thế nào?",
+        "Giải thích về nước ngọt có ga",
+        "Đồ uống không đường là gì?",
+        "Nước trái cây nguyên chất nghĩa là gì?",
+        "What is a sports drink?",
+    ],
+    "find_min_attribute": [
+        "Sản phẩm nào ít calo nhất?",
+        "Nước nào có lượng đường thấp nhất?",
+        "Đồ uống nào ít natri nhất?",
+        "Loại nào có calo nhỏ nhất?",
+        "Sản phẩm nào ít đường nhất?",
+        "Which drink has the fewest calories?",
+    ],
+    "find_max_attribute": [
+        "Nước nào nhiều đường nhất?",
+        "Sản phẩm nào có nhiều calo nhất?",
+        "Đồ uống nào có lượng natri cao nhất?",
+        "Loại nào có calo lớn nhất?",
+        "Sản phẩm nào chứa nhiều đường nhất?",
+        "Which drink has the most sugar?",
+    ],
+    "find_top_k_attribute": [
+        "5 loại nước ít calo nhất",
+        "Top 3 sản phẩm nhiều đường nhất",
+        "Liệt kê 10 đồ uống có natri thấp nhất",
+        "Cho tôi 5 sản phẩm ít đường nhất",
+        "3 loại nước có nhiều calo nhất là gì?",
+        "Top 5 lowest calorie drinks",
+    ],
+    "filter_by_attribute_range": [
+        "Những đồ uống dưới 50 calo",
+        "Sản phẩm nào có ít hơn 10g đường?",
+        "Các loại nước trên 100 calo",
+        "Đồ uống có từ 20 đến 40 gam đường",
+        "Nước nào có natri không quá 30mg?",
+        "Drinks under 50 calories",
+    ],
+    "greeting": [
+        "Chào bạn",
+        "Xin chào",
+        "Hello",
+        "Hi",
+        "Chào buổi sáng",
+        "Bạn là ai?",
+        "Cảm ơn bạn",
+        "Tạm biệt",
+    ],
+}
+
+# Các intent có thể trả lời mà không cần Gemini trích xuất entities.
+# Các intent liệt kê/so sánh/cực trị cần entities để định tuyến nên luôn gọi Gemini.
+DEFAULT_FAST_PATH_INTENTS = [
+    "greeting", "get_ingredients", "get_nutrition_facts", "get_calories",
+    "get_sugar_content", "check_caffeine", "get_available_sizes",
+    "get_product_summary", "product_inquiry", "explain_category"
+]
+
+# Các intent hỏi về sản phẩm cụ thể: product_names được trích xuất cục bộ bằng ProductNameResolver,
+# câu hỏi không nhắc tới tên sản phẩm nào trong dữ liệu thì để Gemini trích xuất
+PRODUCT_ENTITY_INTENTS = [
+    "get_ingredients", "get_nutrition_facts", "get_calories", "get_sugar_content",
+    "check_caffeine", "get_available_sizes", "get_product_summary", "product_inquiry"
+]
+
+
+class LocalIntentClassifier:
+    def __init__(self, vector_db, exemplars: Optional[Dict[str, List[str]]] = None,
+                 min_score: float = 0.7, margin: float = 0.1, top_k: int = 1,
+                 fast_path_intents: Optional[Iterable[str]] = None, product_resolver=None):
+        """
+        Phân loại intent cục bộ bằng láng giềng gần nhất trên embedding của các câu hỏi mẫu
+
+        Args:
+            vector_db: VectorDatabase có model embedding đã load (dùng chung model và cache embedding câu truy vấn)
+            exemplars: Câu hỏi mẫu theo intent, mặc định INTENT_EXEMPLARS
+            min_score: Độ tương đồng cosine tối thiểu của intent tốt nhất
+            margin: Khoảng cách tối thiểu giữa điểm của intent tốt nhất và intent thứ hai
+            top_k: Số láng giềng gần nhất của mỗi intent dùng để tính điểm trung bình (1 là láng giềng gần nhất)
+            fast_path_intents: Các intent được phép trả về mà không gọi Gemini
+            product_resolver: ProductNameResolver để lấy product_names từ câu hỏi cho PRODUCT_ENTITY_INTENTS;
+                None thì các intent này luôn gọi Gemini
+        """
+        self.vector_db = vector_db
+        self.product_resolver = product_resolver
+        self.min_score = min_score
+        self.margin = margin
+        self.top_k = top_k
+        self.fast_path_intents = set(fast_path_intents if fast_path_intents is not None
+                                     else DEFAULT_FAST_PATH_INTENTS)
+
+        exemplars = exemplars or INTENT_EXEMPLARS
+        self.intents = list(exemplars.keys())
+        texts = []
+        labels = []
+        for label, intent in enumerate(self.intents):
+            for text in exemplars[intent]:
+                texts.append(normalize_query(text))
+                labels.append(label)
+
+        # Embed bộ câu mẫu một lần khi khởi động, cùng backend encode với câu truy vấn
+        embeddings = np.asarray(vector_db.query_encoder.encode(texts), dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.embeddings = embeddings / np.maximum(norms, 1e-12)
+        self.labels = np.asarray(labels)
+        logger.info(f"Đã embed {len(texts)} câu mẫu cho {len(self.intents)} intent")
+
+    def score(self, user_question: str) -> Dict[str, float]:
+        """Điểm của từng intent: trung bình top_k độ tương đồng cosine với các câu mẫu của intent đó"""
+        query_embedding = self.vector_db.encode_query(user_question)[0]
+        similarities = self.embeddings @ query_embedding
+        scores = {}
+        for label, intent in enumerate(self.intents):
+            intent_sims = np.sort(similarities[self.labels == label])[::-1][:self.top_k]
+            scores[intent] = float(intent_sims.mean())
+        return scores
+
+    def classify(self, user_question: str) -> Optional[Dict[str, Any]]:
+        """
+        Trả về {"intent", "entities"} nếu đủ tự tin và intent nằm trong fast_path_intents (với intent hỏi về
+        sản phẩm cụ thể thì câu hỏi phải nhắc tới tên sản phẩm, entities có product_names),
+        ngược lại trả về None để người gọi dùng Gemini
+        """
+        scores = self.score(user_question)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        best_intent, best_score = ranked[0]
+        second_score = ranked[1][1] if len(ranked) > 1 else 0.0
+        if best_intent not in self.fast_path_intents:
+            return None
+        if best_score < self.min_score or best_score - second_score < self.margin:
+            return None
+        entities = {}
+        if best_intent in PRODUCT_ENTITY_INTENTS:
+            # Không có product_names thì mất lọc/ưu tiên theo sản phẩm khi search và câu trả lời theo mẫu
+            if self.product_resolver is None:
+                return None
+            mentions = self.product_resolver.find_mentions(user_question)
+            if not mentions:
+                return None
+            entities["product_names"] = [self.product_resolver.product_names[idx] for idx in mentions]
+        return {
+            "intent": best_intent,
+            "entities": entities
+        }
@@ -0,0 +1,193 @@
+import math
+import re
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
+
+# Các cột dinh dưỡng và đơn vị chuẩn hoá của từng cột
+NUTRIENT_UNITS = {
+    'calories': 'kcal',
+    'total_sugars': 'g',
+    'total_fat': 'g',
+    'total_carbohydrate': 'g',
+    'protein': 'g',
+    'sodium': 'mg'
+}
+
+# Hệ số đổi từ đơn vị trong dữ liệu sang đơn vị chuẩn của cột
+UNIT_FACTORS = {
+    'g': {'g': 1.0, 'mg': 1e-3, 'mcg': 1e-6},
+    'mg': {'mg': 1.0, 'g': 1e3, 'mcg': 1e-3},
+    'kcal': {'kcal': 1.0, 'cal': 1.0}
+}
+
+# Từ khoá trong câu hỏi -> cột dinh dưỡng (từ khoá dài đứng trước để khớp chính xác hơn)
+ATTRIBUTE_KEYWORDS = [
+    ('carbohydrate', 'total_carbohydrate'),
+    ('tinh bột', 'total_carbohydrate'),
+    ('chất béo', 'total_fat'),
+    ('calories', 'calories'),
+    ('calorie', 'calories'),
+    ('protein', 'protein'),
+    ('sodium', 'sodium'),
+    ('sugar', 'total_sugars'),
+    ('đường', 'total_sugars'),
+    ('natri', 'sodium'),
+    ('muối', 'sodium'),
+    ('carb', 'total_carbohydrate'),
+    ('béo', 'total_fat'),
+    ('fat', 'total_fat'),
+    ('đạm', 'protein'),
+    ('calo', 'calories'),
+    ('kcal', 'calories')
+]
+
+# Tên hiển thị tiếng Việt của từng cột
+ATTRIBUTE_LABELS = {
+    'calories': 'calo',
+    'total_sugars': 'đường',
+    'total_fat': 'chất béo',
+    'total_carbohydrate': 'carbohydrate',
+    'protein': 'protein',
+    'sodium': 'natri'
+}
+
+_QUANTITY_RE = re.compile(r'(-?\d+(?:[.,]\d+)?)\s*(kcal|mcg|µg|mg|g|cal|%)?', re.IGNORECASE)
+
+
+def parse_quantity(value: Any, target_unit: Optional[str] = None) -> float:
+    """
+    Trích xuất số từ giá trị dinh dưỡng ("65g", "75mg", "≤ 23 mg", 240, ...) và đổi sang target_unit.
+    Trả về NaN nếu không có dữ liệu hoặc đơn vị không đổi được (ví dụ giá trị phần trăm).
+    Giá trị có dấu "<", "≤" được lấy theo cận trên.
+    """
+    if value is None or isinstance(value, bool):
+        return math.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _QUANTITY_RE.search(str(value))
+    if not match:
+        return math.nan
+    number = float(match.group(1).replace(',', '.'))
+    unit = (match.group(2) or '').lower().replace('µg', 'mcg')
+    if unit == '%':
+        return math.nan
+    if not unit or target_unit is None:
+        return number
+    factor = UNIT_FACTORS.get(target_unit, {}).get(unit)
+    if factor is None:
+        return math.nan
+    return number * factor
+
+
+def resolve_attribute(text: str) -> Optional[str]:
+    """Tìm cột dinh dưỡng được nhắc tới trong text (ví dụ "ít calo nhất" -> "calories")"""
+    text = (text or '').lower()
+    for keyword, key in ATTRIBUTE_KEYWORDS:
+        if keyword in text:
+            return key
+    return None
+
+
+def parse_range(text: str) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Trích xuất khoảng giá trị từ text tiếng Việt, ví dụ "dưới 50 calo" -> (None, 50),
+    "trên 100 mg natri" -> (100, None), "từ 10 đến 20g đường" -> (10, 20)
+    """
+    text = (text or '').lower()
+    numbers = [float(n.replace(',', '.')) for n in re.findall(r'\d+(?:[.,]\d+)?', text)]
+    if not numbers:
+        return None, None
+    if len(numbers) >= 2 and re.search(r'từ|giữa|between|-|đến|tới', text):
+        return min(numbers[:2]), max(numbers[:2])
+    if re.search(r'dưới|ít hơn|nhỏ hơn|thấp hơn|không quá|tối đa|<|≤|under|less than|below', text):
+        return None, numbers[0]
+    if re.search(r'trên|nhiều hơn|lớn hơn|cao hơn|ít nhất|tối thiểu|>|≥|over|more than|above', text):
+        return numbers[0], None
+    return None, numbers[0]
+
+
+def format_quantity(value: float, unit: str) -> str:
+    return f"{value:g} {unit}"
+
+
+def nutrient_raw_value(product: Dict, key: str) -> Any:
+    """Giá trị gốc của một chất dinh dưỡng trong dữ liệu sản phẩm (có thể là số hoặc dict {"value": ...})"""
+    raw = (product.get('nutrition_facts') or {}).get(key)
+    if isinstance(raw, dict):
+        return raw.get('value')
+    return raw
+
+
+class NutritionTable:
+    def __init__(self, products: List[Dict], columns: Optional[Dict[str, str]] = None):
+        """
+        Bảng dinh dưỡng dạng cột: parse một lần các giá trị dinh dưỡng của toàn bộ sản phẩm
+        thành mảng NumPy float64 theo đơn vị chuẩn, giá trị thiếu là NaN
+
+        Args:
+            products: Danh sách sản phẩm gốc (final_product_data.json)
+            columns: Cột cần parse và đơn vị chuẩn, mặc định NUTRIENT_UNITS
+        """
+        self.products = products
+        self.units = dict(columns or NUTRIENT_UNITS)
+        self.columns: Dict[str, np.ndarray] = {}
+        for key, unit in self.units.items():
+            self.columns[key] = np.array(
+                [parse_quantity(nutrient_raw_value(p, key), unit) for p in products],
+                dtype=np.float64
+            )
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def column(self, key: str) -> np.ndarray:
+        if key not in self.columns:
+            raise KeyError(f"Không có cột dinh dưỡng: {key}")
+        return self.columns[key]
+
+    def valid_mask(self, key: str) -> np.ndarray:
+        return ~np.isnan(self.column(key))
+
+    def value(self, idx: int, key: str) -> float:
+        return float(self.column(key)[idx])
+
+    def argmin(self, key: str) -> Optional[int]:
+        """Chỉ số sản phẩm có giá trị nhỏ nhất (bỏ qua giá trị thiếu), None nếu cột không có dữ liệu"""
+        col = self.column(key)
+        if not np.any(~np.isnan(col)):
+            return None
+        return int(np.nanargmin(col))
+
+    def argmax(self, key: str) -> Optional[int]:
+        """Chỉ số sản phẩm có giá trị lớn nhất (bỏ qua giá trị thiếu), None nếu cột không có dữ liệu"""
+        col = self.column(key)
+        if not np.any(~np.isnan(col)):
+            return None
+        return int(np.nanargmax(col))
+
+    def top_k(self, key: str, k: int, ascending: bool = True) -> List[int]:
+        """k sản phẩm có giá trị nhỏ nhất (ascending) hoặc lớn nhất, đã sắp xếp"""
+        col = self.column(key)
+        valid = np.flatnonzero(~np.isnan(col))
+        if k <= 0 or valid.size == 0:
+            return []
+        values = col[valid] if ascending else -col[valid]
+        k = min(k, valid.size)
+        # Lấy ngưỡng giá trị thứ k bằng partition (O(n)), rồi chỉ sắp xếp các ứng viên không vượt ngưỡng;
+        # sort ổn định nên các giá trị bằng nhau giữ thứ tự sản phẩm, kết quả xác định
+        kth_value = np.partition(values, k - 1)[k - 1]
+        candidates = np.flatnonzero(values <= kth_value)
+        order = candidates[np.argsort(values[candidates], kind='stable')][:k]
+        return [int(i) for i in valid[order]]
+
+    def in_range(self, key: str, min_value: Optional[float] = None, max_value: Optional[float] = None) -> List[int]:
+        """Các sản phẩm có giá trị trong [min_value, max_value] (cận None là không giới hạn), sắp xếp tăng dần"""
+        col = self.column(key)
+        mask = ~np.isnan(col)
+        if min_value is not None:
+            mask &= col >= min_value
+        if max_value is not None:
+            mask &= col <= max_value
+        matched = np.flatnonzero(mask)
+        order = np.argsort(col[matched], kind='stable')
+        return [int(i) for i in matched[order]]
@@ -0,0 +1,29 @@
+import os
+from typing import Dict
+
+
+def memory_usage(pid: int = None) -> Dict[str, float]:
+    """
+    Bộ nhớ của process (MB) đọc từ /proc (Linux):
+    rss là tổng bộ nhớ thường trú, shared là phần dùng chung với process khác (ví dụ trang copy-on-write
+    từ gunicorn master hoặc file memory-mapped), private là phần riêng của process.
+    Trả về dict rỗng nếu hệ điều hành không có /proc.
+    """
+    path = f"/proc/{pid or os.getpid()}/smaps_rollup"
+    fields = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 3 and parts[0].endswith(':') and parts[2] == 'kB':
+                    fields[parts[0][:-1]] = int(parts[1])
+    except OSError:
+        return {}
+    shared = fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0)
+    private = fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    return {
+        'rss_mb': round(fields.get('Rss', 0) / 1024, 1),
+        'shared_mb': round(shared / 1024, 1),
+        'private_mb': round(private / 1024, 1),
+        'pss_mb': round(fields.get('Pss', 0) / 1024, 1)
+    }
@@ -0,0 +1,145 @@
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, List, Optional, Iterable, Set, Tuple
+
+# Tên gọi tắt/tên tiếng Việt -> tên sản phẩm trong dữ liệu
+PRODUCT_ALIASES = {
+    "coke": "Coca-Cola Original",
+    "coca": "Coca-Cola Original",
+    "coca cola": "Coca-Cola Original",
+    "cocacola": "Coca-Cola Original",
+    "coke original": "Coca-Cola Original",
+    "coke zero": "Coca-Cola Zero Sugar",
+    "coca zero": "Coca-Cola Zero Sugar",
+    "coca cola zero": "Coca-Cola Zero Sugar",
+    "coke light": "Coca-Cola Light",
+    "coca light": "Coca-Cola Light",
+    "fanta cam": "Fanta Orange",
+    "fanta nho": "Fanta Grape",
+    "fanta dau": "Fanta Strawberry",
+    "fanta dua": "Fanta Pineapple",
+    "fanta dao": "Fanta Peach",
+    "fanta xa xi": "Fanta hương Xá xị",
+    "fanta soda kem": "Fanta hương Soda kem",
+    "sprite chanh": "Sprite Hương Chanh",
+    "sprite zero": "Sprite Zero Sugar",
+    "fanta zero": "Fanta Zero Sugar Orange",
+    "nuoc suoi dasani": "Nước uống đóng chai Dasani",
+    "dasani": "Dasani Purified Water"
+}
+
+
+def normalize_name(text: str) -> str:
+    """Chuẩn hoá tên sản phẩm: bỏ dấu tiếng Việt, ký hiệu ®/™/*, gạch nối; chữ thường, gộp khoảng trắng"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    text = text.replace('đ', 'd').replace('Đ', 'D').lower()
+    text = re.sub(r'[^0-9a-z+]+', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def _trigrams(normalized: str) -> Set[str]:
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ProductNameResolver:
+    def __init__(self, product_names: Iterable[str], aliases: Optional[Dict[str, str]] = None,
+                 min_score: float = 0.4):
+        """
+        Tra cứu tên sản phẩm bằng inverted index theo token và trigram ký tự, xây một lần khi khởi động
+
+        Args:
+            product_names: Tên sản phẩm theo thứ tự trong dữ liệu (chỉ số trả về là vị trí trong danh sách này)
+            aliases: Bảng tên gọi khác -> tên sản phẩm, mặc định PRODUCT_ALIASES
+            min_score: Điểm tối thiểu để chấp nhận kết quả
+        """
+        self.product_names = list(product_names)
+        self.min_score = min_score
+        self.normalized = [normalize_name(name) for name in self.product_names]
+        self.tokens = [set(name.split()) for name in self.normalized]
+        self.trigrams = [_trigrams(name) for name in self.normalized]
+
+        self.token_index: Dict[str, List[int]] = defaultdict(list)
+        self.trigram_index: Dict[str, List[int]] = defaultdict(list)
+        self.exact_index: Dict[str, List[int]] = defaultdict(list)
+        for idx, name in enumerate(self.normalized):
+            if not name:
+                continue
+            self.exact_index[name].append(idx)
+            for token in self.tokens[idx]:
+                self.token_index[token].append(idx)
+            for gram in self.trigrams[idx]:
+                self.trigram_index[gram].append(idx)
+
+        self.aliases = {normalize_name(alias): normalize_name(target)
+                        for alias, target in (aliases if aliases is not None else PRODUCT_ALIASES).items()}
+
+    def _score(self, query: str, query_tokens: Set[str], query_trigrams: Set[str], idx: int) -> float:
+        if self.normalized[idx] == query:
+            return 2.0
+        tokens = self.tokens[idx]
+        token_score = 2 * len(query_tokens & tokens) / (len(query_tokens) + len(tokens))
+        trigrams = self.trigrams[idx]
+        trigram_score = 2 * len(query_trigrams & trigrams) / (len(query_trigrams) + len(trigrams))
+        return 0.6 * token_score + 0.4 * trigram_score
+
+    def rank(self, name: str, exclude: Iterable[int] = (), limit: int = 5) -> List[Tuple[int, float]]:
+        """Các sản phẩm khớp nhất với name, dạng (chỉ số, điểm), điểm giảm dần"""
+        query = normalize_name(name)
+        if not query:
+            return []
+        query = self.aliases.get(query, query)
+        exclude = set(exclude)
+        query_tokens = set(query.split())
+        query_trigrams = _trigrams(query)
+
+        candidates = set(self.exact_index.get(query, []))
+        for token in query_tokens:
+            candidates.update(self.token_index.get(token, []))
+        for gram in query_trigrams:
+            candidates.update(self.trigram_index.get(gram, []))
+        candidates -= exclude
+
+        scored = [(idx, self._score(query, query_tokens, query_trigrams, idx)) for idx in candidates]
+        # Sắp xếp xác định: điểm cao hơn, tên ngắn hơn, rồi vị trí trong dữ liệu
+        scored.sort(key=lambda item: (-item[1], len(self.normalized[item[0]]), item[0]))
+        return [(idx, score) for idx, score in scored[:limit] if score >= self.min_score]
+
+    def resolve(self, name: str, exclude: Iterable[int] = ()) -> Optional[int]:
+        """Chỉ số sản phẩm khớp nhất với name, None nếu không có sản phẩm nào đủ điểm"""
+        ranked = self.rank(name, exclude=exclude, limit=1)
+        return ranked[0][0] if ranked else None
+
+    def find_mentions(self, text: str) -> List[int]:
+        """
+        Các sản phẩm được nhắc tới trong một câu (tên đầy đủ sau chuẩn hoá hoặc tên gọi khác trong aliases),
+        theo thứ tự xuất hiện; ưu tiên cụm từ dài nhất nên "Sprite Zero Sugar" không bị tính thêm là "Sprite"
+        """
+        words = normalize_name(text).split()
+        if not words:
+            return []
+        max_words = max(len(tokens) for tokens in self.tokens) if self.tokens else 0
+        taken = [False] * len(words)
+        found = []
+        for size in range(min(max_words, len(words)), 0, -1):
+            for start in range(len(words) - size + 1):
+                if any(taken[start:start + size]):
+                    continue
+                phrase = " ".join(words[start:start + size])
+                indices = self.exact_index.get(self.aliases.get(phrase, phrase))
+                if not indices:
+                    continue
+                for pos in range(start, start + size):
+                    taken[pos] = True
+                found.append((start, indices[0]))
+        mentions = []
+        for _, idx in sorted(found):
+            if idx not in mentions:
+                mentions.append(idx)
+        return mentions
+
+    def same_product_name(self, idx: int, other_name: str) -> bool:
+        """So sánh tên sản phẩm idx với một tên khác sau khi chuẩn hoá"""
+        return self.normalized[idx] == normalize_name(other_name)
@@ -0,0 +1,218 @@
+"""
+Backend encode câu truy vấn cho model embedding (paraphrase-multilingual-MiniLM-L12-v2), chọn bằng
+biến môi trường EMBEDDING_BACKEND:
+- torch: SentenceTransformer fp32 (mặc định, cùng model đã dùng để embed chunk)
+- torch_int8: SentenceTransformer với các lớp Linear được lượng tử hoá động int8 (torch dynamic quantization)
+- onnx / onnx_int8: model đã export sang ONNX (fp32 hoặc lượng tử hoá int8), chạy bằng onnxruntime,
+  không cần import torch/sentence_transformers lúc chạy
+
+Embedding của chunk luôn được tạo bằng model fp32, các backend chỉ thay phần encode câu truy vấn.
+Kiểm tra độ lệch so với fp32 và đo latency/bộ nhớ: python benchmark_encoders.py
+
+Export model sang ONNX (cần torch, onnx, onnxruntime):
+    python query_encoders.py --export-onnx [--output-dir models/onnx]
+"""
+import json
+import logging
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ENCODER_BACKENDS = ["torch", "torch_int8", "onnx", "onnx_int8"]
+
+DEFAULT_ONNX_DIR = "models/onnx"
+ONNX_MODEL_FILES = {
+    "onnx": "model.onnx",
+    "onnx_int8": "model_int8.onnx"
+}
+ENCODER_CONFIG_FILE = "encoder_config.json"
+
+
+class QueryEncoder:
+    """Encode danh sách câu thành ma trận embedding float32 (chưa chuẩn hoá), shape (n, dim)"""
+
+    name = ""
+
+    def __init__(self):
+        self.load_ms = 0.0
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    def describe(self) -> Dict[str, Any]:
+        return {'backend': self.name, 'load_ms': round(self.load_ms, 1)}
+
+
+class TorchEncoder(QueryEncoder):
+    """SentenceTransformer (fp32 hoặc đã lượng tử hoá int8)"""
+
+    def __init__(self, model, name: str = "torch"):
+        super().__init__()
+        self.model = model
+        self.name = name
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.model.encode(texts, batch_size=max(1, len(texts)), show_progress_bar=False),
+                          dtype=np.float32)
+
+
+class OnnxEncoder(QueryEncoder):
+    """
+    Model ONNX (transformer) + tokenizer đã lưu bởi export_onnx, pooling làm bằng NumPy
+    giống module Pooling của SentenceTransformer
+
+    Args:
+        model_dir: Thư mục chứa file .onnx, tokenizer và encoder_config.json
+        name: "onnx" hoặc "onnx_int8"
+        num_threads: Số thread của onnxruntime, None là mặc định (theo số CPU)
+    """
+
+    def __init__(self, model_dir: str = DEFAULT_ONNX_DIR, name: str = "onnx", num_threads: Optional[int] = None):
+        super().__init__()
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise RuntimeError("Backend ONNX cần onnxruntime: pip install onnxruntime") from e
+        # Dùng thẳng thư viện tokenizers (transformers.AutoTokenizer sẽ import torch nếu có)
+        from tokenizers import Tokenizer
+
+        model_file = os.path.join(model_dir, ONNX_MODEL_FILES[name])
+        if not os.path.exists(model_file):
+            raise RuntimeError(f"Chưa có {model_file}, chạy 'python query_encoders.py --export-onnx' trước")
+        with open(os.path.join(model_dir, ENCODER_CONFIG_FILE), 'r', encoding='utf-8') as f:
+            self.config = json.load(f)
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(self.config['max_seq_length'])
+        self.tokenizer.enable_padding(pad_id=self.config['pad_token_id'], pad_token=self.config['pad_token'])
+        self.name = name
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.config['dimension']), dtype=np.float32)
+        encodings = self.tokenizer.encode_batch(list(texts))
+        tokens = {
+            'input_ids': np.asarray([e.ids for e in encodings], dtype=np.int64),
+            'attention_mask': np.asarray([e.attention_mask for e in encodings], dtype=np.int64),
+            'token_type_ids': np.asarray([e.type_ids for e in encodings], dtype=np.int64)
+        }
+        hidden = self.session.run(None, {name: tokens[name] for name in self.input_names})[0]
+        if self.config.get('pooling') == 'cls':
+            return np.ascontiguousarray(hidden[:, 0], dtype=np.float32)
+        mask = tokens['attention_mask'][:, :, None].astype(np.float32)
+        return ((hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)).astype(np.float32)
+
+
+def quantize_int8(model):
+    """Lượng tử hoá động int8 các lớp Linear của SentenceTransformer (sửa trực tiếp model)"""
+    import torch
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def _pooling_mode(pooling) -> str:
+    """Chế độ pooling của module Pooling ("mean", "cls", ...), tương thích các phiên bản sentence-transformers"""
+    mode = getattr(pooling, 'pooling_mode', None)
+    if isinstance(mode, str):
+        return mode
+    return pooling.get_pooling_mode_str()
+
+
+def load_query_encoder(backend: str, model_name: str, local_files_only: bool = True, model=None,
+                       onnx_dir: Optional[str] = None) -> QueryEncoder:
+    """
+    Tạo backend encode câu truy vấn
+
+    Args:
+        backend: Một trong ENCODER_BACKENDS
+        model_name: Tên model embedding (cho backend torch/torch_int8)
+        local_files_only: Chỉ load model từ cache cục bộ
+        model: SentenceTransformer fp32 đã load sẵn, backend "torch" dùng chung thay vì load lại
+        onnx_dir: Thư mục model ONNX, mặc định theo biến môi trường EMBEDDING_ONNX_DIR
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Không hỗ trợ backend encode: {backend} (chọn một trong {ENCODER_BACKENDS})")
+    start = time.perf_counter()
+    if backend in ONNX_MODEL_FILES:
+        encoder = OnnxEncoder(onnx_dir or os.getenv('EMBEDDING_ONNX_DIR', DEFAULT_ONNX_DIR), backend)
+    else:
+        if model is None or backend == "torch_int8":
+            # Lượng tử hoá sửa trực tiếp model nên torch_int8 luôn load bản riêng
+            from vector_database import load_embedding_model
+            model = load_embedding_model(model_name, local_files_only)
+        if backend == "torch_int8":
+            model = quantize_int8(model)
+        encoder = TorchEncoder(model, backend)
+    encoder.load_ms = (time.perf_counter() - start) * 1000
+    logger.info(f"Đã load backend encode {backend} ({encoder.load_ms:.0f} ms)")
+    return encoder
+
+
+def export_onnx(model_name: str, output_dir: str = DEFAULT_ONNX_DIR, local_files_only: bool = False,
+                opset: int = 14) -> Dict[str, str]:
+    """
+    Export transformer của SentenceTransformer sang ONNX (fp32) và bản lượng tử hoá động int8,
+    kèm tokenizer và cấu hình pooling
+
+    Returns:
+        Backend -> đường dẫn file .onnx
+    """
+    import torch
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from vector_database import load_embedding_model
+
+    model = load_embedding_model(model_name, local_files_only)
+    transformer = model[0]
+    pooling = _pooling_mode(model[1])
+    if pooling not in ("mean", "cls"):
+        raise ValueError(f"Backend ONNX chưa hỗ trợ pooling {pooling}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    auto_model = transformer.auto_model.eval()
+    sample = transformer.tokenizer(["Coca-Cola Original có bao nhiêu calo?"], return_tensors="pt")
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+    fp32_path = os.path.join(output_dir, ONNX_MODEL_FILES["onnx"])
+    with torch.no_grad():
+        torch.onnx.export(auto_model, tuple(sample[name] for name in input_names), fp32_path,
+                          input_names=input_names, output_names=['last_hidden_state'],
+                          dynamic_axes=dynamic_axes, opset_version=opset)
+
+    int8_path = os.path.join(output_dir, ONNX_MODEL_FILES["onnx_int8"])
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+    # Tokenizer "fast" lưu tokenizer.json, OnnxEncoder đọc bằng thư viện tokenizers
+    transformer.tokenizer.save_pretrained(output_dir)
+    config = {
+        'model_name': model_name,
+        'max_seq_length': transformer.max_seq_length,
+        'pad_token': transformer.tokenizer.pad_token,
+        'pad_token_id': transformer.tokenizer.pad_token_id,
+        'dimension': model.get_sentence_embedding_dimension(),
+        'pooling': pooling
+    }
+    with open(os.path.join(output_dir, ENCODER_CONFIG_FILE), 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return {"onnx": fp32_path, "onnx_int8": int8_path}
+
+
+if __name__ == "__main__":
+    from vector_database import DEFAULT_MODEL_NAME
+
+    if "--export-onnx" in sys.argv:
+        output_dir = DEFAULT_ONNX_DIR
+        if "--output-dir" in sys.argv:
+            output_dir = sys.argv[sys.argv.index("--output-dir") + 1]
+        for backend, path in export_onnx(DEFAULT_MODEL_NAME, output_dir).items():
+            print(f"Đã export backend {backend}: {path}")
+    else:
+        print(__doc__)
@@ -1,81 +1,729 @@
 import json
 import os
+import math
+import time
 import logging
-import re
-from typing import Dict, Any, List
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, List, Iterator, Tuple, Optional, Callable
 
 # Hãy đảm bảo các module này được import đúng
-from intent_classifier import IntentClassifier
-from vector_database import VectorDatabase
-from llm_generator import generate_with_llm
+from intent_classifier import IntentClassifier, INTENT_DESCRIPTIONS, extract_json_object
+from vector_database import VectorDatabase, index_exists
+from llm_generator import generate_with_llm, stream_with_llm, LLM_ERROR_RESPONSE, LLMStreamError
+from local_intent_classifier import LocalIntentClassifier
+from http_client import get_http_client
+from process_memory import memory_usage
+from startup_timeline import StartupTimeline, RequestTimings
+from response_cache import DataVersion, ResponseCache
+from semantic_cache import SemanticAnswerCache
+from context_packer import ContextPacker, count_tokens
+from product_resolver import ProductNameResolver, normalize_name
+from nutrition_table import (NutritionTable, ATTRIBUTE_LABELS, resolve_attribute, parse_quantity,
+                             parse_range, format_quantity)
+from response_templates import (RESPONSE_MODES, ATTRIBUTE_LOOKUP_INTENTS, render_greeting, render_list,
+                                render_extremum, render_top_k, render_range, render_attribute)
 
 logger = logging.getLogger(__name__)
 
+PIPELINE_MODES = ["two_stage", "fused"]
+
+# Các intent cần entities trước để chạy đường dữ liệu cục bộ (lọc, tính cực trị, so sánh)
+STRUCTURED_INTENTS = [
+    'list_by_product_type', 'list_by_brand', 'list_by_attribute',
+    'find_min_attribute', 'find_max_attribute', 'find_top_k_attribute',
+    'filter_by_attribute_range', 'compare_two_products'
+]
+
+# Các intent mà câu hỏi khác nhau ở thông tin không có trong entities (quốc gia, tên nhóm sản phẩm):
+# không dùng cache theo ngữ nghĩa vì "sản phẩm tại Việt Nam" và "sản phẩm tại Nhật Bản" cùng phạm vi
+SEMANTIC_CACHE_EXCLUDED_INTENTS = ['list_by_country', 'explain_category']
+
+# Các intent có một câu trả lời chung, không cần entities để phân biệt câu hỏi
+SEMANTIC_CACHE_UNSCOPED_INTENTS = ['greeting']
+
+FUSED_PROMPT = """Bạn là trợ lý ảo của Coca-Cola. Hãy phân loại ý định (intent), trích xuất thực thể và trả lời câu hỏi của người dùng trong cùng một lần.
+
+Các intent có thể có là:
+{intent_descriptions}
+
+--- CONTEXT ---
+{context}
+--- END CONTEXT ---
+
+Chỉ trả về một object JSON duy nhất theo dạng:
+{"intent": "<intent>", "entities": {"product_names": ["..."], "attribute": "...", "brand_name": "...", "product_type": "...", "k": 5, "order": "asc", "min_value": null, "max_value": null}, "answer": "<câu trả lời>"}
+
+QUY TẮC QUAN TRỌNG:
+- Chỉ đưa vào "entities" những thực thể xuất hiện trong câu hỏi. Tên sản phẩm cần đầy đủ và chính xác nhất có thể, ví dụ "Coke Zero" nên là "Coca-Cola Zero Sugar".
+- Nếu câu hỏi có từ "ít nhất", "thấp nhất", "nhỏ nhất", hãy dùng intent "find_min_attribute"; nếu có từ "nhiều nhất", "cao nhất", "lớn nhất", hãy dùng intent "find_max_attribute".
+- Nếu câu hỏi muốn nhiều sản phẩm đứng đầu (ví dụ "5 loại ít calo nhất"), hãy dùng intent "find_top_k_attribute"; nếu hỏi theo ngưỡng (ví dụ "dưới 50 calo"), hãy dùng intent "filter_by_attribute_range".
+- Với các intent list_by_product_type, list_by_brand, list_by_attribute, find_min_attribute, find_max_attribute, find_top_k_attribute, filter_by_attribute_range, compare_two_products: để "answer" là chuỗi rỗng.
+- Với các intent còn lại: "answer" trả lời thẳng vào câu hỏi dựa vào context, ngắn gọn, không bình luận thêm về việc thiếu thông tin.
+
+Câu hỏi: {user_query}"""
+
 class RAGSystem:
-    def __init__(self, vector_db_path: str = "vector_db/coca_cola_index", data_file: str = "data/final_product_data.json"):
-        self.intent_classifier = IntentClassifier()
+    # Số sản phẩm tối đa trong một lần so sánh, giữ prompt ở độ dài hợp lý
+    MAX_COMPARE_PRODUCTS = 6
+    # Số sản phẩm tối đa của truy vấn top-k
+    MAX_TOP_K = 20
+    # Số chunk lấy về cho câu trả lời semantic search
+    SEMANTIC_SEARCH_K = 10
+
+    def __init__(self, vector_db_path: str = "vector_db/coca_cola_index", data_file: str = "data/final_product_data.json",
+                 use_local_intent: bool = True, pipeline_mode: str = "two_stage",
+                 search_backend: str = "auto", search_params: Optional[Dict[str, int]] = None,
+                 intent_classifier: Optional[IntentClassifier] = None, timeline: Optional[StartupTimeline] = None,
+                 response_cache_size: int = 1024, response_cache_ttl: Optional[float] = 3600,
+                 response_cache_max_mb: float = 64, semantic_cache_size: int = 2048,
+                 semantic_cache_threshold: float = 0.88, semantic_cache_ttl: Optional[float] = 24 * 3600,
+                 response_mode: str = "template", speculative_top_n: int = 100, speculative_workers: int = 4,
+                 context_token_budget: Optional[int] = 1000):
+        """
+        Args:
+            vector_db_path: Đường dẫn (không có đuôi) tới vector database
+            data_file: File dữ liệu sản phẩm gốc
+            use_local_intent: Bật fast path phân loại intent cục bộ
+            pipeline_mode: "two_stage" (phân loại intent rồi sinh câu trả lời) hoặc
+                "fused" (retrieve bằng câu hỏi gốc rồi một lần gọi LLM trả về cả intent, entities và câu trả lời)
+            search_backend: Backend tìm kiếm khi load vector DB (xem VectorDatabase.load_index)
+            search_params: Tham số lúc search của index xấp xỉ, ví dụ {"nprobe": 16} hoặc {"ef_search": 64}
+            intent_classifier: IntentClassifier đã tạo sẵn (ví dụ để /api/intent dùng được trước khi khởi tạo xong)
+            timeline: Nơi ghi thời gian từng bước khởi tạo
+            response_cache_size: Số câu trả lời tối đa được cache theo câu hỏi đã chuẩn hoá (0 để tắt cache)
+            response_cache_ttl: Thời gian sống của câu trả lời trong cache (giây), None là không hết hạn
+            response_cache_max_mb: Tổng kích thước tối đa của cache câu trả lời (MB, ước lượng theo JSON)
+            semantic_cache_size: Số câu trả lời tối đa của cache theo ngữ nghĩa (0 để tắt)
+            semantic_cache_threshold: Cosine tối thiểu giữa câu hỏi mới và câu đã trả lời (cùng intent và entities)
+                để dùng lại câu trả lời
+            semantic_cache_ttl: Thời gian sống của câu trả lời trong cache theo ngữ nghĩa (giây)
+            response_mode: "template" (intent đã có đáp án từ dữ liệu cục bộ như liệt kê, cực trị, tra cứu thuộc tính
+                được trả lời theo mẫu, không gọi LLM) hoặc "llm" (LLM diễn đạt lại các câu trả lời đó)
+            speculative_top_n: Khi phải gọi Gemini phân loại intent, song song đó encode câu hỏi và search rộng
+                top-N không filter; có intent thì lọc tập này theo filter thay vì search lại (0 để tắt)
+            speculative_workers: Số thread của pool dùng chung cho speculative retrieval (số request được
+                search song song với lúc chờ Gemini)
+            context_token_budget: Số token (ước lượng) tối đa của context trong prompt sinh câu trả lời,
+                None là không giới hạn (vẫn bỏ dòng trùng giữa các chunk)
+        """
+        if pipeline_mode not in PIPELINE_MODES:
+            raise ValueError(f"Không hỗ trợ pipeline mode: {pipeline_mode}")
+        if response_mode not in RESPONSE_MODES:
+            raise ValueError(f"Không hỗ trợ response mode: {response_mode}")
+        self.pipeline_mode = pipeline_mode
+        self.response_mode = response_mode
+        # Câu trả lời khác nhau theo pipeline và response mode nên cache phân biệt theo cả hai
+        self.cache_variant = f"{pipeline_mode}:{response_mode}"
+        self.speculative_top_n = speculative_top_n
+        self.speculative_workers = speculative_workers
+        self._speculative_pool: Optional[ThreadPoolExecutor] = None
+        self._speculative_pool_pid: Optional[int] = None
+        self._speculation_lock = threading.Lock()
+        self._speculation_stats = {'started': 0, 'refined': 0, 'fallback': 0, 'unused': 0, 'errors': 0}
+        self._prompt_lock = threading.Lock()
+        self._prompt_totals = {'llm_prompts': 0, 'prompt_tokens': 0, 'context_tokens': 0,
+                               'duplicate_lines': 0, 'dropped_lines': 0}
+        self.startup_timeline = timeline or StartupTimeline()
+        self.intent_classifier = intent_classifier or IntentClassifier(
+            fused_prompt=FUSED_PROMPT if pipeline_mode == 'fused' else None)
         self.vector_db = VectorDatabase()
+        # Ghép context theo ngân sách token, số token từng dòng chunk lấy từ snapshot
+        self.context_packer = ContextPacker(context_token_budget, self.vector_db.chunk_line_tokens)
+        # Cache câu trả lời, tự xoá khi vector DB hoặc file dữ liệu sản phẩm trên đĩa thay đổi
+        self.data_version = DataVersion(vector_db_path, [data_file])
+        self.response_cache = ResponseCache(
+            self.data_version, max_size=response_cache_size, ttl=response_cache_ttl,
+            max_bytes=int(response_cache_max_mb * 1024 * 1024)
+        ) if response_cache_size > 0 else None
+        # Dùng lại câu trả lời cho câu hỏi diễn đạt khác (cùng intent, entities và embedding đủ gần)
+        self.semantic_cache = SemanticAnswerCache(
+            threshold=semantic_cache_threshold, max_size=semantic_cache_size, ttl=semantic_cache_ttl,
+            data_version=self.data_version
+        ) if semantic_cache_size > 0 else None
 
-        # Load vector DB
-        if os.path.exists(f"{vector_db_path}.index"):
-            self.vector_db.load_index(vector_db_path)
-            logging.info("Đã load vector database")
-        else:
-            raise FileNotFoundError("Chưa có vector database, cần tạo trước.")
+        # Load vector DB (snapshot memory-mapped, không cần model)
+        with self.startup_timeline.stage('index_load'):
+            if index_exists(vector_db_path):
+                self.vector_db.load_index(vector_db_path, backend=search_backend, search_params=search_params)
+                logging.info("Đã load vector database")
+            else:
+                raise FileNotFoundError("Chưa có vector database, cần tạo trước.")
 
         # Load dữ liệu gốc để có thể LỌC và TÍNH TOÁN
-        with open(data_file, "r", encoding="utf-8") as f:
-            self.all_products_data = json.load(f)
-        logging.info(f"Đã load {len(self.all_products_data)} sản phẩm gốc.")
+        with self.startup_timeline.stage('product_data'):
+            with open(data_file, "r", encoding="utf-8") as f:
+                self.all_products_data = json.load(f)
+            logging.info(f"Đã load {len(self.all_products_data)} sản phẩm gốc.")
+
+            # Index tên sản phẩm để tra cứu tên trong câu hỏi (so sánh, ưu tiên kết quả search)
+            self.product_resolver = ProductNameResolver([p.get('product_name', '') for p in self.all_products_data])
+
+            # Parse thông tin dinh dưỡng một lần thành các cột NumPy để lọc/tính cực trị
+            self.nutrition_table = NutritionTable(self.all_products_data)
+
+        # Model encode câu truy vấn (import torch/transformers hoặc onnxruntime), bước tốn thời gian nhất
+        with self.startup_timeline.stage('model_load'):
+            self.vector_db.query_encoder
+
+        # Fast path phân loại intent cục bộ, dùng chung model embedding của vector DB
+        if use_local_intent:
+            with self.startup_timeline.stage('local_intent'):
+                self.intent_classifier.local_classifier = LocalIntentClassifier(
+                    self.vector_db, product_resolver=self.product_resolver)
 
     def generate_response(self, user_query: str) -> Dict[str, Any]:
+        """
+        Trả lời một câu hỏi. Kết quả có thêm 'cache': {'status': 'hit' | 'semantic_hit' | 'miss' | 'disabled',
+        'age_seconds'}, với semantic_hit có thêm 'similarity' và 'matched_query', và 'timings': thời gian
+        từng bước (RequestTimings)
+        """
+        timings = RequestTimings()
+        result = self._cached_response(user_query)
+        if result is None:
+            result = self._generate_response(user_query, timings)
+            self._remember_response(user_query, result)
+        result['timings'] = timings.as_dict()
+        return result
+
+    def _cached_response(self, user_query: str) -> Optional[Dict[str, Any]]:
+        if self.response_cache is None:
+            return None
+        result, age = self.response_cache.get(user_query, self.cache_variant)
+        if result is None:
+            return None
+        result['query'] = user_query
+        result['cache'] = {'status': 'hit', 'age_seconds': round(age, 3)}
+        result['prompt_stats'] = None
+        return result
+
+    def _semantic_scope(self, intent: str, entities: Dict) -> Optional[str]:
+        """
+        Phạm vi của cache theo ngữ nghĩa: intent và entities đã chuẩn hoá (tên sản phẩm quy về tên trong dữ liệu).
+        None nếu không dùng cache theo ngữ nghĩa được: intent trong SEMANTIC_CACHE_EXCLUDED_INTENTS, hoặc không có
+        entity nào để phân biệt (câu gần giống nhau về hai sản phẩm khác nhau sẽ trùng phạm vi)
+        """
+        if intent == 'unknown' or intent in SEMANTIC_CACHE_EXCLUDED_INTENTS:
+            return None
+        scope = {}
+        for key, value in entities.items():
+            if value in (None, '', []):
+                continue
+            if key == 'product_names' and isinstance(value, list):
+                names = []
+                for name in value:
+                    idx = self.product_resolver.resolve(str(name))
+                    names.append(self.all_products_data[idx].get('product_name', '') if idx is not None
+                                 else normalize_name(str(name)))
+                value = sorted(names)
+            elif isinstance(value, str):
+                value = normalize_name(value)
+            scope[key] = value
+        if not scope and intent not in SEMANTIC_CACHE_UNSCOPED_INTENTS:
+            return None
+        return json.dumps([intent, scope], ensure_ascii=False, sort_keys=True, default=str)
+
+    def _semantic_cached_response(self, user_query: str, intent: str, entities: Dict) -> Optional[Dict[str, Any]]:
+        if self.semantic_cache is None:
+            return None
+        scope = self._semantic_scope(intent, entities)
+        if scope is None:
+            return None
+        embedding = self.vector_db.encode_query(user_query)[0]
+        match = self.semantic_cache.lookup(embedding, scope)
+        if match is None:
+            return None
+        result = match['result']
+        result['query'] = user_query
+        result['prompt_stats'] = None
+        result['cache'] = {'status': 'semantic_hit', 'age_seconds': round(match['age_seconds'], 3),
+                           'similarity': round(match['similarity'], 4), 'matched_query': match['matched_query']}
+        return result
+
+    def _remember_response(self, user_query: str, result: Dict[str, Any]):
+        """Cache kết quả vừa tạo và gắn trạng thái cache vào kết quả (nếu chưa có)"""
+        # Không cache kết quả lỗi (không phân loại được intent, LLM lỗi, câu trả lời rỗng) để lần sau còn thử lại
+        cacheable = (result.get('intent', 'unknown') != 'unknown' and bool(result.get('response'))
+                     and result.get('response') != LLM_ERROR_RESPONSE)
+        if cacheable and self.response_cache is not None:
+            self.response_cache.put(user_query, result, self.cache_variant)
+        if cacheable and self.semantic_cache is not None and 'cache' not in result:
+            try:
+                scope = self._semantic_scope(result['intent'], result.get('entities') or {})
+                if scope is not None:
+                    self.semantic_cache.put(self.vector_db.encode_query(user_query)[0], scope, user_query, result)
+            except Exception as e:
+                logger.error(f"Lỗi lưu cache theo ngữ nghĩa: {e}")
+        if 'cache' not in result:
+            enabled = self.response_cache is not None or self.semantic_cache is not None
+            result['cache'] = {'status': 'miss' if enabled else 'disabled', 'age_seconds': None}
+
+    def _generate_response(self, user_query: str, timings: RequestTimings) -> Dict[str, Any]:
         # 1. Phân loại Intent và Entities
-        analysis = self.intent_classifier.classify_intent(user_query)
+        speculative = None
+        if self.pipeline_mode == 'fused':
+            # Cache/fast path cục bộ đã có intent thì không cần gộp, chạy luồng hai bước bình thường
+            with timings.stage('classify'):
+                analysis = self.intent_classifier.lookup(user_query)
+            if analysis is None:
+                with timings.stage('fused'):
+                    fused_result = self._generate_fused(user_query)
+                if fused_result is not None:
+                    return fused_result
+                with timings.stage('classify'):
+                    analysis = self.intent_classifier.classify_remote(
+                        user_query, timings.info.setdefault('intent_call', {}))
+        else:
+            analysis, speculative = self._classify(user_query, timings)
         intent = analysis.get("intent", "unknown")
         entities = analysis.get("entities", {})
+        search_results = self._speculative_results(speculative, intent, entities, timings)
+
+        # Câu hỏi cùng ý (cùng intent, entities) đã được trả lời thì dùng lại, không gọi LLM
+        with timings.stage('semantic_cache'):
+            semantic = self._semantic_cached_response(user_query, intent, entities)
+        if semantic is not None:
+            return semantic
 
         # 2. Định tuyến (Route) tác vụ dựa trên Intent
+        with timings.stage('route'):
+            plan = self._route(user_query, intent, entities, search_results)
+        with timings.stage('generate'):
+            response = self._execute_plan(plan)
+        return self._build_result(user_query, intent, entities, response, plan['relevant_items'],
+                                  self._prompt_stats(plan))
+
+    def _classify(self, user_query: str, timings: RequestTimings) -> Tuple[Dict[str, Any], Optional[Future]]:
+        """
+        Phân loại intent. Nếu cache/fast path cục bộ không có kết quả và phải gọi Gemini thì trong lúc chờ,
+        một thread khác encode câu hỏi và search rộng top-N (speculative retrieval)
+
+        Returns:
+            (intent và entities, Future của (kết quả search rộng, thời gian ms) hoặc None)
+        """
+        with timings.stage('classify'):
+            analysis = self.intent_classifier.lookup(user_query)
+            if analysis is not None:
+                return analysis, None
+            speculative = None
+            if self.speculative_top_n > 0:
+                speculative = self._speculative_executor().submit(self._speculative_search, user_query)
+                self._record_speculation('started')
+            call_info = timings.info.setdefault('intent_call', {})
+            return self.intent_classifier.classify_remote(user_query, call_info), speculative
+
+    def _speculative_executor(self) -> ThreadPoolExecutor:
+        """
+        Pool thread dùng chung cho speculative retrieval, tạo lần đầu dùng trong mỗi process
+        (thread không sống qua fork nên worker gunicorn không dùng lại pool của master)
+        """
+        with self._speculation_lock:
+            if self._speculative_pool is None or self._speculative_pool_pid != os.getpid():
+                self._speculative_pool = ThreadPoolExecutor(max_workers=max(1, self.speculative_workers),
+                                                            thread_name_prefix="rag-speculative")
+                self._speculative_pool_pid = os.getpid()
+            return self._speculative_pool
+
+    def close(self):
+        """Dừng pool thread của speculative retrieval (huỷ các lần search chưa chạy)"""
+        with self._speculation_lock:
+            pool, self._speculative_pool = self._speculative_pool, None
+        if pool is not None and self._speculative_pool_pid == os.getpid():
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _speculative_search(self, user_query: str) -> Tuple[List[Dict], float]:
+        start = time.perf_counter()
+        results = self.vector_db.search(user_query, k=self.speculative_top_n)
+        return results, (time.perf_counter() - start) * 1000
+
+    def _speculative_results(self, speculative: Optional[Future], intent: str, entities: Dict,
+                             timings: RequestTimings) -> Optional[List[Dict]]:
+        """
+        Kết quả semantic search lọc từ lần search rộng speculative theo filter của intent, hoặc None nếu
+        không có/không dùng được (khi đó _route search lại như bình thường; embedding đã nằm trong cache)
+        """
+        if speculative is None:
+            return None
+        if not self._is_semantic_intent(intent, entities):
+            speculative.cancel()
+            self._record_speculation('unused')
+            timings.info['speculative'] = 'unused'
+            return None
+        if speculative.cancel():
+            # Pool đang bận, lần search rộng chưa kịp chạy: search trực tiếp nhanh hơn chờ tới lượt
+            self._record_speculation('fallback')
+            timings.info['speculative'] = 'fallback'
+            return None
+        with timings.stage('retrieval_wait'):
+            try:
+                candidates, search_ms = speculative.result()
+            except Exception as e:
+                logger.error(f"Lỗi speculative retrieval: {e}")
+                self._record_speculation('errors')
+                timings.info['speculative'] = 'error'
+                return None
+        # Chạy song song với classify, thời gian thực tế phải chờ nằm ở retrieval_wait
+        timings.record('speculative_retrieval', search_ms)
+        with timings.stage('refine'):
+            results = self.vector_db.refine(candidates, self.SEMANTIC_SEARCH_K, self._semantic_filter(intent, entities))
+        status = 'refined' if results is not None else 'fallback'
+        self._record_speculation(status)
+        timings.info['speculative'] = status
+        return results
+
+    def _record_speculation(self, outcome: str):
+        with self._speculation_lock:
+            self._speculation_stats[outcome] += 1
+
+    def generate_responses(self, user_queries: List[str], max_concurrency: int = 4) -> List[Dict[str, Any]]:
+        """
+        Xử lý một lô câu hỏi (luôn theo luồng hai bước):
+        - Encode mọi câu hỏi trong một lần forward, song song với phân loại intent
+        - Các câu semantic search được search trong một lần search_batch
+        - Phân loại intent và sinh câu trả lời bằng LLM chạy song song, tối đa max_concurrency lời gọi cùng lúc
+        Câu đã có trong cache câu trả lời được trả về ngay, không tính vào lô.
+
+        Returns:
+            Kết quả theo thứ tự câu hỏi, như generate_response; câu bị lỗi có dạng {'query', 'error'}
+            thay vì làm hỏng cả lô
+        """
+        if not user_queries:
+            return []
+        outcomes: List[Optional[Dict[str, Any]]] = [self._cached_response(query) for query in user_queries]
+        rows = [i for i, outcome in enumerate(outcomes) if outcome is None]
+        if rows:
+            generated = self._generate_responses([user_queries[i] for i in rows], max_concurrency)
+            for i, result in zip(rows, generated):
+                if 'error' not in result:
+                    self._remember_response(user_queries[i], result)
+                outcomes[i] = result
+        return outcomes
+
+    def _generate_responses(self, user_queries: List[str], max_concurrency: int) -> List[Dict[str, Any]]:
+        outcomes: List[Optional[Dict[str, Any]]] = [None] * len(user_queries)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(user_queries))),
+                                thread_name_prefix="rag-batch") as pool:
+            # 1. Encode (điền cache embedding câu truy vấn) trong lúc chờ phân loại intent
+            encode_future = pool.submit(self.vector_db.encode_queries, user_queries)
+            analyses = list(pool.map(lambda query: _capture(self.intent_classifier.classify_intent, query),
+                                     user_queries))
+            encode_error = encode_future.exception()
+            if encode_error is not None:
+                logger.error(f"Lỗi encode lô câu hỏi: {encode_error}")
+
+            # 2. Retrieve chung cho các câu semantic search
+            semantic_rows = [i for i, (analysis, error) in enumerate(analyses)
+                             if error is None and self._is_semantic_intent(analysis.get("intent", "unknown"),
+                                                                           analysis.get("entities", {}))]
+            search_results = {}
+            if semantic_rows and encode_error is None:
+                filters = [self._semantic_filter(analyses[i][0].get("intent", "unknown"),
+                                                 analyses[i][0].get("entities", {})) for i in semantic_rows]
+                batch_results, error = _capture(self.vector_db.search_batch, [user_queries[i] for i in semantic_rows],
+                                                self.SEMANTIC_SEARCH_K, filters)
+                if error is None:
+                    search_results = dict(zip(semantic_rows, batch_results))
+
+            # 3. Lập kế hoạch từng câu (dữ liệu cục bộ), rồi gọi LLM song song
+            plans = {}
+            for i, (analysis, error) in enumerate(analyses):
+                if error is None:
+                    intent = analysis.get("intent", "unknown")
+                    entities = analysis.get("entities", {})
+                    semantic, _ = _capture(self._semantic_cached_response, user_queries[i], intent, entities)
+                    if semantic is not None:
+                        outcomes[i] = semantic
+                        continue
+                    plan, error = _capture(self._route, user_queries[i], intent, entities, search_results.get(i))
+                if error is not None:
+                    outcomes[i] = {'query': user_queries[i], 'error': str(error)}
+                else:
+                    plans[i] = (intent, entities, plan)
+            rows = list(plans.keys())
+            for i, (response, error) in zip(rows, pool.map(lambda row: _capture(self._execute_plan, plans[row][2]), rows)):
+                intent, entities, plan = plans[i]
+                if error is not None:
+                    outcomes[i] = {'query': user_queries[i], 'intent': intent, 'entities': entities, 'error': str(error)}
+                else:
+                    outcomes[i] = self._build_result(user_queries[i], intent, entities, response, plan['relevant_items'],
+                                                     self._prompt_stats(plan))
+        return outcomes
+
+    def generate_response_stream(self, user_query: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Phiên bản streaming của generate_response, trả về lần lượt các sự kiện (tên, dữ liệu):
+        - ('meta', {...}): intent, entities và các thông tin liên quan, gửi trước khi có token nào
+        - ('token', {'text': ...}): từng đoạn câu trả lời do LLM stream về
+        - ('done', {'response': ..., 'timings': ...}): câu trả lời đầy đủ và thời gian từng bước
+        - ('error', {'error': ..., 'partial_response': ...}): thay cho 'done' khi stream của LLM bị ngắt giữa chừng
+          hoặc mọi API key đều lỗi (partial_response rỗng)
+        Luôn dùng luồng hai bước vì pipeline fused cần toàn bộ JSON trước khi có câu trả lời.
+        Câu trả lời đã cache được gửi ngay thành một sự kiện token.
+        """
+        timings = RequestTimings()
+        cached = self._cached_response(user_query)
+        if cached is not None:
+            yield from self._stream_cached(cached, timings)
+            return
+
+        analysis, speculative = self._classify(user_query, timings)
+        intent = analysis.get("intent", "unknown")
+        entities = analysis.get("entities", {})
+        search_results = self._speculative_results(speculative, intent, entities, timings)
+        with timings.stage('semantic_cache'):
+            semantic = self._semantic_cached_response(user_query, intent, entities)
+        if semantic is not None:
+            self._remember_response(user_query, semantic)
+            yield from self._stream_cached(semantic, timings)
+            return
+        with timings.stage('route'):
+            plan = self._route(user_query, intent, entities, search_results)
+        prompt_stats = self._prompt_stats(plan)
+
+        yield 'meta', {
+            'query': user_query,
+            'intent': intent,
+            'entities': entities,
+            'relevant_chunks': plan['relevant_items'],
+            'total_chunks_found': len(plan['relevant_items']),
+            'cache': {'status': 'miss' if self.response_cache or self.semantic_cache else 'disabled',
+                      'age_seconds': None},
+            'prompt_stats': prompt_stats
+        }
+
+        if plan['prompt'] is None:
+            response = plan['response']
+            yield 'token', {'text': response}
+        else:
+            parts = []
+            try:
+                with timings.stage('generate'):
+                    for text in stream_with_llm(plan['prompt']):
+                        parts.append(text)
+                        yield 'token', {'text': text}
+            except LLMStreamError as e:
+                logger.error(f"Stream câu trả lời bị ngắt: {e}")
+                yield 'error', {'error': str(e), 'partial_response': ''.join(parts).strip(),
+                                'timings': timings.as_dict()}
+                return
+            response = ''.join(parts).strip()
+        # Chỉ tới đây khi stream đã trả lời xong: stream bị ngắt (LLMStreamError) hoặc client ngắt kết nối
+        # (GeneratorExit tại yield) đều thoát trước, câu trả lời dở dang không bao giờ vào cache
+        self._remember_response(user_query, self._build_result(user_query, intent, entities, response,
+                                                               plan['relevant_items'], prompt_stats))
+        yield 'done', {'response': response, 'timings': timings.as_dict()}
+
+    def _stream_cached(self, result: Dict[str, Any], timings: RequestTimings) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        yield 'meta', {
+            'query': result['query'],
+            'intent': result['intent'],
+            'entities': result['entities'],
+            'relevant_chunks': result['relevant_chunks'],
+            'total_chunks_found': result['total_chunks_found'],
+            'cache': result['cache'],
+            'prompt_stats': result.get('prompt_stats')
+        }
+        yield 'token', {'text': result['response']}
+        yield 'done', {'response': result['response'], 'timings': timings.as_dict()}
+
+    def _execute_plan(self, plan: Dict[str, Any]) -> str:
+        if plan['prompt'] is not None:
+            return generate_with_llm(plan['prompt'])
+        return plan['response']
+
+    def _route(self, user_query: str, intent: str, entities: Dict,
+               search_results: Optional[List[Dict]] = None) -> Dict[str, Any]:
         if intent == 'greeting':
-            response, relevant_items = self._handle_greeting()
+            return self._handle_greeting()
         elif intent in ['list_by_product_type', 'list_by_brand', 'list_by_attribute']:
-            response, relevant_items = self._handle_list_task(intent, entities)
+            return self._handle_list_task(intent, entities)
         elif intent in ['find_min_attribute', 'find_max_attribute']:
-            response, relevant_items = self._handle_extremum_task(intent, entities)
+            return self._handle_extremum_task(intent, entities)
+        elif intent == 'find_top_k_attribute':
+            return self._handle_top_k_task(entities)
+        elif intent == 'filter_by_attribute_range':
+            return self._handle_range_task(entities)
         elif intent == 'compare_two_products':
-            response, relevant_items = self._handle_comparison_task(entities)
-        else:
-            # Các intent còn lại đều dùng semantic search
-            response, relevant_items = self._handle_semantic_search(user_query, intent, entities)
+            return self._handle_comparison_task(entities)
+        plan = self._handle_attribute_lookup(intent, entities)
+        if plan is not None:
+            return plan
+        # Các intent còn lại đều dùng semantic search
+        return self._handle_semantic_search(user_query, intent, entities, search_results)
+
+    def _is_semantic_intent(self, intent: str, entities: Optional[Dict] = None) -> bool:
+        """Intent được _route xử lý bằng semantic search"""
+        if intent == 'greeting' or intent in STRUCTURED_INTENTS:
+            return False
+        return self._handle_attribute_lookup(intent, entities or {}) is None
 
+    def _build_result(self, user_query: str, intent: str, entities: Dict, response: str, relevant_items: List,
+                      prompt_stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         return {
             'query': user_query,
             'intent': intent,
             'entities': entities,
             'response': response,
             'relevant_chunks': relevant_items,
-            'total_chunks_found': len(relevant_items)
+            'total_chunks_found': len(relevant_items),
+            'prompt_stats': prompt_stats
         }
+
+    def _prompt_stats(self, plan: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Số token (ước lượng) của prompt gửi LLM và của phần context đã ghép, None nếu không gọi LLM.
+        Đồng thời cộng dồn vào thống kê chung (get_metrics)
+        """
+        if plan['prompt'] is None:
+            return None
+        context = plan.get('context') or {}
+        stats = {
+            'prompt_tokens': count_tokens(plan['prompt']),
+            'context_tokens': context.get('tokens'),
+            'context_budget': context.get('budget'),
+            'duplicate_lines': context.get('duplicate_lines', 0),
+            'dropped_lines': context.get('dropped_lines', 0)
+        }
+        with self._prompt_lock:
+            self._prompt_totals['llm_prompts'] += 1
+            for key in ('prompt_tokens', 'context_tokens', 'duplicate_lines', 'dropped_lines'):
+                self._prompt_totals[key] += stats[key] or 0
+        return stats
+
+    def prompt_token_stats(self) -> Dict[str, Any]:
+        """Tổng và trung bình số token prompt/context của các lần gọi LLM sinh câu trả lời"""
+        with self._prompt_lock:
+            stats = dict(self._prompt_totals)
+        count = stats['llm_prompts']
+        stats['mean_prompt_tokens'] = round(stats['prompt_tokens'] / count, 1) if count else 0.0
+        stats['mean_context_tokens'] = round(stats['context_tokens'] / count, 1) if count else 0.0
+        stats['context_budget'] = self.context_packer.token_budget
+        return stats
+
+    def _generate_fused(self, user_query: str):
+        """
+        Pipeline fused: retrieve bằng câu hỏi gốc, sau đó một lần gọi LLM trả về intent, entities và câu trả lời.
+        Intent có cấu trúc (liệt kê, cực trị, so sánh) vẫn chạy đường dữ liệu cục bộ với entities vừa nhận.
+        Trả về None nếu không parse được kết quả, khi đó người gọi quay về luồng hai bước.
+        """
+        packed = self.context_packer.pack(self.vector_db.search(user_query, k=5))
+        results = packed['items']
+        prompt = FUSED_PROMPT.replace("{intent_descriptions}", INTENT_DESCRIPTIONS) \
+            .replace("{context}", packed['context']) \
+            .replace("{user_query}", user_query)
+        content = generate_with_llm(prompt, generation_config={"temperature": 0.1, "responseMimeType": "application/json"})
+        parsed = extract_json_object(content)
+        if not parsed or not parsed.get('intent'):
+            logger.error(f"Không parse được kết quả pipeline fused. Content: {content}")
+            return None
+
+        intent = parsed['intent']
+        entities = parsed.get('entities') or {}
+        self.intent_classifier.record('fused')
+        self.intent_classifier.remember(user_query, {'intent': intent, 'entities': entities})
+
+        answer = (parsed.get('answer') or '').strip()
+        if intent in STRUCTURED_INTENTS or intent == 'greeting' or not answer:
+            plan = self._route(user_query, intent, entities)
+            return self._build_result(user_query, intent, entities, self._execute_plan(plan), plan['relevant_items'],
+                                      self._prompt_stats(plan))
+        return self._build_result(user_query, intent, entities, answer, results,
+                                  self._prompt_stats(self._plan(prompt=prompt, context=packed)))
         
+    def get_metrics(self) -> Dict[str, Any]:
+        """Các chỉ số hoạt động của hệ thống (cache, ...)"""
+        return {
+            'query_embedding_cache': self.vector_db.query_cache.stats(),
+            'query_encoder': self.vector_db.encoder_info(),
+            'response_cache': self.response_cache.stats() if self.response_cache else None,
+            'semantic_cache': self.semantic_cache.stats() if self.semantic_cache else None,
+            'speculative_retrieval': self.speculation_stats(),
+            'prompt_tokens': self.prompt_token_stats(),
+            'query_encoder_batching': self.vector_db.batch_encoder.stats() if self.vector_db.batch_encoder else None,
+            'intent_cache': self.intent_classifier.cache.stats(),
+            'intent_classifier': self.intent_classifier.get_stats(),
+            'llm_http_client': get_http_client().stats(),
+            'process_memory': dict(memory_usage(), pid=os.getpid()),
+            'startup': self.startup_timeline.as_dict()
+        }
+
+    def speculation_stats(self) -> Dict[str, Any]:
+        """Số lần speculative retrieval: đã chạy, lọc được kết quả, phải search lại, không dùng tới (intent không cần search)"""
+        with self._speculation_lock:
+            stats = dict(self._speculation_stats)
+        used = stats['refined'] + stats['fallback']
+        stats['top_n'] = self.speculative_top_n
+        stats['refine_rate'] = stats['refined'] / used if used else 0.0
+        return stats
+
+    def warm_up(self) -> Dict[str, float]:
+        """
+        Chạy thử encode, search (có và không có filter) và phân loại intent cục bộ, không gọi Gemini,
+        để model và dữ liệu được nạp hết trước khi nhận request (và trước khi gunicorn fork worker).
+        Trả về thời gian từng bước (ms).
+        """
+        timings = {}
+        start = time.perf_counter()
+        self.vector_db.encode_queries(["Coca-Cola Original có bao nhiêu calo?"])
+        timings['encode_ms'] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        self.vector_db.search("Thành phần của Coca-Cola", k=5)
+        if self.all_products_data:
+            product_name = self.all_products_data[0].get('product_name')
+            self.vector_db.search(product_name, k=1, metadata_filter={'product_name': product_name, 'chunk_level': 2})
+        timings['search_ms'] = (time.perf_counter() - start) * 1000
+
+        if self.intent_classifier.local_classifier is not None:
+            start = time.perf_counter()
+            self.intent_classifier.local_classifier.score("Xin chào")
+            timings['local_intent_ms'] = (time.perf_counter() - start) * 1000
+        return timings
+
     # --- CÁC HÀM XỬ LÝ TÁC VỤ CHUYÊN BIỆT ---
 
-    def _safe_extract_float(self, value: Any) -> float:
-        """Hàm phụ trợ để trích xuất số float từ các định dạng dữ liệu khác nhau."""
-        if value is None:
-            return float('inf')
-        if isinstance(value, (int, float)):
-            return float(value)
-        s_value = str(value).strip()
-        match = re.search(r'^-?\d+(\.\d+)?', s_value)
-        if match:
-            try:
-                return float(match.group(0))
-            except ValueError:
-                return float('inf')
-        return float('inf')
+    def _plan(self, response: str = None, prompt: str = None, relevant_items: List = None,
+              context: Dict[str, Any] = None) -> Dict[str, Any]:
+        """
+        Kết quả của một hàm xử lý tác vụ: hoặc câu trả lời cố định (response),
+        hoặc prompt cần gửi cho LLM để sinh câu trả lời, kèm các thông tin liên quan
+        và thống kê context đã ghép (ContextPacker.pack)
+        """
+        return {
+            'response': response,
+            'prompt': prompt,
+            'relevant_items': relevant_items or [],
+            'context': context
+        }
+
+    def _templated(self, response: str, prompt: str, relevant_items: List) -> Dict[str, Any]:
+        """Câu trả lời theo mẫu, hoặc prompt để LLM diễn đạt lại nếu response_mode là 'llm'"""
+        if self.response_mode == 'llm':
+            return self._plan(prompt=prompt, relevant_items=relevant_items)
+        return self._plan(response=response, relevant_items=relevant_items)
 
     def _handle_greeting(self):
-        response = "Chào bạn! Tôi là trợ lý ảo của Coca-Cola. Tôi có thể giúp bạn tìm hiểu về các sản phẩm, thành phần, dinh dưỡng và nhiều thông tin khác. Bạn muốn biết gì?"
-        return response, []
+        return self._plan(response=render_greeting())
+
+    def _handle_attribute_lookup(self, intent: str, entities: Dict):
+        """
+        Trả lời theo mẫu câu hỏi tra cứu thuộc tính (ATTRIBUTE_LOOKUP_INTENTS) nêu đúng một sản phẩm tra được
+        trong dữ liệu. None nếu không áp dụng được (response mode "llm", không rõ sản phẩm, dữ liệu thiếu
+        thuộc tính đó), khi đó câu hỏi đi semantic search
+        """
+        if self.response_mode != 'template' or intent not in ATTRIBUTE_LOOKUP_INTENTS:
+            return None
+        product_names = entities.get("product_names") or []
+        if len(product_names) != 1:
+            return None
+        idx = self.product_resolver.resolve(str(product_names[0]))
+        if idx is None:
+            return None
+        product = self.all_products_data[idx]
+        response = render_attribute(intent, product)
+        if response is None:
+            return None
+        return self._plan(response=response, relevant_items=[product])
 
     def _handle_list_task(self, intent: str, entities: Dict):
         attribute = entities.get('attribute', '').lower()
@@ -85,13 +733,8 @@ class RAGSystem:
         filtered_products = []
         # Lọc sản phẩm không đường
         if 'không đường' in attribute:
-            for p in self.all_products_data:
-                try:
-                    sugars_value = p.get('nutrition_facts', {}).get('total_sugars', {}).get('value')
-                    if sugars_value is not None and str(sugars_value).strip().startswith('0'):
-                        filtered_products.append(p)
-                except Exception:
-                    continue
+            zero_sugar = self.nutrition_table.in_range('total_sugars', max_value=0)
+            filtered_products = [self.all_products_data[i] for i in sorted(zero_sugar)]
         elif product_type:
             filtered_products = [p for p in self.all_products_data if p.get('product_type') == product_type]
         elif brand_name:
@@ -99,122 +742,176 @@ class RAGSystem:
         # Có thể thêm các logic lọc khác ở đây nếu cần
 
         if not filtered_products:
-            return "Không tìm thấy sản phẩm phù hợp.", []
+            return self._plan(response="Không tìm thấy sản phẩm phù hợp.")
 
         product_names = [p.get('product_name') for p in filtered_products]
         prompt = f"""Người dùng muốn liệt kê các sản phẩm. Dưới đây là danh sách tìm được:
         {', '.join(product_names)}
 
         Dựa vào danh sách trên, hãy tạo một câu trả lời thân thiện. Nếu danh sách quá dài (hơn 10 sản phẩm), chỉ liệt kê một vài cái tên tiêu biểu và cho biết tổng số sản phẩm tìm thấy."""
-        final_answer = generate_with_llm(prompt)
-        return final_answer, filtered_products
+        return self._templated(render_list(product_names), prompt, filtered_products)
 
     def _handle_extremum_task(self, intent: str, entities: Dict):
         user_attribute = entities.get("attribute", "")
-        key_map = {'calo': 'calories', 'đường': 'total_sugars'}
-        target_key = None
-        for keyword, key in key_map.items():
-            if keyword in user_attribute:
-                target_key = key
-                break
+        target_key = resolve_attribute(user_attribute)
         if not target_key:
-            return f"Xin lỗi, tôi không thể tìm kiếm theo thuộc tính '{user_attribute}'.", []
-        valid_products = []
-        for p in self.all_products_data:
-            val = None
-            if target_key == 'total_sugars':
-                val = p.get('nutrition_facts', {}).get('total_sugars', {}).get('value')
-            else:
-                val = p.get('nutrition_facts', {}).get(target_key)
-            val_float = self._safe_extract_float(val)
-            if val_float != float('inf'):
-                valid_products.append((p, val_float))
-        if not valid_products:
-            return "Không có dữ liệu phù hợp để so sánh.", []
-        if "min" in intent:
-            result_product, value = min(valid_products, key=lambda item: item[1])
-        else:
-            result_product, value = max(valid_products, key=lambda item: item[1])
-        prompt = f"Sản phẩm có lượng {user_attribute} {'thấp nhất' if 'min' in intent else 'cao nhất'} là '{result_product.get('product_name')}' với giá trị {value}."
-        final_answer = generate_with_llm(prompt)
-        return final_answer, [result_product]
+            return self._plan(response=f"Xin lỗi, tôi không thể tìm kiếm theo thuộc tính '{user_attribute}'.")
+        is_min = "min" in intent
+        idx = self.nutrition_table.argmin(target_key) if is_min else self.nutrition_table.argmax(target_key)
+        if idx is None:
+            return self._plan(response="Không có dữ liệu phù hợp để so sánh.")
+        result_product = self.all_products_data[idx]
+        value = format_quantity(self.nutrition_table.value(idx, target_key), self.nutrition_table.units[target_key])
+        prompt = f"Sản phẩm có lượng {user_attribute} {'thấp nhất' if is_min else 'cao nhất'} là '{result_product.get('product_name')}' với giá trị {value}."
+        response = render_extremum(ATTRIBUTE_LABELS.get(target_key, target_key), is_min,
+                                   result_product.get('product_name'), value)
+        return self._templated(response, prompt, [result_product])
+
+    def _handle_top_k_task(self, entities: Dict):
+        user_attribute = entities.get("attribute", "")
+        target_key = resolve_attribute(user_attribute)
+        if not target_key:
+            return self._plan(response=f"Xin lỗi, tôi không thể tìm kiếm theo thuộc tính '{user_attribute}'.")
+        try:
+            k = int(entities.get("k") or 5)
+        except (TypeError, ValueError):
+            k = 5
+        k = max(1, min(k, self.MAX_TOP_K))
+        order = str(entities.get("order") or "").lower()
+        if order not in ("asc", "desc"):
+            # Không có order thì đoán từ cách diễn đạt thuộc tính
+            order = "desc" if any(word in user_attribute.lower() for word in ["nhiều", "cao", "lớn", "most", "highest"]) else "asc"
+        indices = self.nutrition_table.top_k(target_key, k, ascending=(order == "asc"))
+        if not indices:
+            return self._plan(response="Không có dữ liệu phù hợp để so sánh.")
+        unit = self.nutrition_table.units[target_key]
+        products = [self.all_products_data[i] for i in indices]
+        entries = [f"{self.all_products_data[i].get('product_name')}: {format_quantity(self.nutrition_table.value(i, target_key), unit)}"
+                   for i in indices]
+        lines = [f"{rank}. {entry}" for rank, entry in enumerate(entries, 1)]
+        label = ATTRIBUTE_LABELS.get(target_key, target_key)
+        prompt = f"""Người dùng muốn biết {len(indices)} sản phẩm có lượng {label} {'thấp nhất' if order == 'asc' else 'cao nhất'}. Kết quả đã sắp xếp:
+{chr(10).join(lines)}
+
+Dựa vào danh sách trên, hãy tạo một câu trả lời thân thiện, giữ nguyên thứ tự và giá trị."""
+        response = render_top_k(label, order == "asc", entries)
+        return self._templated(response, prompt, products)
+
+    def _handle_range_task(self, entities: Dict):
+        user_attribute = entities.get("attribute", "")
+        target_key = resolve_attribute(user_attribute)
+        if not target_key:
+            return self._plan(response=f"Xin lỗi, tôi không thể tìm kiếm theo thuộc tính '{user_attribute}'.")
+        unit = self.nutrition_table.units[target_key]
+        min_value = parse_quantity(entities.get("min_value"), unit)
+        max_value = parse_quantity(entities.get("max_value"), unit)
+        min_value = None if math.isnan(min_value) else min_value
+        max_value = None if math.isnan(max_value) else max_value
+        if min_value is None and max_value is None:
+            min_value, max_value = parse_range(user_attribute)
+        if min_value is None and max_value is None:
+            return self._plan(response=f"Xin lỗi, tôi không xác định được khoảng giá trị trong '{user_attribute}'.")
+        indices = self.nutrition_table.in_range(target_key, min_value, max_value)
+        if not indices:
+            return self._plan(response="Không tìm thấy sản phẩm phù hợp.")
+        products = [self.all_products_data[i] for i in indices]
+        lines = [f"{self.all_products_data[i].get('product_name')}: {format_quantity(self.nutrition_table.value(i, target_key), unit)}"
+                 for i in indices]
+        label = ATTRIBUTE_LABELS.get(target_key, target_key)
+        bounds = []
+        if min_value is not None:
+            bounds.append(f"từ {format_quantity(min_value, unit)}")
+        if max_value is not None:
+            bounds.append(f"đến {format_quantity(max_value, unit)}")
+        prompt = f"""Người dùng muốn tìm các sản phẩm có lượng {label} {' '.join(bounds)}. Có {len(indices)} sản phẩm phù hợp (sắp xếp tăng dần):
+{chr(10).join(lines)}
+
+Dựa vào danh sách trên, hãy tạo một câu trả lời thân thiện. Nếu danh sách quá dài (hơn 10 sản phẩm), chỉ liệt kê một vài cái tên tiêu biểu và cho biết tổng số sản phẩm tìm thấy."""
+        return self._templated(render_range(label, ' '.join(bounds), lines), prompt, products)
 
     def _handle_comparison_task(self, entities: Dict):
         product_names_query = entities.get("product_names", [])
         if len(product_names_query) < 2:
-            return "Vui lòng cung cấp ít nhất hai sản phẩm để so sánh.", []
+            return self._plan(response="Vui lòng cung cấp ít nhất hai sản phẩm để so sánh.")
         products_to_compare = []
-        found_products_set = set()
+        found_indices = []
         for name_query in product_names_query:
-            best_match = None
-            for p in self.all_products_data:
-                product_name_db = p.get('product_name', '')
-                if product_name_db in found_products_set:
-                    continue
-                if name_query.lower() in product_name_db.lower() or \
-                   all(word in product_name_db.lower() for word in name_query.lower().replace('-', ' ').split()):
-                    best_match = p
-                    break
-            if best_match:
-                products_to_compare.append(best_match)
-                found_products_set.add(best_match['product_name'])
+            idx = self.product_resolver.resolve(name_query, exclude=found_indices)
+            if idx is not None:
+                products_to_compare.append(self.all_products_data[idx])
+                found_indices.append(idx)
         if len(products_to_compare) < 2:
-            return "Không tìm thấy đủ thông tin của cả hai sản phẩm để so sánh.", []
+            return self._plan(response="Không tìm thấy đủ thông tin của ít nhất hai sản phẩm để so sánh.")
+        products_to_compare = products_to_compare[:self.MAX_COMPARE_PRODUCTS]
+        # Lấy chunk tổng hợp của tất cả sản phẩm trong một lần search
+        search_results = self.vector_db.search_batch(
+            [f"Thông tin tổng hợp về {p['product_name']}" for p in products_to_compare],
+            k=1,
+            metadata_filters=[{'product_name': p['product_name'], 'chunk_level': 2} for p in products_to_compare]
+        )
         contexts = []
-        for p in products_to_compare:
-            product_name = p['product_name']
-            results = self.vector_db.search(
-                query=f"Thông tin tổng hợp về {product_name}",
-                k=1,
-                metadata_filter={
-                    'product_name': product_name,
-                    'chunk_level': 2
-                }
-            )
+        for p, results in zip(products_to_compare, search_results):
             if results:
-                contexts.append(results[0]['chunk']['content'])
+                contexts.append(results[0])
             else:
                 content = f"Tên sản phẩm: {p.get('product_name', '')}\n"
                 content += f"Mô tả: {p.get('description', '')}\n"
                 content += f"Thành phần: {p.get('ingredients', [])}\n"
                 content += f"Dinh dưỡng: {p.get('nutrition_facts', {})}\n"
-                contexts.append(content)
-        if not all(contexts):
-            return "Không thể tạo ngữ cảnh để so sánh.", []
-        context_str = "\n\n---\n\n".join(contexts)
-        prompt = f"""Dựa vào thông tin chi tiết của hai sản phẩm sau:
-{context_str}
-Hãy viết một đoạn văn so sánh hai sản phẩm này, tập trung vào những điểm khác biệt chính (ví dụ: calo, đường, caffeine, thành phần chính)."""
-        final_answer = generate_with_llm(prompt)
-        return final_answer, products_to_compare
-
-    def _handle_semantic_search(self, user_query: str, intent: str, entities: Dict):
+                contexts.append({'chunk': {'content': content, 'metadata': {'product_name': p.get('product_name')}}})
+        # Chia đều ngân sách token để sản phẩm nào cũng có mặt trong context
+        packed = self.context_packer.pack(contexts, fair=True)
+        if packed['chunks'] < len(contexts):
+            return self._plan(response="Không thể tạo ngữ cảnh để so sánh.")
+        prompt = f"""Dựa vào thông tin chi tiết của {len(products_to_compare)} sản phẩm sau:
+{packed['context']}
+Hãy viết một đoạn văn so sánh các sản phẩm này, tập trung vào những điểm khác biệt chính (ví dụ: calo, đường, caffeine, thành phần chính)."""
+        return self._plan(prompt=prompt, relevant_items=products_to_compare, context=packed)
+
+    def _semantic_filter(self, intent: str, entities: Dict) -> Dict:
+        """Filter metadata cho semantic search theo intent và entities"""
         metadata_filter = {}
-        product_names = entities.get("product_names")
-        if product_names:
-            # Không filter nghiêm ngặt, ưu tiên sau khi search
-            query_name = product_names[0].lower().replace('®', '')
         attribute = self.intent_classifier.get_attribute_for_intent(intent)
         if attribute:
             metadata_filter['attribute'] = attribute
-        if product_names and not attribute:
+        if entities.get("product_names") and not attribute:
             metadata_filter['chunk_level'] = 2
-        results = self.vector_db.search(user_query, k=10, metadata_filter=metadata_filter)
-        # Ưu tiên chunk khớp product_name
+        return metadata_filter
+
+    def _handle_semantic_search(self, user_query: str, intent: str, entities: Dict,
+                                results: Optional[List[Dict]] = None):
+        """
+        Args:
+            results: Kết quả search (SEMANTIC_SEARCH_K, filter theo _semantic_filter) đã có sẵn, ví dụ từ
+                search_batch của cả lô hoặc từ speculative retrieval
+        """
+        product_names = entities.get("product_names")
+        if results is None:
+            results = self.vector_db.search(user_query, k=self.SEMANTIC_SEARCH_K,
+                                            metadata_filter=self._semantic_filter(intent, entities))
+        # Không filter nghiêm ngặt theo tên, ưu tiên chunk khớp product_name sau khi search
         if product_names and results:
-            query_name_lower = product_names[0].lower().replace('®', '')
+            product_idx = self.product_resolver.resolve(product_names[0])
+            query_name = normalize_name(product_names[0])
             prioritized_results = []
             other_results = []
             for res in results:
-                chunk_product_name = res['chunk']['metadata'].get('product_name', '').lower().replace('®', '')
-                if query_name_lower in chunk_product_name:
+                chunk_product_name = res['chunk']['metadata'].get('product_name', '')
+                if product_idx is not None:
+                    is_match = self.product_resolver.same_product_name(product_idx, chunk_product_name)
+                else:
+                    is_match = query_name in normalize_name(chunk_product_name)
+                if is_match:
                     prioritized_results.append(res)
                 else:
                     other_results.append(res)
             results = (prioritized_results + other_results)[:5]
-        if not results:
-            return "Xin lỗi, tôi không tìm thấy thông tin bạn cần.", []
-        context = "\n\n---\n\n".join([res['chunk']['content'] for res in results])
+        # Bỏ dòng trùng giữa các chunk và giữ context trong ngân sách token
+        packed = self.context_packer.pack(results) if results else None
+        if not results or not packed['items']:
+            return self._plan(response="Xin lỗi, tôi không tìm thấy thông tin bạn cần.")
+        results = packed['items']
+        context = packed['context']
         prompt = f"""Dựa vào các thông tin sau đây:
 --- CONTEXT ---
 {context}
@@ -222,5 +919,13 @@ Hãy viết một đoạn văn so sánh hai sản phẩm này, tập trung vào
 Hãy trả lời thẳng vào câu hỏi của người dùng một cách ngắn gọn, không bình luận thêm về việc thiếu thông tin.
 Câu hỏi: {user_query}
 """
-        final_answer = generate_with_llm(prompt)
-        return final_answer, results
\ No newline at end of file
+        return self._plan(prompt=prompt, relevant_items=results, context=packed)
+
+
+def _capture(fn: Callable, *args) -> Tuple[Any, Optional[Exception]]:
+    """Gọi fn(*args), trả về (kết quả, None) hoặc (None, lỗi) để lỗi của một câu không làm hỏng cả lô"""
+    try:
+        return fn(*args), None
+    except Exception as e:
+        logger.error(f"Lỗi xử lý {getattr(fn, '__name__', fn)}: {e}")
+        return None, e
@@ -0,0 +1,135 @@
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from cache import TTLCache, normalize_query
+from snapshot import snapshot_path
+
+logger = logging.getLogger(__name__)
+
+
+def file_version(path: str) -> Tuple:
+    """Phiên bản của một file/thư mục theo stat (mtime, kích thước), () nếu không tồn tại"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ()
+    return (st.st_mtime_ns, st.st_size)
+
+
+def vector_db_version(index_path: str) -> Tuple:
+    """
+    Phiên bản vector database trên đĩa: manifest của snapshot (được ghi lại mỗi lần build/convert),
+    hoặc file .index/.metadata của định dạng cũ
+    """
+    manifest = os.path.join(snapshot_path(index_path), "manifest.json")
+    if os.path.exists(manifest):
+        return ('snapshot',) + file_version(manifest)
+    return ('legacy',) + file_version(f"{index_path}.index") + file_version(f"{index_path}.metadata")
+
+
+def approx_size(value: Any) -> int:
+    """Kích thước ước lượng (byte) của một kết quả: độ dài JSON UTF-8"""
+    return len(json.dumps(value, ensure_ascii=False, default=str).encode('utf-8'))
+
+
+class DataVersion:
+    """
+    Phiên bản của vector database và các file dữ liệu trên đĩa (theo stat), dùng chung cho các cache
+    câu trả lời. Việc stat file được làm tối đa một lần mỗi check_interval giây.
+
+    Args:
+        index_path: Đường dẫn vector database (không có đuôi)
+        data_files: Các file dữ liệu mà câu trả lời phụ thuộc
+        check_interval: Khoảng thời gian tối thiểu giữa hai lần kiểm tra (giây)
+    """
+
+    def __init__(self, index_path: str, data_files: Sequence[str] = (), check_interval: float = 1.0):
+        self.index_path = index_path
+        self.data_files = list(data_files)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version = self._read()
+        self._checked_at = time.monotonic()
+
+    def _read(self) -> Tuple:
+        return (vector_db_version(self.index_path),) + tuple(file_version(path) for path in self.data_files)
+
+    def current(self) -> Tuple:
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self._version
+        with self._lock:
+            if now - self._checked_at >= self.check_interval:
+                current = self._read()
+                if current != self._version:
+                    logger.info("Vector database hoặc dữ liệu sản phẩm trên đĩa đã thay đổi")
+                    self._version = current
+                self._checked_at = now
+        return self._version
+
+
+class ResponseCache:
+    """
+    Cache toàn bộ kết quả generate_response theo câu hỏi đã chuẩn hoá (LRU + TTL + giới hạn bộ nhớ).
+
+    Mỗi phần tử được gắn phiên bản của vector database và các file dữ liệu (DataVersion). Khi phát hiện
+    phiên bản trên đĩa thay đổi (rebuild index, sửa final_product_data.json), toàn bộ cache bị xoá.
+
+    Args:
+        data_version: Phiên bản dữ liệu mà câu trả lời phụ thuộc
+        max_size: Số câu trả lời tối đa
+        ttl: Thời gian sống (giây), None là không hết hạn
+        max_bytes: Tổng kích thước tối đa (byte, ước lượng theo JSON)
+    """
+
+    def __init__(self, data_version: DataVersion, max_size: int = 1024, ttl: Optional[float] = 3600,
+                 max_bytes: Optional[int] = 64 * 1024 * 1024):
+        self.data_version = data_version
+        self.cache = TTLCache(max_size=max_size, ttl=ttl, max_bytes=max_bytes, sizeof=approx_size)
+        self._lock = threading.Lock()
+        self._version = data_version.current()
+        self.invalidations = 0
+
+    def version(self) -> Tuple:
+        """Phiên bản hiện tại; nếu dữ liệu trên đĩa đã đổi thì xoá cache"""
+        current = self.data_version.current()
+        if current != self._version:
+            with self._lock:
+                if current != self._version:
+                    self.cache.clear()
+                    self.invalidations += 1
+                    self._version = current
+        return current
+
+    def key(self, query: str, variant: str = "") -> str:
+        return f"{variant}\x00{normalize_query(query)}"
+
+    def get(self, query: str, variant: str = "") -> Tuple[Optional[Dict[str, Any]], Optional[float]]:
+        """
+        Kết quả đã cache (bản sao) và tuổi (giây), hoặc (None, None) nếu chưa có/đã mất hiệu lực
+
+        Args:
+            variant: Phần phân biệt thêm trong khoá (ví dụ pipeline mode)
+        """
+        version = self.version()
+        entry = self.cache.get_entry(self.key(query, variant))
+        if entry is None:
+            return None, None
+        (stamp, result), created_at = entry
+        if stamp != version:
+            return None, None
+        return copy.deepcopy(result), time.time() - created_at
+
+    def put(self, query: str, result: Dict[str, Any], variant: str = ""):
+        self.cache.put(self.key(query, variant), (self.version(), copy.deepcopy(result)))
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.cache.stats(), invalidations=self.invalidations)
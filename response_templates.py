@@ -0,0 +1,126 @@
+"""
+Câu trả lời tiếng Việt dựng sẵn theo mẫu cho các intent mà dữ liệu cục bộ đã có đáp án chính xác
+(chào hỏi, liệt kê, cực trị, top-k, khoảng giá trị, tra cứu một thuộc tính của một sản phẩm).
+Không gọi LLM nên trả lời gần như tức thì và không tốn quota Gemini; RESPONSE_MODE=llm để LLM diễn đạt lại.
+"""
+import math
+from typing import Any, Dict, List, Optional
+
+from nutrition_table import NUTRIENT_UNITS, ATTRIBUTE_LABELS, format_quantity, nutrient_raw_value, parse_quantity
+
+RESPONSE_MODES = ["template", "llm"]
+
+# Số sản phẩm tối đa được liệt kê tên trong một câu trả lời, phần còn lại chỉ báo số lượng
+MAX_LISTED_PRODUCTS = 10
+
+# Các intent tra cứu một thuộc tính của một sản phẩm, trả lời được từ dữ liệu gốc
+ATTRIBUTE_LOOKUP_INTENTS = [
+    'get_calories', 'get_sugar_content', 'get_nutrition_facts',
+    'get_ingredients', 'check_caffeine', 'get_available_sizes'
+]
+
+GREETING_RESPONSE = "Chào bạn! Tôi là trợ lý ảo của Coca-Cola. Tôi có thể giúp bạn tìm hiểu về các sản phẩm, thành phần, dinh dưỡng và nhiều thông tin khác. Bạn muốn biết gì?"
+
+# Từ khoá caffeine trong danh sách thành phần (dữ liệu tiếng Anh)
+CAFFEINE_KEYWORDS = ["caffeine"]
+
+
+def _join_names(names: List[str]) -> str:
+    if len(names) <= MAX_LISTED_PRODUCTS:
+        return ", ".join(names)
+    rest = len(names) - MAX_LISTED_PRODUCTS
+    return f"{', '.join(names[:MAX_LISTED_PRODUCTS])} và {rest} sản phẩm khác"
+
+
+def _numbered(lines: List[str]) -> str:
+    shown = lines[:MAX_LISTED_PRODUCTS]
+    text = "\n".join(f"{rank}. {line}" for rank, line in enumerate(shown, 1))
+    if len(lines) > len(shown):
+        text += f"\n... và {len(lines) - len(shown)} sản phẩm khác."
+    return text
+
+
+def render_greeting() -> str:
+    return GREETING_RESPONSE
+
+
+def render_list(product_names: List[str]) -> str:
+    """Danh sách tên sản phẩm, quá MAX_LISTED_PRODUCTS thì chỉ nêu các tên đầu và tổng số"""
+    if len(product_names) == 1:
+        return f"Tôi tìm thấy 1 sản phẩm phù hợp: {product_names[0]}."
+    return f"Tôi tìm thấy {len(product_names)} sản phẩm phù hợp: {_join_names(product_names)}."
+
+
+def render_extremum(label: str, is_min: bool, product_name: str, value: str) -> str:
+    return f"Sản phẩm có lượng {label} {'thấp nhất' if is_min else 'cao nhất'} là {product_name} với {value}."
+
+
+def render_top_k(label: str, ascending: bool, lines: List[str]) -> str:
+    """lines: "tên: giá trị" của từng sản phẩm, đã sắp xếp"""
+    return f"{len(lines)} sản phẩm có lượng {label} {'thấp nhất' if ascending else 'cao nhất'}:\n{_numbered(lines)}"
+
+
+def render_range(label: str, bounds: str, lines: List[str]) -> str:
+    """lines: "tên: giá trị" của từng sản phẩm phù hợp, đã sắp xếp tăng dần"""
+    return f"Có {len(lines)} sản phẩm có lượng {label} {bounds} (sắp xếp tăng dần):\n{_numbered(lines)}"
+
+
+def _nutrient_text(product: Dict, key: str) -> Optional[str]:
+    """Giá trị một chất dinh dưỡng theo đơn vị chuẩn, kèm % nhu cầu hằng ngày nếu có; None nếu thiếu dữ liệu"""
+    value = parse_quantity(nutrient_raw_value(product, key), NUTRIENT_UNITS[key])
+    if math.isnan(value):
+        return None
+    text = format_quantity(value, NUTRIENT_UNITS[key])
+    raw = (product.get('nutrition_facts') or {}).get(key)
+    daily_value = raw.get('daily_value') if isinstance(raw, dict) else None
+    if daily_value and daily_value != '-':
+        text += f" ({daily_value} nhu cầu hằng ngày)"
+    return text
+
+
+def _serving(product: Dict) -> str:
+    serving_size = (product.get('nutrition_facts') or {}).get('serving_size')
+    return f" trong một khẩu phần {serving_size}" if serving_size else ""
+
+
+def render_attribute(intent: str, product: Dict) -> Optional[str]:
+    """
+    Câu trả lời cho intent tra cứu thuộc tính (ATTRIBUTE_LOOKUP_INTENTS) của một sản phẩm
+
+    Returns:
+        Câu trả lời, hoặc None nếu dữ liệu sản phẩm không có thuộc tính đó (để người gọi quay về semantic search)
+    """
+    name = product.get('product_name', '')
+    if intent == 'get_calories':
+        value = _nutrient_text(product, 'calories')
+        return f"{name} cung cấp {value}{_serving(product)}." if value is not None else None
+    if intent == 'get_sugar_content':
+        value = _nutrient_text(product, 'total_sugars')
+        return f"{name} chứa {value} đường{_serving(product)}." if value is not None else None
+    if intent == 'get_nutrition_facts':
+        lines = []
+        for key in NUTRIENT_UNITS:
+            value = _nutrient_text(product, key)
+            if value is not None:
+                lines.append(f"- {ATTRIBUTE_LABELS[key].capitalize()}: {value}")
+        if not lines:
+            return None
+        return f"Thông tin dinh dưỡng của {name}{_serving(product)}:\n" + "\n".join(lines)
+    ingredients: List[Any] = product.get('ingredients') or []
+    if intent == 'get_ingredients':
+        if not ingredients:
+            return None
+        return f"Thành phần của {name}: {', '.join(str(i) for i in ingredients)}."
+    if intent == 'check_caffeine':
+        if not ingredients:
+            return None
+        has_caffeine = any(keyword in str(i).lower() for i in ingredients for keyword in CAFFEINE_KEYWORDS)
+        if has_caffeine:
+            return f"Có, {name} có chứa caffeine."
+        return f"Không, theo danh sách thành phần thì {name} không chứa caffeine."
+    if intent == 'get_available_sizes':
+        sizes = product.get('available_sizes') or []
+        if not sizes:
+            return None
+        return f"{name} có các dung tích: {', '.join(str(s) for s in sizes)}."
+    return None
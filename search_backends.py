@@ -0,0 +1,385 @@
+import logging
+import time
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
+
+from lazy_import import lazy_module
+
+# faiss chỉ được import khi thật sự dùng tới (backend NumPy không cần)
+faiss = lazy_module("faiss")
+
+logger = logging.getLogger(__name__)
+
+# Ngưỡng kích thước corpus để tự chọn backend (đo bằng benchmark_search.py, dim 384, 1 CPU):
+# - NumPy và FAISS flat có latency 1 truy vấn gần như nhau (~0.1 ms ở 1k, 2-3.5 ms ở 20k, 8-9 ms ở 50k vectors),
+#   NumPy nhanh hơn 3-5 lần khi truy vấn theo lô (32 câu: 21 so với 60 ms ở 20k, 47 so với 254 ms ở 50k)
+#   và build tức thì, nên FAISS flat không được tự chọn (vẫn dùng được khi chỉ định backend="faiss_flat")
+# - IVF nhanh hơn ~7 lần từ 20k vectors (0.25 ms) nhưng tốn thời gian train và là tìm kiếm xấp xỉ
+# Tới NUMPY_MAX_VECTORS dùng NumPy (chính xác), lớn hơn dùng IVF
+NUMPY_MAX_VECTORS = 50000
+
+# Số điểm train tối đa cho mỗi cluster IVF (lấy mẫu ngẫu nhiên nếu corpus lớn hơn)
+TRAIN_POINTS_PER_CLUSTER = 64
+
+BACKEND_NAMES = ["numpy", "faiss_flat", "faiss_ivf", "faiss_ivfpq", "faiss_hnsw"]
+
+# Tham số lúc search của từng loại index xấp xỉ và các giá trị được thử khi tự tune
+SEARCH_PARAM_GRID = {
+    'nprobe': [1, 2, 4, 8, 16, 32, 64, 128, 256],
+    'ef_search': [8, 16, 32, 64, 128, 256, 512]
+}
+
+# Tên index_type cũ của build_index -> backend tương ứng
+INDEX_TYPE_ALIASES = {
+    "IndexFlatL2": "faiss_flat",
+    "IndexFlatIP": "faiss_flat",
+    "IndexIVFFlat": "faiss_ivf",
+    "IndexIVFPQ": "faiss_ivfpq",
+    "IndexHNSWFlat": "faiss_hnsw"
+}
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    """Bản sao float32 liên tục của vectors, mỗi dòng đã chuẩn hoá L2 (để inner product = cosine)"""
+    vectors = np.array(vectors, dtype=np.float32, copy=True, order='C')
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return vectors
+
+
+def select_backend(n_vectors: int) -> str:
+    """Chọn backend theo kích thước corpus"""
+    if n_vectors <= NUMPY_MAX_VECTORS:
+        return "numpy"
+    return "faiss_ivf"
+
+
+def default_nlist(n_vectors: int) -> int:
+    """Số cluster IVF theo kích thước corpus (~4*sqrt(n)), đảm bảo mỗi cluster có đủ điểm để train"""
+    nlist = int(4 * np.sqrt(max(n_vectors, 1)))
+    return max(1, min(nlist, n_vectors // 39))
+
+
+def parse_search_params(text: Optional[str]) -> Dict[str, int]:
+    """Đọc tham số search dạng "nprobe=16,ef_search=64" (ví dụ từ biến môi trường)"""
+    params = {}
+    for item in (text or '').split(','):
+        if '=' not in item:
+            continue
+        key, value = item.split('=', 1)
+        params[key.strip()] = int(value)
+    return params
+
+
+def _top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """k cột có điểm cao nhất của mỗi dòng (argpartition rồi chỉ sắp xếp k phần tử), điểm giảm dần"""
+    n = scores.shape[1]
+    k = min(k, n)
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.float32), empty.astype(np.int64)
+    if k < n:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(n), (scores.shape[0], 1))
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return (np.take_along_axis(top_scores, order, axis=1).astype(np.float32),
+            np.take_along_axis(top, order, axis=1).astype(np.int64))
+
+
+class SearchBackend:
+    """
+    Backend tìm kiếm trên các vector đã chuẩn hoá L2, điểm là inner product (cosine similarity, càng cao càng giống).
+    Các backend con chỉ khác nhau ở cách tìm kiếm trên toàn bộ corpus.
+    """
+
+    name = ""
+
+    @property
+    def ntotal(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def dimension(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """Ma trận vector (ntotal, dimension) đã chuẩn hoá, dùng cho tìm kiếm trên tập con"""
+        raise NotImplementedError
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Trả về (scores, indices) shape (n_queries, k), chỉ số -1 là không có kết quả"""
+        raise NotImplementedError
+
+    def search_subset(self, queries: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Tìm kiếm chính xác chỉ trong các vector có chỉ số ids, chi phí tỉ lệ với len(ids)"""
+        if ids.size == 0:
+            empty = np.empty((queries.shape[0], 0))
+            return empty.astype(np.float32), empty.astype(np.int64)
+        scores, positions = _top_k(queries @ self.vectors[ids].T, k)
+        return scores, ids[positions]
+
+    def to_faiss(self) -> "faiss.Index":
+        """FAISS index tương ứng để lưu ra file"""
+        raise NotImplementedError
+
+    def search_params(self) -> Dict[str, int]:
+        """Tham số lúc search hiện tại (rỗng với backend chính xác)"""
+        return {}
+
+    def set_search_params(self, **params) -> Dict[str, int]:
+        """Đặt tham số lúc search (nprobe cho IVF, ef_search cho HNSW), bỏ qua tham số không áp dụng được"""
+        return {}
+
+    def describe(self) -> Dict[str, Any]:
+        info = {
+            'backend': self.name,
+            'metric': 'inner_product',
+            'total_vectors': self.ntotal,
+            'dimension': self.dimension
+        }
+        info.update(self.search_params())
+        return info
+
+
+class NumpyBackend(SearchBackend):
+    """Tìm kiếm chính xác bằng một phép nhân ma trận + argpartition, nhanh nhất với corpus nhỏ"""
+
+    name = "numpy"
+
+    def __init__(self, vectors: np.ndarray):
+        self._vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+    @property
+    def ntotal(self) -> int:
+        return self._vectors.shape[0]
+
+    @property
+    def dimension(self) -> int:
+        return self._vectors.shape[1]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return _top_k(queries @ self._vectors.T, k)
+
+    def to_faiss(self) -> "faiss.Index":
+        index = faiss.IndexFlatIP(self.dimension)
+        index.add(self._vectors)
+        return index
+
+
+class FaissBackend(SearchBackend):
+    """Bọc một FAISS index dùng metric inner product (flat, IVF, ...)"""
+
+    def __init__(self, index: "faiss.Index", name: str, vectors: Optional[np.ndarray] = None):
+        """
+        Args:
+            index: FAISS index dùng METRIC_INNER_PRODUCT
+            name: Tên backend
+            vectors: Ma trận vector đã có sẵn (ví dụ memory-mapped từ snapshot), None là lấy lại từ index khi cần
+        """
+        if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            raise ValueError("FaissBackend cần index dùng METRIC_INNER_PRODUCT")
+        self.index = index
+        self.name = name
+        self._vectors = vectors
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def dimension(self) -> int:
+        return self.index.d
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            if isinstance(self.index, faiss.IndexFlat):
+                # Đọc thẳng bộ nhớ của index, không tạo bản sao
+                self._vectors = faiss.rev_swig_ptr(self.index.get_xb(), self.ntotal * self.dimension) \
+                    .reshape(self.ntotal, self.dimension)
+            else:
+                ivf = faiss.try_extract_index_ivf(self.index)
+                if ivf is not None:
+                    ivf.make_direct_map()
+                self._vectors = self.index.reconstruct_n(0, self.ntotal)
+        return self._vectors
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self.index.search(np.ascontiguousarray(queries, dtype=np.float32), min(k, self.ntotal))
+
+    def to_faiss(self) -> "faiss.Index":
+        return self.index
+
+    def search_params(self) -> Dict[str, int]:
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            return {'nlist': ivf.nlist, 'nprobe': ivf.nprobe}
+        if isinstance(self.index, faiss.IndexHNSW):
+            return {'hnsw_m': self.index.hnsw.nb_neighbors(1), 'ef_construction': self.index.hnsw.efConstruction,
+                    'ef_search': self.index.hnsw.efSearch}
+        return {}
+
+    def set_search_params(self, **params) -> Dict[str, int]:
+        applied = {}
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None and params.get('nprobe'):
+            ivf.nprobe = min(int(params['nprobe']), ivf.nlist)
+            applied['nprobe'] = ivf.nprobe
+        if isinstance(self.index, faiss.IndexHNSW) and params.get('ef_search'):
+            self.index.hnsw.efSearch = int(params['ef_search'])
+            applied['ef_search'] = self.index.hnsw.efSearch
+        return applied
+
+    def describe(self) -> Dict[str, Any]:
+        info = super().describe()
+        info['index_type'] = type(self.index).__name__
+        return info
+
+
+def build_backend(vectors: np.ndarray, backend: str = "auto", nlist: Optional[int] = None,
+                  nprobe: Optional[int] = None, m: int = 8, bits: int = 8,
+                  hnsw_m: int = 32, ef_construction: int = 40, ef_search: int = 64) -> SearchBackend:
+    """
+    Tạo backend từ các vector đã chuẩn hoá L2
+
+    Args:
+        vectors: Ma trận (n, dim) đã chuẩn hoá (xem normalize_vectors)
+        backend: "auto", một trong BACKEND_NAMES hoặc tên index_type cũ ("IndexFlatL2", "IndexIVFFlat", ...)
+        nlist: Số cluster cho IVF, None là tự tính theo kích thước corpus
+        nprobe: Số cluster được duyệt khi search IVF, None là nlist / 8
+        m: Số sub-vectors cho PQ
+        bits: Số bits cho PQ
+        hnsw_m: Số láng giềng mỗi node của đồ thị HNSW
+        ef_construction: Độ rộng tìm kiếm khi xây đồ thị HNSW
+        ef_search: Độ rộng tìm kiếm khi search HNSW
+    """
+    n_vectors, dimension = vectors.shape
+    backend = INDEX_TYPE_ALIASES.get(backend, backend)
+    if backend == "auto":
+        backend = select_backend(n_vectors)
+    if backend == "numpy":
+        return NumpyBackend(vectors)
+    if backend == "faiss_flat":
+        index = faiss.IndexFlatIP(dimension)
+        index.add(vectors)
+        return FaissBackend(index, backend)
+    if backend in ("faiss_ivf", "faiss_ivfpq"):
+        nlist = nlist or default_nlist(n_vectors)
+        quantizer = faiss.IndexFlatIP(dimension)
+        if backend == "faiss_ivf":
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, m, bits, faiss.METRIC_INNER_PRODUCT)
+        train_size = nlist * TRAIN_POINTS_PER_CLUSTER
+        if n_vectors > train_size:
+            sample = np.random.default_rng(0).choice(n_vectors, train_size, replace=False)
+            index.train(vectors[np.sort(sample)])
+        else:
+            index.train(vectors)
+        index.add(vectors)
+        index.nprobe = min(nprobe or max(1, nlist // 8), nlist)
+        return FaissBackend(index, backend)
+    if backend == "faiss_hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        index.hnsw.efSearch = ef_search
+        index.add(vectors)
+        return FaissBackend(index, backend)
+    raise ValueError(f"Không hỗ trợ backend: {backend}")
+
+
+def backend_from_faiss(index: "faiss.Index", backend: str = "auto", search_params: Optional[Dict[str, int]] = None,
+                       **build_params) -> SearchBackend:
+    """
+    Tạo backend từ FAISS index đã load.
+    Index L2 cũ (lưu vector chưa chuẩn hoá) được chuyển đổi: lấy lại vector, chuẩn hoá rồi build backend mới.
+
+    Args:
+        index: FAISS index đọc từ file
+        backend: Backend mong muốn, "auto" là giữ index xấp xỉ đã lưu hoặc chọn theo kích thước corpus
+        search_params: Tham số lúc search ghi đè giá trị lưu trong file (nprobe, ef_search)
+        build_params: Tham số build_backend khi phải build lại
+    """
+    wanted = INDEX_TYPE_ALIASES.get(backend, backend)
+    if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+        logger.info(f"Chuyển đổi {type(index).__name__} (L2) sang backend inner product")
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.make_direct_map()
+        result = build_backend(normalize_vectors(index.reconstruct_n(0, index.ntotal)), wanted, **build_params)
+    elif isinstance(index, faiss.IndexFlat):
+        if wanted == "auto":
+            wanted = select_backend(index.ntotal)
+        if wanted == "faiss_flat":
+            result = FaissBackend(index, "faiss_flat")
+        elif wanted == "numpy":
+            result = NumpyBackend(index.reconstruct_n(0, index.ntotal))
+        else:
+            result = build_backend(index.reconstruct_n(0, index.ntotal), wanted, **build_params)
+    else:
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            name = "faiss_ivfpq" if isinstance(ivf, faiss.IndexIVFPQ) else "faiss_ivf"
+        elif isinstance(index, faiss.IndexHNSW):
+            name = "faiss_hnsw"
+        else:
+            name = type(index).__name__
+        result = FaissBackend(index, name)
+        if wanted not in ("auto", name):
+            result = build_backend(result.vectors, wanted, **build_params)
+    if search_params:
+        result.set_search_params(**search_params)
+    return result
+
+
+def tune_search_params(backend: SearchBackend, queries: np.ndarray, k: int = 5, target_recall: float = 0.95,
+                       grid: Optional[Dict[str, List[int]]] = None, repeat: int = 3) -> Dict[str, Any]:
+    """
+    Thử các tham số lúc search của backend xấp xỉ, so với tìm kiếm chính xác trên cùng vectors,
+    rồi đặt tham số nhanh nhất đạt recall@k >= target_recall (không có thì lấy tham số có recall cao nhất).
+
+    Args:
+        backend: Backend cần tune (IVF hoặc HNSW); backend chính xác được trả về nguyên trạng
+        queries: Ma trận truy vấn mẫu đã chuẩn hoá
+        k: Số kết quả dùng để tính recall
+        target_recall: Recall@k tối thiểu
+        grid: Giá trị cần thử theo tham số, mặc định SEARCH_PARAM_GRID
+        repeat: Số lần đo latency cho mỗi giá trị
+
+    Returns:
+        {"params", "recall", "latency_ms", "sweep": [...]} với sweep là kết quả của từng giá trị đã thử
+    """
+    grid = grid or SEARCH_PARAM_GRID
+    current = backend.search_params()
+    param = 'nprobe' if 'nprobe' in current else 'ef_search' if 'ef_search' in current else None
+    if param is None:
+        return {'params': {}, 'recall': 1.0, 'latency_ms': None, 'sweep': []}
+    values = [v for v in grid[param] if param != 'nprobe' or v <= current['nlist']]
+
+    exact_indices = NumpyBackend(backend.vectors).search(queries, k)[1]
+    sweep = []
+    for value in values:
+        backend.set_search_params(**{param: value})
+        _, indices = backend.search(queries, k)
+        hits = sum(len(set(row) & set(exact_row)) for row, exact_row in zip(indices, exact_indices))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            backend.search(queries, k)
+        latency_ms = (time.perf_counter() - start) / repeat / len(queries) * 1000
+        sweep.append({'params': {param: value}, 'recall': hits / exact_indices.size, 'latency_ms': latency_ms})
+
+    passing = [item for item in sweep if item['recall'] >= target_recall]
+    best = min(passing, key=lambda item: item['latency_ms']) if passing \
+        else max(sweep, key=lambda item: (item['recall'], -item['latency_ms']))
+    backend.set_search_params(**best['params'])
+    logger.info(f"Tune {backend.name}: chọn {best['params']} (recall@{k}={best['recall']:.3f}, "
+                f"{best['latency_ms']:.3f} ms/truy vấn)")
+    return dict(best, sweep=sweep)
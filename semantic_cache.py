@@ -0,0 +1,153 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+import numpy as np
+
+from response_cache import DataVersion
+
+
+class SemanticAnswerCache:
+    """
+    Cache câu trả lời theo ngữ nghĩa: câu hỏi mới có embedding đủ giống (cosine >= threshold) một câu đã trả lời
+    trong cùng phạm vi (cùng intent và entities) thì dùng lại câu trả lời đó, không gọi LLM.
+
+    Embedding của các câu đã trả lời nằm trong một ma trận NumPy cấp phát sẵn max_size dòng; mỗi phạm vi
+    giữ danh sách dòng của nó nên mỗi lần tra chỉ nhân ma trận trên các dòng cùng phạm vi.
+    Hết chỗ thì loại câu ít dùng nhất (LRU); dữ liệu trên đĩa thay đổi thì xoá toàn bộ.
+
+    Args:
+        threshold: Cosine tối thiểu để dùng lại câu trả lời
+        max_size: Số câu trả lời tối đa
+        ttl: Thời gian sống (giây), None là không hết hạn
+        data_version: Phiên bản vector database/dữ liệu sản phẩm, đổi thì cache bị xoá
+    """
+
+    # Câu mới giống một câu đã có trong cùng phạm vi tới mức này thì ghi đè thay vì thêm dòng mới
+    DUPLICATE_THRESHOLD = 0.995
+
+    def __init__(self, threshold: float = 0.88, max_size: int = 2048, ttl: Optional[float] = 24 * 3600,
+                 data_version: Optional[DataVersion] = None):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data_version = data_version
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None
+        self._entries: List[Optional[Tuple[str, str, Dict[str, Any], float]]] = [None] * max_size
+        self._scope_rows: Dict[str, Set[int]] = {}
+        self._lru: "OrderedDict[int, None]" = OrderedDict()
+        self._free = list(range(max_size - 1, -1, -1))
+        self._version = data_version.current() if data_version else None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_version(self):
+        if self.data_version is None:
+            return
+        current = self.data_version.current()
+        if current != self._version:
+            self._clear()
+            self.invalidations += 1
+            self._version = current
+
+    def _clear(self):
+        self._entries = [None] * self.max_size
+        self._scope_rows = {}
+        self._lru.clear()
+        self._free = list(range(self.max_size - 1, -1, -1))
+
+    def _remove(self, row: int):
+        scope = self._entries[row][0]
+        self._entries[row] = None
+        rows = self._scope_rows.get(scope)
+        if rows is not None:
+            rows.discard(row)
+            if not rows:
+                del self._scope_rows[scope]
+        self._lru.pop(row, None)
+        self._free.append(row)
+
+    def _evict_expired(self, scope: str):
+        """Xoá các câu trả lời đã hết hạn trong phạm vi scope, để chúng không che mất câu còn hạn khi so khớp"""
+        if not self.ttl:
+            return
+        now = time.time()
+        for row in list(self._scope_rows.get(scope, ())):
+            if now - self._entries[row][3] > self.ttl:
+                self._remove(row)
+
+    def _best_match(self, embedding: np.ndarray, scope: str) -> Tuple[Optional[int], float]:
+        self._evict_expired(scope)
+        rows = self._scope_rows.get(scope)
+        if not rows:
+            return None, 0.0
+        rows = np.fromiter(rows, dtype=np.int64, count=len(rows))
+        similarities = self._vectors[rows] @ embedding
+        best = int(np.argmax(similarities))
+        return int(rows[best]), float(similarities[best])
+
+    def lookup(self, embedding: np.ndarray, scope: str) -> Optional[Dict[str, Any]]:
+        """
+        Câu trả lời đã cache cho câu hỏi có embedding (đã chuẩn hoá L2) trong phạm vi scope
+
+        Returns:
+            {'result': bản sao kết quả, 'similarity', 'matched_query', 'age_seconds'} hoặc None
+        """
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            self._check_version()
+            row, similarity = self._best_match(embedding, scope)
+            if row is None or similarity < self.threshold:
+                self.misses += 1
+                return None
+            _, query, result, created_at = self._entries[row]
+            age = time.time() - created_at
+            self._lru.move_to_end(row)
+            self.hits += 1
+            return {'result': copy.deepcopy(result), 'similarity': similarity,
+                    'matched_query': query, 'age_seconds': age}
+
+    def put(self, embedding: np.ndarray, scope: str, query: str, result: Dict[str, Any]):
+        if self.max_size <= 0:
+            return
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._check_version()
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_size, embedding.shape[0]), dtype=np.float32)
+            row, similarity = self._best_match(embedding, scope)
+            if row is None or similarity < self.DUPLICATE_THRESHOLD:
+                if not self._free:
+                    self._remove(next(iter(self._lru)))
+                    self.evictions += 1
+                row = self._free.pop()
+            self._vectors[row] = embedding
+            self._entries[row] = (scope, query, copy.deepcopy(result), time.time())
+            self._scope_rows.setdefault(scope, set()).add(row)
+            self._lru[row] = None
+            self._lru.move_to_end(row)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._lru),
+            'max_size': self.max_size,
+            'threshold': self.threshold,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
@@ -0,0 +1,303 @@
+"""
+Định dạng snapshot của vector database, thay cho file .metadata (pickle).
+
+Một snapshot là thư mục gồm:
+- manifest.json: phiên bản định dạng, số chunk, số chiều, backend, từ điển giá trị metadata
+- vectors.npy: ma trận vector float32 đã chuẩn hoá L2
+- text.bin + text_offsets.npy: nội dung các chunk (UTF-8) nối liền và bảng offset (n + 1 phần tử)
+- meta_<i>.npy: mã int32 của trường metadata thứ i theo từng chunk (-1 là không có), tên trường và giá trị nằm trong manifest
+- line_tokens.npy + line_token_offsets.npy: số token ước lượng của từng dòng trong các chunk (context_packer.py),
+  nối liền và bảng offset theo chunk; snapshot cũ không có hoặc khác cách ước lượng thì tính lại khi cần
+- index.faiss: FAISS index (chỉ với backend xấp xỉ IVF/HNSW)
+
+Mọi mảng đều được mở bằng memory-map nên các worker dùng chung page cache của OS
+và chunk chỉ được dựng thành dict khi được truy cập.
+
+Chuyển đổi một lần từ định dạng cũ:
+    python snapshot.py vector_db/coca_cola_index
+"""
+import json
+import os
+import shutil
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+from context_packer import TOKEN_ESTIMATOR, line_token_counts
+from lazy_import import lazy_module
+from search_backends import SearchBackend, FaissBackend, build_backend, backend_from_faiss
+
+faiss = lazy_module("faiss")
+
+SNAPSHOT_FORMAT = "coca-cola-rag-snapshot"
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_path(filepath: str) -> str:
+    """Thư mục snapshot tương ứng với đường dẫn index (không có đuôi)"""
+    return f"{filepath}.snapshot"
+
+
+def snapshot_exists(filepath: str) -> bool:
+    return os.path.exists(os.path.join(snapshot_path(filepath), "manifest.json"))
+
+
+class ChunkTexts(Sequence):
+    """Nội dung chunk đọc từ blob UTF-8 memory-mapped theo bảng offset"""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        start, end = int(self._offsets[idx]), int(self._offsets[idx + 1])
+        return self._blob[start:end].tobytes().decode('utf-8')
+
+
+class ChunkLineTokens(Sequence):
+    """Số token từng dòng của chunk đọc từ mảng int32 memory-mapped theo bảng offset"""
+
+    def __init__(self, counts: np.ndarray, offsets: np.ndarray):
+        self._counts = counts
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return self._counts[int(self._offsets[idx]):int(self._offsets[idx + 1])]
+
+
+class ColumnarMetadata(Sequence):
+    """
+    Metadata của chunk lưu theo cột: mỗi trường là một mảng mã int32 và một danh sách giá trị.
+    Truy cập theo chỉ số trả về dict như metadata gốc.
+    """
+
+    def __init__(self, codes: Dict[str, np.ndarray], values: Dict[str, List[Any]], count: int):
+        self.codes = codes
+        self.values = values
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError(idx)
+        metadata = {}
+        for field, codes in self.codes.items():
+            code = int(codes[idx])
+            if code >= 0:
+                metadata[field] = self.values[field][code]
+        return metadata
+
+    def inverted_index(self) -> Dict[str, Dict[Any, np.ndarray]]:
+        """trường -> giá trị -> chỉ số chunk (đã sắp xếp), tính trực tiếp từ các cột mã"""
+        index = {}
+        for field, codes in self.codes.items():
+            order = np.argsort(codes, kind='stable')
+            counts = np.bincount(codes[codes >= 0], minlength=len(self.values[field]))
+            start = int(np.count_nonzero(codes < 0))
+            field_index = {}
+            for code, value in enumerate(self.values[field]):
+                end = start + int(counts[code])
+                try:
+                    field_index[value] = order[start:end].astype(np.int64)
+                except TypeError:
+                    pass
+                start = end
+            index[field] = field_index
+        return index
+
+
+class LazyChunks(Sequence):
+    """Danh sách chunk {"content", "metadata"} dựng khi truy cập từ ChunkTexts và ColumnarMetadata"""
+
+    def __init__(self, texts: ChunkTexts, metadata: ColumnarMetadata):
+        self.texts = texts
+        self.metadata = metadata
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        return {'content': self.texts[idx], 'metadata': self.metadata[idx]}
+
+
+def _encode_metadata(chunk_metadata: Sequence[Dict]) -> Tuple[Dict[str, np.ndarray], Dict[str, List[Any]]]:
+    fields: List[str] = []
+    for metadata in chunk_metadata:
+        for field in metadata:
+            if field not in fields:
+                fields.append(field)
+    codes = {field: np.full(len(chunk_metadata), -1, dtype=np.int32) for field in fields}
+    values: Dict[str, List[Any]] = {field: [] for field in fields}
+    lookup: Dict[str, Dict[str, int]] = {field: {} for field in fields}
+    for idx, metadata in enumerate(chunk_metadata):
+        for field, value in metadata.items():
+            # Khoá theo JSON để phân biệt 1 và "1" và hỗ trợ giá trị list/dict
+            key = json.dumps(value, ensure_ascii=False, sort_keys=True)
+            code = lookup[field].get(key)
+            if code is None:
+                code = lookup[field][key] = len(values[field])
+                values[field].append(value)
+            codes[field][idx] = code
+    return codes, values
+
+
+def write_snapshot(filepath: str, backend: SearchBackend, chunks: Sequence[Dict],
+                   chunk_metadata: Optional[Sequence[Dict]] = None) -> str:
+    """
+    Ghi snapshot của vector database ra thư mục {filepath}.snapshot (thay thế snapshot cũ nếu có)
+
+    Args:
+        filepath: Đường dẫn index (không có đuôi)
+        backend: Backend tìm kiếm đã build
+        chunks: Danh sách chunk {"content", "metadata"}
+        chunk_metadata: Metadata của từng chunk, mặc định lấy từ chunks
+    """
+    if chunk_metadata is None:
+        chunk_metadata = [chunk.get('metadata', {}) for chunk in chunks]
+    if len(chunks) != backend.ntotal or len(chunk_metadata) != backend.ntotal:
+        raise ValueError("Số chunk, số metadata và số vector phải bằng nhau")
+
+    target = snapshot_path(filepath)
+    tmp_dir = f"{target}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    np.save(os.path.join(tmp_dir, "vectors.npy"), np.ascontiguousarray(backend.vectors, dtype=np.float32))
+
+    encoded = [chunk['content'].encode('utf-8') for chunk in chunks]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(text) for text in encoded])
+    with open(os.path.join(tmp_dir, "text.bin"), 'wb') as f:
+        for text in encoded:
+            f.write(text)
+    np.save(os.path.join(tmp_dir, "text_offsets.npy"), offsets)
+
+    line_counts = [line_token_counts(chunk['content']) for chunk in chunks]
+    line_offsets = np.zeros(len(line_counts) + 1, dtype=np.int64)
+    line_offsets[1:] = np.cumsum([len(counts) for counts in line_counts])
+    np.save(os.path.join(tmp_dir, "line_tokens.npy"),
+            np.asarray([count for counts in line_counts for count in counts], dtype=np.int32))
+    np.save(os.path.join(tmp_dir, "line_token_offsets.npy"), line_offsets)
+
+    codes, values = _encode_metadata(chunk_metadata)
+    for i, field_codes in enumerate(codes.values()):
+        np.save(os.path.join(tmp_dir, f"meta_{i}.npy"), field_codes)
+
+    has_index = backend.name not in ("numpy", "faiss_flat")
+    if has_index:
+        faiss.write_index(backend.to_faiss(), os.path.join(tmp_dir, "index.faiss"))
+
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'created_at': time.time(),
+        'count': backend.ntotal,
+        'dimension': backend.dimension,
+        'metric': 'inner_product',
+        'backend': backend.name,
+        'search_params': backend.search_params(),
+        'has_index': has_index,
+        'token_estimator': TOKEN_ESTIMATOR,
+        'metadata_fields': [{'name': field, 'file': f"meta_{i}.npy", 'values': values[field]}
+                            for i, field in enumerate(codes)]
+    }
+    with open(os.path.join(tmp_dir, "manifest.json"), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    # Đổi tên thư mục: snapshot cũ chỉ bị xoá sau khi snapshot mới đã vào đúng chỗ
+    old_dir = f"{target}.{os.getpid()}.old"
+    if os.path.exists(target):
+        os.replace(target, old_dir)
+    os.replace(tmp_dir, target)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    return target
+
+
+class Snapshot:
+    """Snapshot đã mở: vectors, chunks và metadata đều memory-mapped"""
+
+    def __init__(self, filepath: str):
+        self.path = snapshot_path(filepath)
+        with open(os.path.join(self.path, "manifest.json"), 'r', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f"{self.path} không phải snapshot vector database")
+        if self.manifest.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"Không hỗ trợ snapshot phiên bản {self.manifest.get('version')}")
+        count = self.manifest['count']
+
+        self.vectors = np.load(os.path.join(self.path, "vectors.npy"), mmap_mode='r')
+        offsets = np.load(os.path.join(self.path, "text_offsets.npy"), mmap_mode='r')
+        text_file = os.path.join(self.path, "text.bin")
+        blob = np.memmap(text_file, dtype=np.uint8, mode='r') if os.path.getsize(text_file) \
+            else np.zeros(0, dtype=np.uint8)
+        texts = ChunkTexts(blob, offsets)
+
+        codes, values = {}, {}
+        for field in self.manifest['metadata_fields']:
+            codes[field['name']] = np.load(os.path.join(self.path, field['file']), mmap_mode='r')
+            values[field['name']] = field['values']
+        self.chunk_metadata = ColumnarMetadata(codes, values, count)
+        self.chunks = LazyChunks(texts, self.chunk_metadata)
+
+        self.line_tokens: Optional[ChunkLineTokens] = None
+        if self.manifest.get('token_estimator') == TOKEN_ESTIMATOR:
+            self.line_tokens = ChunkLineTokens(
+                np.load(os.path.join(self.path, "line_tokens.npy"), mmap_mode='r'),
+                np.load(os.path.join(self.path, "line_token_offsets.npy"), mmap_mode='r')
+            )
+
+    def backend(self, backend: str = "auto", search_params: Optional[Dict[str, int]] = None) -> SearchBackend:
+        """
+        Backend tìm kiếm trên vectors của snapshot. Backend NumPy dùng thẳng vùng nhớ memory-mapped;
+        index xấp xỉ đã lưu được đọc lại thay vì build lại.
+        """
+        saved = self.manifest.get('backend')
+        if self.manifest.get('has_index') and backend in ("auto", saved):
+            index = faiss.read_index(os.path.join(self.path, "index.faiss"))
+            result = FaissBackend(index, saved, vectors=self.vectors)
+            if search_params:
+                result.set_search_params(**search_params)
+            return result
+        result = build_backend(self.vectors, backend)
+        if search_params:
+            result.set_search_params(**search_params)
+        return result
+
+
+def convert_legacy(filepath: str) -> str:
+    """Chuyển vector database định dạng cũ ({filepath}.index + {filepath}.metadata pickle) sang snapshot"""
+    import pickle
+
+    with open(f"{filepath}.metadata", 'rb') as f:
+        metadata = pickle.load(f)
+    chunks = metadata['chunks']
+    chunk_metadata = metadata.get('chunk_metadata') or [chunk.get('metadata', {}) for chunk in chunks]
+    backend = backend_from_faiss(faiss.read_index(f"{filepath}.index"))
+    return write_snapshot(filepath, backend, chunks, chunk_metadata)
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:] or ["vector_db/coca_cola_index"]:
+        print(f"Đã chuyển {path} sang snapshot {convert_legacy(path)}")
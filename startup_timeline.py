@@ -0,0 +1,84 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimeline:
+    """
+    Ghi thời gian từng bước khởi động (import, load model, load index, warm-up, ...)
+    để biết thời gian khởi động tốn vào đâu
+
+    Args:
+        started_at: Mốc bắt đầu (time.perf_counter()), mặc định là lúc tạo timeline
+    """
+
+    def __init__(self, started_at: Optional[float] = None):
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self._stages: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+        self.finished_at: Optional[float] = None
+
+    def record(self, name: str, duration_ms: float):
+        with self._lock:
+            self._stages.append((name, duration_ms))
+        logger.info(f"[startup] {name}: {duration_ms:.1f} ms")
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+        logger.info("[startup] " + self.summary())
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {name: round(duration_ms, 1) for name, duration_ms in self._stages}
+        end = self.finished_at
+        return {
+            'stages_ms': stages,
+            'total_ms': round(((end or time.perf_counter()) - self.started_at) * 1000, 1),
+            'finished': end is not None
+        }
+
+    def summary(self) -> str:
+        info = self.as_dict()
+        stages = ", ".join(f"{name}={duration:.0f}ms" for name, duration in info['stages_ms'].items())
+        return f"Khởi động {info['total_ms']:.0f} ms ({stages})"
+
+
+class RequestTimings:
+    """
+    Thời gian từng bước xử lý một request (ms). Bước chạy song song với bước khác (ví dụ retrieve
+    trong lúc chờ Gemini phân loại intent) vẫn được ghi riêng, nên tổng các bước có thể lớn hơn total_ms.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.info: Dict[str, Any] = {}
+
+    def record(self, name: str, duration_ms: float):
+        self.stages[name] = self.stages.get(name, 0.0) + duration_ms
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict({
+            'stages_ms': {name: round(duration_ms, 2) for name, duration_ms in self.stages.items()},
+            'total_ms': round((time.perf_counter() - self.started_at) * 1000, 2)
+        }, **self.info)
@@ -0,0 +1,25 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# Các module nằm ở thư mục gốc của repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def bare_rag_system():
+    """RAGSystem không load model/index/dữ liệu, test tự gán các thành phần cần dùng"""
+    from rag_system import RAGSystem
+
+    system = RAGSystem.__new__(RAGSystem)
+    system.pipeline_mode = 'two_stage'
+    system.response_mode = 'llm'
+    system.cache_variant = 'two_stage:llm'
+    system.response_cache = None
+    system.semantic_cache = None
+    system._prompt_lock = threading.Lock()
+    system._prompt_totals = {'llm_prompts': 0, 'prompt_tokens': 0, 'context_tokens': 0,
+                             'duplicate_lines': 0, 'dropped_lines': 0}
+    return system
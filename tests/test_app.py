@@ -0,0 +1,30 @@
+import app as app_module
+
+
+class FakeIntentClassifier:
+    def classify_intent(self, message):
+        return {"intent": "get_calories", "entities": {"product_names": ["Sprite"]}}
+
+    def get_chunk_level_for_intent(self, intent):
+        return 1
+
+
+def test_intent_endpoint_works_before_rag_system_is_ready(monkeypatch):
+    monkeypatch.setattr(app_module, "rag_system", None)
+    monkeypatch.setattr(app_module, "intent_classifier", FakeIntentClassifier())
+
+    response = app_module.app.test_client().post("/api/intent", json={"message": "Sprite có bao nhiêu calo?"})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["intent"] == "get_calories"
+    assert body["chunk_level"] == 1
+
+
+def test_intent_endpoint_reports_missing_classifier(monkeypatch):
+    monkeypatch.setattr(app_module, "rag_system", None)
+    monkeypatch.setattr(app_module, "intent_classifier", None)
+
+    response = app_module.app.test_client().post("/api/intent", json={"message": "Xin chào"})
+
+    assert response.status_code == 503
@@ -0,0 +1,28 @@
+from context_packer import ContextPacker, count_tokens
+
+
+def chunk(product, lines):
+    content = "\n".join([f"Sản phẩm: {product}"] + lines)
+    return {"chunk": {"content": content, "metadata": {"product_name": product}}}
+
+
+def test_fair_pack_gives_unused_share_to_long_chunks():
+    long_lines = [f"- Chất dinh dưỡng {i}: {i} g" for i in range(40)]
+    items = [chunk("Sprite", long_lines)] + [chunk(name, ["- Calo: 0 kcal"]) for name in ["Dasani", "Smartwater"]]
+    packer = ContextPacker(token_budget=200)
+
+    packed = packer.pack(items, fair=True)
+
+    assert packed["chunks"] == 3
+    assert packed["tokens"] <= 200
+    sprite_tokens = count_tokens(packed["context"].split("\n\n---\n\n")[0])
+    # Hai chunk ngắn chỉ cần ~10 token mỗi chunk, phần còn lại của ngân sách thuộc về chunk dài
+    assert sprite_tokens > 200 // 3 * 2
+    assert packed["tokens"] > 200 - count_tokens(long_lines[-1])
+
+
+def test_fair_pack_keeps_every_chunk_when_everything_fits():
+    items = [chunk(name, ["- Calo: 100 kcal", "- Đường: 20 g"]) for name in ["Sprite", "Fanta Orange", "Coca-Cola"]]
+    packed = ContextPacker(token_budget=1000).pack(items, fair=True)
+    assert packed["chunks"] == 3
+    assert packed["dropped_lines"] == 0
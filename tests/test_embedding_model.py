@@ -0,0 +1,50 @@
+import os
+import sys
+import types
+
+import pytest
+
+from vector_database import load_embedding_model
+
+OFFLINE_VARS = ('HF_HUB_OFFLINE', 'TRANSFORMERS_OFFLINE')
+
+
+def install_sentence_transformers(monkeypatch, model_class):
+    module = types.ModuleType("sentence_transformers")
+    module.SentenceTransformer = model_class
+    monkeypatch.setitem(sys.modules, "sentence_transformers", module)
+
+
+@pytest.fixture(autouse=True)
+def online_environment(monkeypatch):
+    for name in OFFLINE_VARS:
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_offline_load_does_not_switch_process_to_offline(monkeypatch):
+    calls = []
+
+    class SentenceTransformer:
+        def __init__(self, model_name, local_files_only=False):
+            calls.append(local_files_only)
+
+    install_sentence_transformers(monkeypatch, SentenceTransformer)
+    load_embedding_model("model", local_files_only=True)
+    load_embedding_model("model", local_files_only=False)
+
+    assert calls == [True, False]
+    assert not any(name in os.environ for name in OFFLINE_VARS)
+
+
+def test_offline_env_is_scoped_for_old_sentence_transformers(monkeypatch):
+    seen = []
+
+    class SentenceTransformer:
+        def __init__(self, model_name):
+            seen.append({name: os.environ.get(name) for name in OFFLINE_VARS})
+
+    install_sentence_transformers(monkeypatch, SentenceTransformer)
+    load_embedding_model("model", local_files_only=True)
+
+    assert seen == [{'HF_HUB_OFFLINE': '1', 'TRANSFORMERS_OFFLINE': '1'}]
+    assert not any(name in os.environ for name in OFFLINE_VARS)
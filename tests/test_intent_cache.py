@@ -0,0 +1,52 @@
+import json
+
+from cache import TTLCache
+from intent_classifier import IntentClassifier, intent_prompt_version
+
+
+def test_save_merge_keeps_entries_of_other_processes(tmp_path):
+    path = str(tmp_path / "intent_cache.json")
+    worker_a = TTLCache(max_size=10, ttl=None)
+    worker_b = TTLCache(max_size=10, ttl=None)
+    worker_a.put("sprite có bao nhiêu calo?", {"intent": "get_calories"})
+    worker_b.put("xin chào", {"intent": "greeting"})
+
+    worker_a.save(path, version="v1", merge=True)
+    worker_b.save(path, version="v1", merge=True)
+
+    restored = TTLCache(max_size=10, ttl=None)
+    assert restored.load(path, version="v1") == 2
+    assert restored.get("sprite có bao nhiêu calo?") == {"intent": "get_calories"}
+    assert restored.get("xin chào") == {"intent": "greeting"}
+
+
+def test_save_merge_ignores_other_versions(tmp_path):
+    path = str(tmp_path / "intent_cache.json")
+    old = TTLCache(max_size=10, ttl=None)
+    old.put("xin chào", {"intent": "greeting"})
+    old.save(path, version="v1")
+
+    current = TTLCache(max_size=10, ttl=None)
+    current.put("sprite có bao nhiêu calo?", {"intent": "get_calories"})
+    current.save(path, version="v2", merge=True)
+
+    with open(path, encoding="utf-8") as f:
+        assert [entry[0] for entry in json.load(f)["entries"]] == ["sprite có bao nhiêu calo?"]
+
+
+def test_remember_batches_writes(tmp_path):
+    path = str(tmp_path / "intent_cache.json")
+    classifier = IntentClassifier(cache_path=path, save_interval=60)
+    classifier.remember("xin chào", {"intent": "greeting", "entities": {}})
+    classifier.remember("hello", {"intent": "greeting", "entities": {}})
+    assert not (tmp_path / "intent_cache.json").exists()
+
+    classifier.flush_cache()
+    restored = IntentClassifier(cache_path=path, save_interval=0)
+    assert restored.lookup("hello") == {"intent": "greeting", "entities": {}}
+
+
+def test_cache_version_depends_on_prompt_mode():
+    versions = {intent_prompt_version("few_shot"), intent_prompt_version("structured"),
+                intent_prompt_version("few_shot", fused_prompt="fused prompt")}
+    assert len(versions) == 3
@@ -0,0 +1,47 @@
+import json
+import os
+
+import numpy as np
+
+from local_intent_classifier import LocalIntentClassifier
+from product_resolver import ProductNameResolver
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "final_product_data.json")
+
+
+class FakeEncoder:
+    def encode(self, texts):
+        return np.random.default_rng(0).normal(size=(len(texts), 8)).astype(np.float32)
+
+
+class FakeVectorDB:
+    query_encoder = FakeEncoder()
+
+
+def make_classifier(scores, product_resolver):
+    classifier = LocalIntentClassifier(FakeVectorDB(), product_resolver=product_resolver)
+    classifier.score = lambda question: dict(scores)
+    return classifier
+
+
+def product_resolver():
+    with open(DATA_FILE, encoding="utf-8") as f:
+        return ProductNameResolver([p.get("product_name", "") for p in json.load(f)])
+
+
+def test_fast_path_extracts_product_names():
+    classifier = make_classifier({"get_calories": 0.95, "get_sugar_content": 0.6}, product_resolver())
+    result = classifier.classify("Sprite có bao nhiêu calo?")
+    assert result["intent"] == "get_calories"
+    assert result["entities"]["product_names"] == ["Sprite"]
+
+
+def test_fast_path_defers_product_question_without_known_name():
+    classifier = make_classifier({"get_calories": 0.95, "get_sugar_content": 0.6}, product_resolver())
+    assert classifier.classify("Loại này có bao nhiêu calo?") is None
+    assert make_classifier({"get_calories": 0.95}, None).classify("Sprite có bao nhiêu calo?") is None
+
+
+def test_fast_path_keeps_intents_without_entities():
+    classifier = make_classifier({"greeting": 0.95, "get_calories": 0.3}, product_resolver())
+    assert classifier.classify("Xin chào") == {"intent": "greeting", "entities": {}}
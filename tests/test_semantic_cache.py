@@ -0,0 +1,71 @@
+import time
+
+import numpy as np
+
+from product_resolver import ProductNameResolver
+from semantic_cache import SemanticAnswerCache
+
+PRODUCTS = [{"product_name": "Sprite"}, {"product_name": "Fanta Orange"}]
+
+
+class FakeVectorDB:
+    """Hai câu hỏi chỉ khác tên sản phẩm có embedding gần như trùng nhau"""
+
+    def encode_query(self, query):
+        vector = np.ones((1, 8), dtype=np.float32)
+        vector[0, 0] += 0.01 * len(query)
+        return vector / np.linalg.norm(vector)
+
+
+def make_system(bare_rag_system):
+    system = bare_rag_system
+    system.semantic_cache = SemanticAnswerCache(threshold=0.88)
+    system.vector_db = FakeVectorDB()
+    system.all_products_data = PRODUCTS
+    system.product_resolver = ProductNameResolver([p["product_name"] for p in PRODUCTS])
+    return system
+
+
+def answer(query, intent, entities, response):
+    return {"query": query, "intent": intent, "entities": entities, "response": response,
+            "relevant_chunks": [], "total_chunks_found": 0}
+
+
+def test_similar_questions_about_different_products_do_not_share_answers(bare_rag_system):
+    system = make_system(bare_rag_system)
+    system._remember_response("Sprite có bao nhiêu calo?",
+                              answer("Sprite có bao nhiêu calo?", "get_calories",
+                                     {"product_names": ["Sprite"]}, "Sprite có 140 kcal."))
+
+    assert system._semantic_cached_response("Fanta có bao nhiêu calo?", "get_calories",
+                                            {"product_names": ["Fanta Orange"]}) is None
+    hit = system._semantic_cached_response("Lượng calo của Sprite?", "get_calories",
+                                           {"product_names": ["Sprite"]})
+    assert hit["response"] == "Sprite có 140 kcal."
+
+
+def test_questions_without_distinguishing_entities_are_not_cached(bare_rag_system):
+    system = make_system(bare_rag_system)
+    system._remember_response("Sprite có bao nhiêu calo?",
+                              answer("Sprite có bao nhiêu calo?", "get_calories", {}, "Sprite có 140 kcal."))
+    system._remember_response("Các sản phẩm tại Việt Nam",
+                              answer("Các sản phẩm tại Việt Nam", "list_by_country", {}, "Coca-Cola, Sprite."))
+
+    assert len(system.semantic_cache) == 0
+    assert system._semantic_cached_response("Fanta có bao nhiêu calo?", "get_calories", {}) is None
+    assert system._semantic_cached_response("Các sản phẩm tại Nhật Bản", "list_by_country", {}) is None
+
+
+def test_expired_best_match_does_not_hide_valid_answer():
+    cache = SemanticAnswerCache(threshold=0.5, ttl=60)
+    older = np.array([1.0, 0.0], dtype=np.float32)
+    newer = np.array([0.8, 0.6], dtype=np.float32)
+    cache.put(older, "scope", "câu cũ", {"response": "cũ"})
+    cache.put(newer, "scope", "câu mới", {"response": "mới"})
+    # Câu giống nhất đã hết hạn, câu còn lại vẫn còn hạn và đủ giống
+    cache._entries[0] = cache._entries[0][:3] + (time.time() - 120,)
+
+    match = cache.lookup(older, "scope")
+
+    assert match["result"] == {"response": "mới"}
+    assert len(cache) == 1
@@ -0,0 +1,17 @@
+import threading
+
+
+def test_speculative_pool_is_shared_and_closed(bare_rag_system):
+    system = bare_rag_system
+    system.speculative_workers = 2
+    system._speculative_pool = None
+    system._speculative_pool_pid = None
+    system._speculation_lock = threading.Lock()
+
+    pool = system._speculative_executor()
+    assert system._speculative_executor() is pool
+    assert pool.submit(lambda: 42).result() == 42
+
+    system.close()
+    assert system._speculative_pool is None
+    assert pool._shutdown
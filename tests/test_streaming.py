@@ -0,0 +1,122 @@
+import json
+
+import pytest
+import requests
+
+import llm_generator
+import rag_system
+from llm_generator import LLMStreamError, stream_with_llm
+
+
+class BrokenStreamResponse:
+    """Response SSE trả về một đoạn text rồi mất kết nối"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self, decode_unicode=True):
+        yield "data: " + json.dumps({"candidates": [{"content": {"parts": [{"text": "Sprite là"}]}}]})
+        raise requests.exceptions.ChunkedEncodingError("Connection broken")
+
+
+class FailingResponse(BrokenStreamResponse):
+    """Key bị từ chối (hết quota) trước khi có đoạn text nào"""
+
+    def raise_for_status(self):
+        raise requests.exceptions.HTTPError("429 Too Many Requests")
+
+
+class FakeClient:
+    def __init__(self, response_class=BrokenStreamResponse):
+        self.response_class = response_class
+
+    def post(self, url, json=None, stream=False):
+        return self.response_class()
+
+
+def test_stream_with_llm_raises_after_partial_text(monkeypatch):
+    monkeypatch.setattr(llm_generator, "get_http_client", lambda: FakeClient())
+    monkeypatch.setattr(llm_generator, "gemini_api_keys", lambda: ["key-1", "key-2"])
+    stream = stream_with_llm("prompt")
+    assert next(stream) == "Sprite là"
+    with pytest.raises(LLMStreamError):
+        next(stream)
+
+
+def test_stream_with_llm_raises_when_every_key_fails(monkeypatch):
+    monkeypatch.setattr(llm_generator, "get_http_client", lambda: FakeClient(FailingResponse))
+    monkeypatch.setattr(llm_generator, "gemini_api_keys", lambda: ["key-1", "key-2"])
+    with pytest.raises(LLMStreamError, match="hết quota"):
+        list(stream_with_llm("prompt"))
+
+
+def broken_stream(prompt):
+    yield "Sprite là"
+    raise LLMStreamError("Gemini stream bị ngắt giữa chừng")
+
+
+def stub_pipeline(system):
+    """Các bước trước khi sinh câu trả lời: intent cố định, không cache theo ngữ nghĩa, luôn gọi LLM"""
+    system._classify = lambda query, timings: ({"intent": "product_inquiry", "entities": {}}, None)
+    system._speculative_results = lambda speculative, intent, entities, timings: None
+    system._semantic_cached_response = lambda query, intent, entities: None
+    system._route = lambda query, intent, entities, results: {"prompt": "prompt", "response": None,
+                                                              "relevant_items": []}
+
+
+def test_generate_response_stream_emits_error_event(monkeypatch, bare_rag_system):
+    monkeypatch.setattr(rag_system, "stream_with_llm", broken_stream)
+    system = bare_rag_system
+    stub_pipeline(system)
+
+    events = list(system.generate_response_stream("Sprite là gì?"))
+
+    assert [name for name, _ in events] == ["meta", "token", "error"]
+    assert events[-1][1]["partial_response"] == "Sprite là"
+
+
+def complete_stream(prompt):
+    yield "Sprite là"
+    yield " nước ngọt có ga vị chanh."
+
+
+def test_partial_stream_is_not_cached(monkeypatch, bare_rag_system, tmp_path):
+    from response_cache import DataVersion, ResponseCache
+
+    system = bare_rag_system
+    system.response_cache = ResponseCache(DataVersion(str(tmp_path / "index")))
+    stub_pipeline(system)
+
+    monkeypatch.setattr(rag_system, "stream_with_llm", broken_stream)
+    list(system.generate_response_stream("Sprite là gì?"))
+    assert system._cached_response("Sprite là gì?") is None
+
+    monkeypatch.setattr(rag_system, "stream_with_llm", complete_stream)
+    events = list(system.generate_response_stream("Sprite là gì?"))
+    assert events[-1][0] == "done"
+    cached = system._cached_response("Sprite là gì?")
+    assert cached["response"] == "Sprite là nước ngọt có ga vị chanh."
+    assert cached["cache"]["status"] == "hit"
+
+
+def test_generate_response_stream_emits_error_event_when_every_key_fails(monkeypatch, bare_rag_system, tmp_path):
+    from response_cache import DataVersion, ResponseCache
+
+    monkeypatch.setattr(llm_generator, "get_http_client", lambda: FakeClient(FailingResponse))
+    monkeypatch.setattr(llm_generator, "gemini_api_keys", lambda: ["key-1", "key-2"])
+    system = bare_rag_system
+    system.response_cache = ResponseCache(DataVersion(str(tmp_path / "index")))
+    stub_pipeline(system)
+
+    events = list(system.generate_response_stream("Sprite là gì?"))
+
+    assert [name for name, _ in events] == ["meta", "error"]
+    assert events[-1][1]["error"] == llm_generator.LLM_ERROR_RESPONSE
+    assert events[-1][1]["partial_response"] == ""
+    assert system._cached_response("Sprite là gì?") is None
@@ -1,24 +1,143 @@
 import json
 import os
+import inspect
+import logging
+import threading
+from contextlib import contextmanager
 import numpy as np
-import faiss
-from sentence_transformers import SentenceTransformer
 from typing import List, Dict, Any, Optional
 import pickle
+from lazy_import import lazy_module
+from cache import TTLCache, normalize_query
+from embedding_store import EmbeddingStore
+from query_encoders import QueryEncoder, load_query_encoder
+from batch_encoder import MicroBatchEncoder
+from snapshot import Snapshot, ColumnarMetadata, snapshot_exists, write_snapshot
+from context_packer import line_token_counts
+from search_backends import SearchBackend, build_backend, backend_from_faiss, normalize_vectors, tune_search_params
+
+faiss = lazy_module("faiss")
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+
+@contextmanager
+def _offline_env():
+    """Bật HF_HUB_OFFLINE/TRANSFORMERS_OFFLINE trong phạm vi with rồi trả lại giá trị cũ"""
+    saved = {name: os.environ.get(name) for name in ('HF_HUB_OFFLINE', 'TRANSFORMERS_OFFLINE')}
+    for name, value in saved.items():
+        if value is None:
+            os.environ[name] = '1'
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+
+
+def load_embedding_model(model_name: str = DEFAULT_MODEL_NAME, local_files_only: bool = True):
+    """
+    Load SentenceTransformer (import sentence_transformers/torch tại đây chứ không lúc import module).
+
+    Args:
+        model_name: Tên model embedding từ sentence-transformers
+        local_files_only: Chỉ dùng model đã có trong cache, không gọi Hugging Face Hub
+            (tải trước bằng: python vector_database.py --download-model); chỉ áp dụng cho lần load này,
+            các lần load khác trong cùng process vẫn tải được model
+    """
+    from sentence_transformers import SentenceTransformer
+    try:
+        if not local_files_only:
+            return SentenceTransformer(model_name)
+        if 'local_files_only' in inspect.signature(SentenceTransformer.__init__).parameters:
+            return SentenceTransformer(model_name, local_files_only=True)
+        # sentence-transformers < 2.3 không có tham số local_files_only: bật chế độ offline trong lúc load
+        with _offline_env():
+            return SentenceTransformer(model_name)
+    except (OSError, ValueError) as e:
+        if local_files_only:
+            raise RuntimeError(f"Chưa có model {model_name} trong cache, "
+                               f"chạy 'python vector_database.py --download-model' trước: {e}") from e
+        raise
 
 class VectorDatabase:
-    def __init__(self, model_name: str = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"):
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME,
+                 query_cache_size: int = 1024, query_cache_ttl: Optional[float] = 3600,
+                 local_files_only: Optional[bool] = None, encoder_backend: Optional[str] = None,
+                 micro_batch: Optional[bool] = None):
         """
-        Khởi tạo vector database với model embedding và FAISS index
+        Khởi tạo vector database. Model embedding chỉ được load ở lần đầu cần encode (thuộc tính model).
         
         Args:
             model_name: Tên model embedding từ sentence-transformers
+            query_cache_size: Số embedding câu truy vấn tối đa được cache (0 để tắt cache)
+            query_cache_ttl: Thời gian sống của embedding trong cache (giây), None là không hết hạn
+            local_files_only: Chỉ load model từ cache cục bộ, mặc định theo biến môi trường
+                EMBEDDING_MODEL_OFFLINE (mặc định bật)
+            encoder_backend: Backend encode câu truy vấn (xem query_encoders.py), mặc định theo biến môi trường
+                EMBEDDING_BACKEND (mặc định "torch"); embedding của chunk luôn dùng model fp32
+            micro_batch: Gom các câu truy vấn (chưa có trong cache) của các request đồng thời thành một lần encode,
+                mặc định theo EMBEDDING_MICRO_BATCH (mặc định bật); kích thước lô và thời gian chờ gom cấu hình qua
+                EMBEDDING_BATCH_SIZE (mặc định 32) và EMBEDDING_BATCH_WAIT_MS (mặc định 2)
         """
-        self.model = SentenceTransformer(model_name)
-        self.index = None
+        self.model_name = model_name
+        if local_files_only is None:
+            local_files_only = os.getenv('EMBEDDING_MODEL_OFFLINE', '1') != '0'
+        self.local_files_only = local_files_only
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.encoder_backend = encoder_backend or os.getenv('EMBEDDING_BACKEND', 'torch')
+        self._query_encoder: Optional[QueryEncoder] = None
+        if micro_batch is None:
+            micro_batch = os.getenv('EMBEDDING_MICRO_BATCH', '1') != '0'
+        self.batch_encoder = MicroBatchEncoder(
+            lambda texts: self.query_encoder.encode(texts),
+            max_batch_size=int(os.getenv('EMBEDDING_BATCH_SIZE', '32')),
+            max_wait_ms=float(os.getenv('EMBEDDING_BATCH_WAIT_MS', '2'))
+        ) if micro_batch else None
+        self.backend: Optional[SearchBackend] = None
         self.chunks = []
         self.chunk_metadata = []
+        # Số token từng dòng của chunk, tính sẵn lúc build index (snapshot)
+        self.line_tokens = None
+        # Cache embedding câu truy vấn theo text đã chuẩn hoá
+        self.query_cache = TTLCache(max_size=query_cache_size, ttl=query_cache_ttl)
+        self._reset_search_state()
         
+    @property
+    def model(self):
+        """Model embedding, load ở lần truy cập đầu tiên"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = load_embedding_model(self.model_name, self.local_files_only)
+                    logger.info(f"Đã load model embedding {self.model_name}")
+        return self._model
+
+    @property
+    def model_loaded(self) -> bool:
+        return self._model is not None
+
+    @property
+    def query_encoder(self) -> QueryEncoder:
+        """Backend encode câu truy vấn, load ở lần truy cập đầu tiên (backend "torch" dùng chung model fp32)"""
+        if self._query_encoder is None:
+            model = self.model if self.encoder_backend == "torch" else None
+            with self._model_lock:
+                if self._query_encoder is None:
+                    self._query_encoder = load_query_encoder(self.encoder_backend, self.model_name,
+                                                             self.local_files_only, model=model)
+        return self._query_encoder
+
+    def encoder_info(self) -> Dict[str, Any]:
+        """Backend encode câu truy vấn và thời gian load (nếu đã load)"""
+        if self._query_encoder is None:
+            return {'backend': self.encoder_backend, 'loaded': False}
+        return dict(self._query_encoder.describe(), loaded=True)
+
     def load_chunks(self, chunks_file: str = "chunks/all_chunks.json"):
         """Load chunks từ file JSON"""
         if not os.path.exists(chunks_file):
@@ -28,139 +147,334 @@ class VectorDatabase:
             self.chunks = json.load(f)
         
         self.chunk_metadata = [chunk.get('metadata', {}) for chunk in self.chunks]
+        self.line_tokens = None
+        self._reset_search_state()
         print(f"Đã load {len(self.chunks)} chunks")
         
-    def create_embeddings(self) -> np.ndarray:
-        """Tạo embeddings cho tất cả chunks"""
+    def create_embeddings(self, store: Optional[EmbeddingStore] = None) -> np.ndarray:
+        """
+        Tạo embeddings cho tất cả chunks
+
+        Args:
+            store: Kho embedding theo hash nội dung; nếu có, chỉ encode các chunk chưa có trong kho
+                và lưu lại kho (chỉ giữ embedding của các chunk hiện tại)
+        """
         if not self.chunks:
             raise ValueError("Chưa có chunks để tạo embeddings")
         
         # Trích xuất nội dung chunks
         contents = [chunk['content'] for chunk in self.chunks]
+        if store is None:
+            found, missing = [None] * len(contents), list(range(len(contents)))
+        else:
+            found, missing = store.lookup(contents)
+            print(f"Dùng lại {len(contents) - len(missing)} embeddings từ {store.path}")
         
-        # Tạo embeddings
-        print("Đang tạo embeddings...")
-        embeddings = self.model.encode(contents, show_progress_bar=True)
+        # Tạo embeddings cho các chunk mới/đã sửa
+        if missing:
+            print(f"Đang tạo embeddings cho {len(missing)} chunks...")
+            encoded = np.asarray(self.model.encode([contents[i] for i in missing], show_progress_bar=True),
+                                 dtype=np.float32)
+            for i, vector in zip(missing, encoded):
+                found[i] = vector
+                if store is not None:
+                    store.put(store.key(contents[i]), vector)
+        if store is not None:
+            store.save(keep=[store.key(content) for content in contents])
+        embeddings = np.stack(found).astype(np.float32)
         
         print(f"Đã tạo embeddings với shape: {embeddings.shape}")
         return embeddings
     
-    def build_index(self, embeddings: np.ndarray, index_type: str = "IndexFlatL2", 
-                   nlist: int = 100, m: int = 8, bits: int = 8):
+    def build_index(self, embeddings: np.ndarray, index_type: str = "auto",
+                   nlist: Optional[int] = None, m: int = 8, bits: int = 8, nprobe: Optional[int] = None,
+                   hnsw_m: int = 32, ef_construction: int = 40, ef_search: int = 64):
         """
-        Xây dựng FAISS index
+        Xây dựng backend tìm kiếm trên embeddings đã chuẩn hoá L2 (điểm là cosine similarity)
         
         Args:
             embeddings: Ma trận embeddings
-            index_type: Loại index ("IndexFlatL2", "IndexIVFFlat", "IndexIVFPQ")
-            nlist: Số cluster cho IVF (chỉ dùng cho IVF)
-            m: Số sub-vectors cho PQ (chỉ dùng cho IndexIVFPQ)
-            bits: Số bits cho PQ (chỉ dùng cho IndexIVFPQ)
+            index_type: "auto" (chọn theo kích thước corpus), "numpy", "faiss_flat", "faiss_ivf", "faiss_ivfpq",
+                "faiss_hnsw" hoặc tên FAISS index cũ ("IndexFlatL2", "IndexIVFFlat", "IndexIVFPQ")
+            nlist: Số cluster cho IVF, None là tự tính theo kích thước corpus
+            m: Số sub-vectors cho PQ (chỉ dùng cho IVFPQ)
+            bits: Số bits cho PQ (chỉ dùng cho IVFPQ)
+            nprobe: Số cluster được duyệt khi search IVF, None là nlist / 8
+            hnsw_m: Số láng giềng mỗi node của đồ thị HNSW
+            ef_construction: Độ rộng tìm kiếm khi xây đồ thị HNSW
+            ef_search: Độ rộng tìm kiếm khi search HNSW
         """
-        dimension = embeddings.shape[1]
-        
-        if index_type == "IndexFlatL2":
-            self.index = faiss.IndexFlatL2(dimension)
-            print("Đã tạo IndexFlatL2")
-            
-        elif index_type == "IndexIVFFlat":
-            # Tạo quantizer
-            quantizer = faiss.IndexFlatL2(dimension)
-            self.index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
-            print(f"Đã tạo IndexIVFFlat với {nlist} clusters")
-            
-        elif index_type == "IndexIVFPQ":
-            # Tạo quantizer
-            quantizer = faiss.IndexFlatL2(dimension)
-            self.index = faiss.IndexIVFPQ(quantizer, dimension, nlist, m, bits)
-            print(f"Đã tạo IndexIVFPQ với {nlist} clusters, {m} sub-vectors, {bits} bits")
-            
-        else:
-            raise ValueError(f"Không hỗ trợ index type: {index_type}")
-        
-        # Thêm vectors vào index
-        if index_type in ["IndexIVFFlat", "IndexIVFPQ"]:
-            # Cần train cho IVF
-            print("Đang train index...")
-            self.index.train(embeddings)
-        
-        print("Đang thêm vectors vào index...")
-        self.index.add(embeddings)
-        print(f"Đã thêm {self.index.ntotal} vectors vào index")
+        vectors = normalize_vectors(embeddings)
+        print(f"Đang build backend {index_type} cho {vectors.shape[0]} vectors...")
+        self.backend = build_backend(vectors, index_type, nlist=nlist, nprobe=nprobe, m=m, bits=bits,
+                                     hnsw_m=hnsw_m, ef_construction=ef_construction, ef_search=ef_search)
+        self._reset_search_state()
+        print(f"Đã build backend {self.backend.name} với {self.backend.ntotal} vectors")
     
+    def set_search_params(self, **params) -> Dict[str, int]:
+        """Đặt tham số lúc search của index xấp xỉ (nprobe cho IVF, ef_search cho HNSW)"""
+        if self.backend is None:
+            raise ValueError("Chưa có index, cần build index trước")
+        return self.backend.set_search_params(**params)
+
+    def tune_search(self, queries: Optional[List[str]] = None, k: int = 5, target_recall: float = 0.95,
+                    sample_size: int = 200) -> Dict[str, Any]:
+        """
+        Tự chọn tham số search nhanh nhất đạt recall@k >= target_recall so với tìm kiếm chính xác.
+        Tham số được chọn có hiệu lực ngay và được lưu cùng index khi gọi save_index.
+
+        Args:
+            queries: Câu truy vấn mẫu, None là lấy ngẫu nhiên sample_size vector chunk làm truy vấn
+            k: Số kết quả dùng để tính recall
+            target_recall: Recall@k tối thiểu
+            sample_size: Số vector chunk lấy làm truy vấn khi không truyền queries
+        """
+        if self.backend is None:
+            raise ValueError("Chưa có index, cần build index trước")
+        if queries:
+            query_embeddings = self.encode_queries(queries)
+        else:
+            rng = np.random.default_rng(0)
+            sample = rng.choice(self.backend.ntotal, min(sample_size, self.backend.ntotal), replace=False)
+            query_embeddings = np.ascontiguousarray(self.backend.vectors[np.sort(sample)])
+        return tune_search_params(self.backend, query_embeddings, k=k, target_recall=target_recall)
+
+    def index_info(self) -> Dict[str, Any]:
+        """Thông tin backend tìm kiếm (loại backend, số vectors, metric, ...)"""
+        if self.backend is None:
+            return {'backend': None, 'total_vectors': 0}
+        return self.backend.describe()
+
+    def encode_query(self, query: str) -> np.ndarray:
+        """
+        Tạo embedding (shape (1, dim), đã chuẩn hoá L2) cho câu truy vấn.
+        Câu truy vấn được chuẩn hoá trước khi encode, nếu đã có trong cache thì bỏ qua model.
+        """
+        return self.encode_queries([query])
+
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Tạo embedding (shape (n, dim), đã chuẩn hoá L2) cho nhiều câu truy vấn.
+        Các câu đã có trong cache được lấy ra, các câu còn lại được encode trong một lần forward của model
+        (cùng lô với câu truy vấn của các request đồng thời khi bật micro-batch).
+        """
+        keys = [normalize_query(query) for query in queries]
+        embeddings = [None] * len(keys)
+        missing = {}
+        for i, key in enumerate(keys):
+            cached = self.query_cache.get(key)
+            if cached is not None:
+                embeddings[i] = cached[0]
+            else:
+                missing.setdefault(key, []).append(i)
+        if missing:
+            texts = list(missing.keys())
+            encoder = self.batch_encoder or self.query_encoder
+            encoded = normalize_vectors(encoder.encode(texts))
+            for text, embedding in zip(texts, encoded):
+                self.query_cache.put(text, embedding[None, :].copy())
+                for i in missing[text]:
+                    embeddings[i] = embedding
+        # np.stack tạo mảng mới nên FAISS/người gọi không sửa vào dữ liệu trong cache
+        return np.stack(embeddings).astype(np.float32)
+
     def search(self, query: str, k: int = 5, metadata_filter: Dict = None) -> List[Dict]:
-        if self.index is None:
+        return self.search_batch([query], k=k, metadata_filters=metadata_filter)[0]
+
+    def search_batch(self, queries: List[str], k: int = 5, metadata_filters=None) -> List[List[Dict]]:
+        """
+        Tìm kiếm nhiều câu truy vấn cùng lúc: encode trong một lần forward và search FAISS trên cả ma trận truy vấn
+
+        Args:
+            queries: Danh sách câu truy vấn
+            k: Số kết quả cho mỗi câu truy vấn
+            metadata_filters: None, một dict filter dùng chung cho mọi câu truy vấn,
+                hoặc danh sách filter (dict hoặc None) tương ứng từng câu truy vấn
+
+        Returns:
+            Danh sách kết quả theo thứ tự của queries
+        """
+        if self.backend is None:
             raise ValueError("Chưa có index, cần build index trước")
-        query_embedding = self.model.encode([query])
-        faiss.normalize_L2(query_embedding)
-        if not metadata_filter:
-            scores, indices = self.index.search(query_embedding, k)
-            results = []
-            for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-                if idx != -1:
-                    results.append({'rank': i + 1, 'score': float(score), 'chunk': self.chunks[idx], 'index': int(idx)})
-            return results
-        # Nếu có filter, search top 100 rồi lọc
-        search_k = min(self.index.ntotal, 100)
-        scores, indices = self.index.search(query_embedding, search_k)
-        filtered_results = []
-        for score, idx in zip(scores[0], indices[0]):
+        if not queries:
+            return []
+        if metadata_filters is None or isinstance(metadata_filters, dict):
+            metadata_filters = [metadata_filters] * len(queries)
+        if len(metadata_filters) != len(queries):
+            raise ValueError("Số filter phải bằng số câu truy vấn")
+
+        query_embeddings = self.encode_queries(queries)
+        all_results = [[] for _ in queries]
+
+        plain_rows = [i for i, metadata_filter in enumerate(metadata_filters) if not metadata_filter]
+        if plain_rows:
+            scores, indices = self.backend.search(query_embeddings[plain_rows], k)
+            for row, i in enumerate(plain_rows):
+                all_results[i] = self._collect_results(scores[row], indices[row], k)
+
+        # Nếu có filter, chỉ search trong tập chunk khớp filter (chính xác, luôn đủ k nếu có đủ chunk khớp).
+        # Các câu truy vấn có cùng filter được tính chung một phép nhân ma trận.
+        rows_by_filter = {}
+        for i, metadata_filter in enumerate(metadata_filters):
+            if metadata_filter:
+                rows_by_filter.setdefault(self._filter_key(metadata_filter), []).append(i)
+        for rows in rows_by_filter.values():
+            candidate_ids = self._candidate_ids(metadata_filters[rows[0]])
+            scores, indices = self.backend.search_subset(query_embeddings[rows], candidate_ids, k)
+            for row, i in enumerate(rows):
+                all_results[i] = self._collect_results(scores[row], indices[row], k)
+        return all_results
+
+    def refine(self, candidates: List[Dict], k: int, metadata_filter: Dict = None) -> Optional[List[Dict]]:
+        """
+        Lọc theo metadata_filter và lấy k kết quả tốt nhất từ một lần search rộng không filter (top-N theo score).
+        Chunk khớp filter nằm ngoài top-N có score thấp hơn mọi ứng viên, nên nếu còn ít nhất k ứng viên khớp
+        thì kết quả giống search có filter.
+
+        Args:
+            candidates: Kết quả search() không filter, đã sắp xếp theo score giảm dần
+
+        Returns:
+            Kết quả (rank đánh lại), hoặc None nếu còn ít hơn k ứng viên khớp và tập ứng viên chưa phủ cả index,
+            khi đó cần search lại với filter
+        """
+        matched = [res for res in candidates
+                   if not metadata_filter or self._matches_filter(res['index'], metadata_filter)]
+        if len(matched) < k and len(candidates) < self.backend.ntotal:
+            return None
+        return [dict(res, rank=rank) for rank, res in enumerate(matched[:k], 1)]
+
+    def chunk_line_tokens(self, idx: int):
+        """Số token ước lượng từng dòng của chunk idx: lấy từ snapshot, không có thì tính (và nhớ lại)"""
+        if self.line_tokens is not None:
+            return self.line_tokens[idx]
+        counts = self._line_token_cache.get(idx)
+        if counts is None:
+            counts = self._line_token_cache[idx] = line_token_counts(self.chunks[idx]['content'])
+        return counts
+
+    def _reset_search_state(self):
+        """Xây lại inverted index của metadata và xoá các dữ liệu phụ trợ khi chunks/index thay đổi"""
+        self._candidate_cache = {}
+        self._line_token_cache = {}
+        if isinstance(self.chunk_metadata, ColumnarMetadata):
+            # Metadata từ snapshot đã ở dạng cột, tính thẳng từ mảng mã
+            self._metadata_index = self.chunk_metadata.inverted_index()
+            return
+        self._metadata_index = {}
+        for idx, chunk_metadata in enumerate(self.chunk_metadata):
+            for key, value in chunk_metadata.items():
+                try:
+                    self._metadata_index.setdefault(key, {}).setdefault(value, []).append(idx)
+                except TypeError:
+                    # Giá trị không hash được (list, dict) thì không index, lọc tuần tự khi cần
+                    continue
+        for key, values in self._metadata_index.items():
+            for value, ids in values.items():
+                values[value] = np.asarray(ids, dtype=np.int64)
+
+    def _filter_key(self, metadata_filter: Dict):
+        try:
+            return tuple(sorted(metadata_filter.items()))
+        except TypeError:
+            return repr(sorted(metadata_filter.items(), key=lambda item: item[0]))
+
+    def _candidate_ids(self, metadata_filter: Dict) -> np.ndarray:
+        """Chỉ số (đã sắp xếp) của các chunk khớp toàn bộ điều kiện trong metadata_filter"""
+        key = self._filter_key(metadata_filter)
+        cached = self._candidate_cache.get(key)
+        if cached is not None:
+            return cached
+        candidate_ids = None
+        for field, value in metadata_filter.items():
+            try:
+                ids = self._metadata_index.get(field, {}).get(value)
+            except TypeError:
+                ids = np.asarray([idx for idx in range(len(self.chunk_metadata))
+                                  if self.chunk_metadata[idx].get(field) == value], dtype=np.int64)
+            if ids is None:
+                ids = np.empty(0, dtype=np.int64)
+            candidate_ids = ids if candidate_ids is None else np.intersect1d(candidate_ids, ids, assume_unique=True)
+            if candidate_ids.size == 0:
+                break
+        self._candidate_cache[key] = candidate_ids
+        return candidate_ids
+
+    def _matches_filter(self, idx: int, metadata_filter: Dict) -> bool:
+        chunk_metadata = self.chunk_metadata[idx]
+        for key, value in metadata_filter.items():
+            if chunk_metadata.get(key) != value:
+                return False
+        return True
+
+    def _collect_results(self, scores: np.ndarray, indices: np.ndarray, k: int) -> List[Dict]:
+        results = []
+        for score, idx in zip(scores, indices):
             if idx == -1:
                 continue
-            chunk_metadata = self.chunk_metadata[idx]
-            is_match = True
-            for key, value in metadata_filter.items():
-                if chunk_metadata.get(key) != value:
-                    is_match = False
-                    break
-            if is_match:
-                filtered_results.append({'score': float(score), 'chunk': self.chunks[idx], 'index': int(idx)})
-            if len(filtered_results) >= k:
+            results.append({'rank': len(results) + 1, 'score': float(score), 'chunk': self.chunks[idx], 'index': int(idx)})
+            if len(results) >= k:
                 break
-        return filtered_results
+        return results
     
     def save_index(self, filepath: str):
-        """Lưu index và metadata"""
-        if self.index is None:
+        """Lưu index và chunks dạng snapshot memory-mapped ({filepath}.snapshot, xem snapshot.py)"""
+        if self.backend is None:
             raise ValueError("Chưa có index để lưu")
         
-        # Lưu index
-        faiss.write_index(self.index, f"{filepath}.index")
-        
-        # Lưu metadata
-        metadata = {
-            'chunks': self.chunks,
-            'chunk_metadata': self.chunk_metadata
-        }
-        with open(f"{filepath}.metadata", 'wb') as f:
-            pickle.dump(metadata, f)
-        
-        print(f"Đã lưu index và metadata vào {filepath}")
+        path = write_snapshot(filepath, self.backend, self.chunks, self.chunk_metadata)
+        print(f"Đã lưu index và metadata vào {path}")
     
-    def load_index(self, filepath: str):
-        """Load index và metadata"""
-        # Load index
-        self.index = faiss.read_index(f"{filepath}.index")
-        
-        # Load metadata
-        with open(f"{filepath}.metadata", 'rb') as f:
-            metadata = pickle.load(f)
-            self.chunks = metadata['chunks']
-            self.chunk_metadata = metadata.get('chunk_metadata', [])
+    def load_index(self, filepath: str, backend: str = "auto", search_params: Optional[Dict[str, int]] = None):
+        """
+        Load index và metadata. Ưu tiên snapshot ({filepath}.snapshot), không có thì đọc định dạng cũ
+        ({filepath}.index + {filepath}.metadata pickle); index L2 cũ được chuyển sang inner product khi load.
+
+        Args:
+            filepath: Đường dẫn index (không có phần mở rộng)
+            backend: Backend tìm kiếm, "auto" là giữ index xấp xỉ đã lưu hoặc chọn theo kích thước corpus
+            search_params: Tham số lúc search ghi đè giá trị đã lưu, ví dụ {"nprobe": 16} hoặc {"ef_search": 64}
+        """
+        if snapshot_exists(filepath):
+            snapshot = Snapshot(filepath)
+            self.backend = snapshot.backend(backend, search_params=search_params)
+            self.chunks = snapshot.chunks
+            self.chunk_metadata = snapshot.chunk_metadata
+            self.line_tokens = snapshot.line_tokens
+        else:
+            self.backend = backend_from_faiss(faiss.read_index(f"{filepath}.index"), backend,
+                                              search_params=search_params)
+            with open(f"{filepath}.metadata", 'rb') as f:
+                metadata = pickle.load(f)
+                self.chunks = metadata['chunks']
+                self.chunk_metadata = metadata.get('chunk_metadata', [])
+            self.line_tokens = None
+        self._reset_search_state()
         
         print(f"Đã load index và metadata từ {filepath}")
-        print(f"Index có {self.index.ntotal} vectors")
+        print(f"Index có {self.backend.ntotal} vectors (backend {self.backend.name})")
+
+
+def index_exists(filepath: str) -> bool:
+    """Đã có vector database (snapshot hoặc định dạng cũ) tại filepath chưa"""
+    return snapshot_exists(filepath) or os.path.exists(f"{filepath}.index")
 
 def create_vector_database(chunks_file: str = "chunks/all_chunks.json", 
-                          index_type: str = "IndexFlatL2",
-                          save_path: str = "vector_db/coca_cola_index"):
+                          index_type: str = "auto",
+                          save_path: str = "vector_db/coca_cola_index",
+                          target_recall: Optional[float] = None,
+                          embedding_store_path: Optional[str] = "cache/embeddings.npz",
+                          **index_params):
     """
     Tạo và lưu vector database
     
     Args:
         chunks_file: Đường dẫn file chunks
-        index_type: Loại FAISS index
+        index_type: Loại backend tìm kiếm (xem VectorDatabase.build_index)
         save_path: Đường dẫn lưu index
+        embedding_store_path: File kho embedding theo hash nội dung, chỉ encode lại chunk mới/đã sửa (None để tắt)
+        target_recall: Nếu có, tự tune tham số search của index xấp xỉ theo recall@k này trước khi lưu
+        index_params: Tham số khác của build_index (nlist, nprobe, hnsw_m, ef_construction, ef_search, ...)
     """
     # Tạo thư mục lưu
     os.makedirs(os.path.dirname(save_path), exist_ok=True)
@@ -171,16 +485,14 @@ def create_vector_database(chunks_file: str = "chunks/all_chunks.json",
     # Load chunks
     vdb.load_chunks(chunks_file)
     
-    # Tạo embeddings
-    embeddings = vdb.create_embeddings()
+    # Tạo embeddings (dùng lại embedding của các chunk không đổi)
+    store = EmbeddingStore(embedding_store_path, vdb.model_name) if embedding_store_path else None
+    embeddings = vdb.create_embeddings(store)
     
-    # Build index
-    if index_type == "IndexIVFFlat":
-        vdb.build_index(embeddings, index_type, nlist=100)
-    elif index_type == "IndexIVFPQ":
-        vdb.build_index(embeddings, index_type, nlist=100, m=8, bits=8)
-    else:
-        vdb.build_index(embeddings, index_type)
+    # Build index (nlist của IVF tự tính theo kích thước corpus)
+    vdb.build_index(embeddings, index_type, **index_params)
+    if target_recall is not None:
+        vdb.tune_search(target_recall=target_recall)
     
     # Lưu index
     vdb.save_index(save_path)
@@ -188,9 +500,17 @@ def create_vector_database(chunks_file: str = "chunks/all_chunks.json",
     return vdb
 
 if __name__ == "__main__":
+    import sys
+
+    if "--download-model" in sys.argv:
+        # Tải model về cache cục bộ (bước build), sau đó ứng dụng chỉ load offline
+        load_embedding_model(local_files_only=False)
+        print(f"Đã tải model {DEFAULT_MODEL_NAME}")
+        sys.exit(0)
+
     # Test tạo vector database
-    print("Tạo vector database với IndexFlatL2...")
-    vdb = create_vector_database(index_type="IndexFlatL2")
+    print("Tạo vector database...")
+    vdb = create_vector_database()
     
     # Test tìm kiếm
     print("\nTest tìm kiếm:")